@@ -0,0 +1,115 @@
+from pathlib import Path
+from datetime import datetime, timezone
+from importlib import metadata as importlib_metadata
+from typing import Optional
+import json
+import joblib
+import polars as pl
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# bump when the layout of the artifact folder or metadata changes
+ARTIFACT_FORMAT_VERSION = 1
+_MODEL_FILE_NAME = 'model.joblib'
+_METADATA_FILE_NAME = 'metadata.json'
+_TRACKED_LIBRARIES = ['econml', 'lightgbm', 'scikit-learn', 'polars', 'numpy']
+
+
+def _library_versions() -> dict[str, Optional[str]]:
+    versions = dict()
+    for library in _TRACKED_LIBRARIES:
+        try:
+            versions[library] = importlib_metadata.version(library)
+        except importlib_metadata.PackageNotFoundError:
+            versions[library] = None
+    return versions
+
+
+def feature_schema(features: pl.DataFrame) -> list[dict[str, str]]:
+    """ ordered feature columns with their dtypes, as stored in the artifact metadata """
+    return [{'name': name, 'dtype': str(dtype)} for name, dtype in features.schema.items()]
+
+
+def save_model_artifact(cate_model,
+                        features: pl.DataFrame,
+                        artifact_dir: str | Path,
+                        extra_metadata: Optional[dict] = None) -> Path:
+    """ Save a fitted CATE model together with the schema of the features it was fitted on
+
+    Args:
+        cate_model: fitted model (e.g. model.XLearner)
+        features (pl.DataFrame): the model's input features (without member_id and labels)
+        artifact_dir (str | Path): folder to save the model and its metadata.json to
+        extra_metadata (Optional[dict], optional): e.g. featurization parameters. Defaults to None.
+
+    Returns:
+        Path: artifact_dir
+    """
+    artifact_dir = Path(artifact_dir)
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+
+    created_at = datetime.now(timezone.utc)
+    metadata = {
+        'format_version': ARTIFACT_FORMAT_VERSION,
+        'model_version': created_at.strftime('%Y%m%dT%H%M%SZ'),
+        'created_at': created_at.isoformat(),
+        'model_class': type(cate_model).__name__,
+        'feature_schema': feature_schema(features),
+        'library_versions': _library_versions(),
+        **(extra_metadata or dict()),
+    }
+
+    joblib.dump(cate_model, artifact_dir / _MODEL_FILE_NAME)
+    (artifact_dir / _METADATA_FILE_NAME).write_text(json.dumps(metadata, indent=2, default=str))
+    logger.info(f"Saved {metadata['model_class']} model version {metadata['model_version']} to {artifact_dir}")
+    return artifact_dir
+
+
+def load_model_artifact(artifact_dir: str | Path) -> tuple[object, dict]:
+    """ Load a model saved with save_model_artifact
+
+    Args:
+        artifact_dir (str | Path):
+
+    Returns:
+        tuple[object, dict]: fitted model and its metadata
+    """
+    artifact_dir = Path(artifact_dir)
+    metadata = json.loads((artifact_dir / _METADATA_FILE_NAME).read_text())
+    if metadata['format_version'] != ARTIFACT_FORMAT_VERSION:
+        raise ValueError(f"Model artifact {artifact_dir} has format version {metadata['format_version']}, "
+                         f"expected {ARTIFACT_FORMAT_VERSION}")
+
+    library_versions = _library_versions()
+    for library, version in metadata['library_versions'].items():
+        if library_versions.get(library) != version:
+            logger.warning(f"Model artifact was saved with {library} {version}, running with {library_versions.get(library)}")
+
+    cate_model = joblib.load(artifact_dir / _MODEL_FILE_NAME)
+    logger.info(f"Loaded {metadata['model_class']} model version {metadata['model_version']} from {artifact_dir}")
+    return cate_model, metadata
+
+
+def check_feature_schema(metadata: dict, features: pl.DataFrame):
+    """ Raise if the features don't have the columns (names and order) the model was fitted on.
+        dtype differences are only logged, the model sees all features as floats.
+
+    Args:
+        metadata (dict): artifact metadata
+        features (pl.DataFrame): the model's input features (without member_id and labels)
+    """
+    expected = metadata['feature_schema']
+    actual = feature_schema(features)
+    expected_names = [column['name'] for column in expected]
+    actual_names = [column['name'] for column in actual]
+    if expected_names != actual_names:
+        missing = [name for name in expected_names if name not in actual_names]
+        extra = [name for name in actual_names if name not in expected_names]
+        raise ValueError(f"Feature schema doesn't match the model artifact: missing {missing}, unexpected {extra}"
+                         + ("" if missing or extra else ", columns are in a different order"))
+    for expected_column, actual_column in zip(expected, actual):
+        if expected_column['dtype'] != actual_column['dtype']:
+            logger.warning(f"Feature {actual_column['name']} has dtype {actual_column['dtype']}, "
+                           f"model was fitted on {expected_column['dtype']}")
@@ -0,0 +1,119 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import json
+import os
+import platform
+import time
+
+import polars as pl
+
+from synthetic_data import generate_train_test
+from data_ingestion import ingest_and_pre_process_data
+from featurization import featurize_data
+from model import train_cate, evaluate_cate
+from instrumentation import PeakRSS
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STAGES = ['ingest', 'featurize', 'train', 'evaluate']
+
+
+def _measure(stage: str, rows: int, fn, *args, **kwargs):
+    """ run a stage and return its result and wall time, peak RSS and rows/sec """
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        wall_s = time.perf_counter() - start
+    metrics = {
+        'wall_s': wall_s,
+        'peak_rss_mb': rss.peak_bytes / 2**20,
+        'peak_rss_delta_mb': (rss.peak_bytes - rss.start_bytes) / 2**20,
+        'rows': rows,
+        'rows_per_s': rows / max(wall_s, 1e-9),
+    }
+    logger.info(f"{stage}: {wall_s:.2f}s, peak RSS {metrics['peak_rss_mb']:.0f}MB, {metrics['rows_per_s']:,.0f} rows/s")
+    return result, metrics
+
+
+def run_scale(data_folder: Path,
+              n_members: int,
+              stages: list[str],
+              lazy: bool = False,
+              n_estimators: int = 1000,
+              seed: int = 0) -> dict:
+    """ generate (or reuse) a synthetic dataset of n_members and benchmark each pipeline stage on it """
+    scale_folder = data_folder / f'members_{n_members}'
+    rows_path = scale_folder / 'rows.json'
+    if rows_path.exists():
+        n_rows = json.loads(rows_path.read_text())
+    else:
+        n_rows = generate_train_test(scale_folder, n_members, seed=seed)
+        rows_path.write_text(json.dumps(n_rows))
+    train_rows = n_rows['train']
+    event_rows = sum(rows for source, rows in train_rows.items() if source != 'churn_labels')
+
+    results = {'n_members': n_members, 'input_rows': train_rows, 'stages': dict()}
+    # a stage needs all the earlier ones
+    last = max(STAGES.index(stage) for stage in stages)
+    if lazy:
+        # the lazy ingest functions only build plans, all of their work runs when the features are collected,
+        # so ingest and featurize are measured as one stage
+        def ingest_and_featurize():
+            return featurize_data(ingest_and_pre_process_data(scale_folder / 'train', lazy=True, n_workers=4))
+        features_w_labels, results['stages']['ingest+featurize'] = _measure('ingest+featurize', sum(train_rows.values()),
+                                                                            ingest_and_featurize)
+    else:
+        dfs, results['stages']['ingest'] = _measure('ingest', sum(train_rows.values()),
+                                                    ingest_and_pre_process_data, scale_folder / 'train', n_workers=4)
+        if last >= STAGES.index('featurize'):
+            features_w_labels, results['stages']['featurize'] = _measure('featurize', event_rows, featurize_data, dfs)
+    if last >= STAGES.index('train'):
+        cate_model, results['stages']['train'] = _measure('train', n_members, train_cate, features_w_labels,
+                                                          lgbm_params={'n_estimators': n_estimators})
+    if last >= STAGES.index('evaluate'):
+        _, results['stages']['evaluate'] = _measure('evaluate', n_members, evaluate_cate, cate_model, features_w_labels)
+    return results
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmark the pipeline stages on synthetic data at several scales.")
+    parser.add_argument("--data-folder", type=str, default="bench_data",
+                        help="Folder for the generated datasets, reused across runs.")
+    parser.add_argument("--output", type=str, default="bench_results.json", help="JSON file to write the results to.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000],
+                        help="Numbers of members.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="Stages to benchmark (the stages they depend on also run).")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Benchmark the lazy streaming ingestion, measured together with featurization as one stage.")
+    parser.add_argument("--n-estimators", type=int, default=1000, help="Trees of each LightGBM model in the train stage.")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'polars': pl.__version__,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+        },
+        'settings': {'lazy': args.lazy, 'n_estimators': args.n_estimators, 'stages': args.stages},
+        'scales': [],
+    }
+    for n_members in args.scales:
+        logger.info(f"Benchmarking {n_members} members...")
+        results['scales'].append(run_scale(Path(args.data_folder), n_members, args.stages,
+                                           lazy=args.lazy, n_estimators=args.n_estimators, seed=args.seed))
+        # written after every scale, so partial results survive an interrupted run
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    logger.info(f"Benchmark results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
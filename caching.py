@@ -0,0 +1,82 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_HASH_CHUNK_SIZE = 8 * 1024 * 1024
+_FINGERPRINT_MEMO_NAME = 'fingerprints.json'
+# guards the memo file when files are fingerprinted from several threads
+_memo_lock = threading.Lock()
+
+
+def _content_hash(file_path: Path) -> str:
+    """ blake2b hash of the file content, read in chunks so large files don't need to fit in memory
+
+    Args:
+        file_path (Path):
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(_HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(file_path: str | Path, memo_dir: str | Path | None = None) -> dict:
+    """ Fingerprint of a source file: size, mtime and content hash.
+        The content hash of a large file is expensive, so if memo_dir is given it is memoized there
+        and only recomputed when the size or mtime of the file change.
+
+    Args:
+        file_path (str | Path):
+        memo_dir (str | Path | None, optional): folder to keep the content hash memo in. Defaults to None (no memo).
+
+    Returns:
+        dict: with keys name, size, mtime_ns, content_hash
+    """
+    file_path = Path(file_path).resolve()
+    stat = file_path.stat()
+    fingerprint = {'name': file_path.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    memo_path = None
+    if memo_dir is not None:
+        memo_path = Path(memo_dir) / _FINGERPRINT_MEMO_NAME
+        with _memo_lock:
+            memo = json.loads(memo_path.read_text()) if memo_path.exists() else {}
+        cached = memo.get(str(file_path))
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return {**fingerprint, 'content_hash': cached['content_hash']}
+
+    fingerprint['content_hash'] = _content_hash(file_path)
+
+    if memo_path is not None:
+        with _memo_lock:
+            # re-read, another thread may have added entries while hashing
+            memo = json.loads(memo_path.read_text()) if memo_path.exists() else {}
+            memo[str(file_path)] = fingerprint
+            memo_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = memo_path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(memo, indent=2))
+            os.replace(tmp_path, memo_path)
+    return fingerprint
+
+
+def hash_key(obj) -> str:
+    """ Stable short hash of a json-serializable object (e.g. a dict of fingerprints and arguments)
+
+    Args:
+        obj: json-serializable, non-serializable leaves (e.g. datetime) are converted with str()
+
+    Returns:
+        str: hex digest
+    """
+    payload = json.dumps(obj, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
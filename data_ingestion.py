@@ -1,5 +1,9 @@
 from pathlib import Path
 import polars as pl
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import Optional
 
@@ -9,59 +13,100 @@ logger.setLevel(logging.INFO)
 
 from datetime import datetime
 
+from caching import file_fingerprint, hash_key
+from instrumentation import span, record, record_drops
 
-def _drop_nulls(df: pl.DataFrame, df_name: str, col_names: Optional[list[str]] = None) -> pl.DataFrame:
-    """ Drop null rows in df with logging
+
+# Explicit dtypes of the csv columns of each source, instead of schema inference:
+# - member_id as UInt32 (half of the inferred Int64), labels as Int8
+# - low cardinality strings as Categorical, so they are stored as UInt32 codes and compared as integers
+# - timestamps and dates parsed by the csv reader (fixed ISO formats) instead of row by row with str.strptime
+SOURCE_SCHEMAS: dict[str, dict[str, pl.DataType]] = {
+    'app_usage': {'member_id': pl.UInt32, 'event_type': pl.Categorical, 'timestamp': pl.Datetime('us')},
+    'churn_labels': {'member_id': pl.UInt32, 'signup_date': pl.Date, 'churn': pl.Int8, 'outreach': pl.Int8},
+    'claims': {'member_id': pl.UInt32, 'icd_code': pl.Categorical, 'diagnosis_date': pl.Date},
+    'web_visits': {'member_id': pl.UInt32, 'url': pl.String, 'title': pl.Categorical, 
+                   'description': pl.String, 'timestamp': pl.Datetime('us')},
+}
+
+
+def _read_csv(file_path: Path,
+              lazy: bool = False,
+              columns: Optional[list[str]] = None,
+              schema: Optional[dict[str, pl.DataType]] = None) -> pl.DataFrame | pl.LazyFrame:
+    """ Read a csv eagerly, or scan it lazily so filters and projections are pushed down into the scan
 
     Args:
-        df (pl.DataFrame): 
-        df_name (str): 
-        col_names (Optional[list[str]], optional): select columns to check for nulls. Defaults to None.
+        file_path (Path): 
+        lazy (bool, optional): return a pl.LazyFrame built on pl.scan_csv. Defaults to False.
+        columns (Optional[list[str]], optional): columns to load. Defaults to None (all columns).
+        schema (Optional[dict[str, pl.DataType]], optional): dtypes of the columns (see SOURCE_SCHEMAS), 
+            columns not in it are inferred. Defaults to None (infer all).
 
     Returns:
-        pl.DataFrame: _description_
+        pl.DataFrame | pl.LazyFrame: 
     """
-    len_df = len(df)
-    df = df.drop_nulls(subset=col_names)
-    len_dropped_df = len(df)
-    if len_df != len_dropped_df:
-        logger.warning(f"Dropped {len_df - len_dropped_df} null rows from {df_name} dataframe")
-    return df
+    schema_overrides = None
+    if schema is not None:
+        # only the loaded columns, and columns the file has (e.g. scoring data has no label columns)
+        loaded = columns if columns is not None else pl.read_csv(file_path, n_rows=0).columns
+        schema_overrides = {name: dtype for name, dtype in schema.items() if name in loaded}
+    if lazy:
+        lf = pl.scan_csv(file_path, schema_overrides=schema_overrides)
+        if columns is not None:
+            lf = lf.select(columns)
+        return lf
+    return pl.read_csv(file_path, columns=columns, schema_overrides=schema_overrides)
 
-    
-def _filter_on_timestamp(df: pl.DataFrame,
-                         df_name: str,
-                         ts_col: str,
-                         min_ts: Optional[datetime] = None,
-                         max_ts: Optional[datetime] = None) -> pl.DataFrame:
-    """ Remove rows with timestamps before min_ts or after max_ts
+
+def _null_filter(col_names: Optional[list[str]] = None) -> list[tuple[str, pl.Expr]]:
+    """ filter (see _apply_filters) keeping rows without nulls in col_names (all columns by default) """
+    cols = pl.col(col_names) if col_names is not None else pl.all()
+    return [('null', pl.all_horizontal(cols.is_not_null()))]
+
+
+def _timestamp_filters(ts_col: str,
+                       min_ts: Optional[datetime] = None,
+                       max_ts: Optional[datetime] = None) -> list[tuple[str, pl.Expr]]:
+    """ filters (see _apply_filters) keeping rows with ts_col in [min_ts, max_ts] """
+    filters = []
+    if min_ts is not None:
+        filters.append(('before_min_ts', pl.col(ts_col) >= min_ts))
+    if max_ts is not None:
+        filters.append(('after_max_ts', pl.col(ts_col) <= max_ts))
+    return filters
+
+
+def _apply_filters(df: pl.DataFrame | pl.LazyFrame,
+                   df_name: str,
+                   filters: list[tuple[str, pl.Expr]]) -> pl.DataFrame | pl.LazyFrame:
+    """ Apply all filters in a single pass, logging and tracing how many rows each one dropped.
+        The predicates are evaluated once into boolean masks, the drop counts are sums over the masks
+        and the frame is filtered on their conjunction, instead of counting rows before and after each filter.
 
     Args:
-        df (pl.DataFrame): 
+        df (pl.DataFrame | pl.LazyFrame): lazy frames are filtered without counting (no logging)
         df_name (str): (for logging purposes)
-        ts_col (str): name of timestamp column
-        min_ts (Optional[datetime], optional): ts to filter on. Defaults to None.
-        max_ts (Optional[datetime], optional): ts to filter on. Defaults to None.
+        filters (list[tuple[str, pl.Expr]]): (reason, predicate of the rows to keep). A row dropped by
+            several filters is counted for the first one.
 
     Returns:
-        pl.DataFrame: _description_
+        pl.DataFrame | pl.LazyFrame: 
     """
-    # filter on min_ts
-    if min_ts is not None:
-        len_df = len(df)
-        df = df.filter(pl.col(ts_col) >= min_ts)
-        len_filtered_df = len(df)
-        if len_df != len_filtered_df:
-            logger.warning(f"Filtered out {len_df - len_filtered_df} rows from {df_name} before min_ts {min_ts}")
-    # filter on max_ts
-    if max_ts is not None:
-        len_df = len(df)
-        df = df.filter(pl.col(ts_col) <= max_ts)
-        len_filtered_df = len(df)
-        if len_df != len_filtered_df:
-            logger.warning(f"Filtered out {len_df - len_filtered_df} rows from {df_name} after max_ts {max_ts}")
+    if not filters:
+        return df
+    if isinstance(df, pl.LazyFrame):
+        return df.filter(pl.all_horizontal([predicate for _, predicate in filters]))
 
-    return df
+    masks = df.select([predicate.fill_null(False).alias(reason) for reason, predicate in filters])
+    reasons = masks.columns
+    drops = masks.select([(~pl.col(reason) & pl.all_horizontal(pl.lit(True), *reasons[:i])).sum().alias(reason)
+                          for i, reason in enumerate(reasons)]).row(0, named=True)
+    for reason, n_dropped in drops.items():
+        if n_dropped:
+            logger.warning(f"Dropped {n_dropped} rows from {df_name} dataframe ({reason})")
+    record_drops(drops)
+    return df.filter(masks.select(pl.all_horizontal(reasons)).to_series())
 
 
 #################################################################################################
@@ -71,18 +116,14 @@ def _filter_on_timestamp(df: pl.DataFrame,
 
 def _ingest_app_usage(file_path: Path,
                        min_ts: Optional[datetime] = None,
-                       max_ts: Optional[datetime] = None) -> pl.DataFrame:
+                       max_ts: Optional[datetime] = None,
+                       lazy: bool = False) -> pl.DataFrame | pl.LazyFrame:
     
-    df = pl.read_csv(file_path, columns=['member_id', 'timestamp']) # event_type is all 'session', don't load it
+    df = _read_csv(file_path, lazy, columns=['member_id', 'timestamp'],  # event_type is all 'session', don't load it
+                   schema=SOURCE_SCHEMAS['app_usage'])
     
-    df = _drop_nulls(df, 'app_usage')  # currently use all columns, the data doesn't contain nulls anyway
-    
-    df = df.with_columns(
-        pl.col("timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S")
-    )
-    
-    # filter timestamp range
-    df = _filter_on_timestamp(df, 'app_usage', 'timestamp', min_ts, max_ts)
+    # drop nulls (all columns, the data doesn't contain nulls anyway) and filter timestamp range in one pass
+    df = _apply_filters(df, 'app_usage', _null_filter() + _timestamp_filters('timestamp', min_ts, max_ts))
     
     df = df.sort(by=['member_id', 'timestamp'])
     
@@ -91,13 +132,14 @@ def _ingest_app_usage(file_path: Path,
 
 def _ingest_churn_labels(file_path: Path, 
                          min_ts: Optional[datetime] = None,
-                         max_ts: Optional[datetime] = None) -> pl.DataFrame:
-    df = pl.read_csv(file_path)
-    df = _drop_nulls(df, 'churn_labels')  
+                         max_ts: Optional[datetime] = None,
+                         lazy: bool = False) -> pl.DataFrame | pl.LazyFrame:
+    df = _read_csv(file_path, lazy, schema=SOURCE_SCHEMAS['churn_labels'])
     
     df = df.with_columns(
-        pl.col("signup_date").str.strptime(pl.Datetime, "%Y-%m-%d")
+        pl.col("signup_date").cast(pl.Datetime('us'))
     )
+    df = _apply_filters(df, 'churn_labels', _null_filter())
     
     # no timestamp filtering for churn_labels as it only has signup_date
     
@@ -106,23 +148,24 @@ def _ingest_churn_labels(file_path: Path,
 
 def _ingest_claims(file_path: Path,
                    min_ts: Optional[datetime] = None,
-                   max_ts: Optional[datetime] = None) -> pl.DataFrame:
-    df = pl.read_csv(file_path)
-    df = _drop_nulls(df, 'claims')  # currently use all columns, the data doesn't contain nulls anyway
+                   max_ts: Optional[datetime] = None,
+                   lazy: bool = False) -> pl.DataFrame | pl.LazyFrame:
+    df = _read_csv(file_path, lazy, schema=SOURCE_SCHEMAS['claims'])
     
     df = df.with_columns(
-        pl.col("diagnosis_date").str.strptime(pl.Datetime, "%Y-%m-%d")
+        pl.col("diagnosis_date").cast(pl.Datetime('us'))
     )
-    # filter timestamp range
-    df = _filter_on_timestamp(df, 'claims', 'diagnosis_date', min_ts, max_ts)
+    # drop nulls (all columns, the data doesn't contain nulls anyway) and filter timestamp range in one pass
+    df = _apply_filters(df, 'claims', _null_filter() + _timestamp_filters('diagnosis_date', min_ts, max_ts))
     
-    df.sort(by=['member_id', 'diagnosis_date'])
+    df = df.sort(by=['member_id', 'diagnosis_date'])
     return df
 
 
 def _ingest_web_visits(file_path: Path,
                        min_ts: Optional[datetime] = None,
-                       max_ts: Optional[datetime] = None) -> pl.DataFrame:
+                       max_ts: Optional[datetime] = None,
+                       lazy: bool = False) -> pl.DataFrame | pl.LazyFrame:
 
     relevant_website_titles = ['Healthy eating guide',
                         'Mediterranean diet',
@@ -145,16 +188,17 @@ def _ingest_web_visits(file_path: Path,
                         ]
     relevant_columns = ['member_id', 'timestamp', 'title']  # don't use url or description for now
     
-    df = pl.read_csv(file_path, columns=relevant_columns)
+    # title is Categorical, so the relevant titles filter compares category codes
+    df = _read_csv(file_path, lazy, columns=relevant_columns, schema=SOURCE_SCHEMAS['web_visits'])
     
-    df = _drop_nulls(df, 'web_visits')  # currently use all columns, the data doesn't contain nulls anyway
-    df = df.filter(pl.col("title").is_in(relevant_website_titles))
+    # drop nulls (all columns, the data doesn't contain nulls anyway), irrelevant titles and
+    # out of range timestamps in one pass
+    df = _apply_filters(df, 'web_visits',
+                        _null_filter()
+                        + [('irrelevant_title', pl.col("title").is_in(relevant_website_titles))]
+                        + _timestamp_filters('timestamp', min_ts, max_ts))
     
-    # convert str to datetime
-    df = df.with_columns(
-        pl.col("timestamp").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S")
-    )
-    df.sort(by=['member_id', 'timestamp'])
+    df = df.sort(by=['member_id', 'timestamp'])
     
     return df
 
@@ -166,9 +210,98 @@ ingest_functions = {
     'web_visits': _ingest_web_visits,
 }
 
+def _ingest_file(file_path: Path,
+                 name: str,
+                 min_ts: Optional[datetime] = None,
+                 max_ts: Optional[datetime] = None,
+                 lazy: bool = False) -> pl.DataFrame | pl.LazyFrame:
+    """ Ingest a single csv with the ingest function registered for its name """
+    if name in ingest_functions:
+        logger.info(f"Ingesting and pre-processing {name} dataframe")
+        return ingest_functions[name](file_path, min_ts, max_ts, lazy)
+    logger.warning(f"No ingest function defined for {name}, ingesting without processing")
+    return _read_csv(file_path, lazy)
+
+
+def _source_name(file_path: Path) -> str:
+    """ remove 'test_' prefix to unify naming convention, e.g. test_app_usage.csv -> app_usage """
+    return file_path.stem.replace('test_', '')
+
+
+#################################################################################################
+# On-disk cache of ingested dataframes (Arrow IPC), keyed by source file fingerprint
+#################################################################################################
+
+# bump when the output of the ingest functions changes, to invalidate existing caches
+_CACHE_VERSION = 2
+
+
+def default_cache_dir(folder_path: str | Path) -> Path:
+    """ Cache folder next to the data folder, e.g. data/.ingest_cache/train for data/train """
+    folder_path = Path(folder_path).resolve()
+    return folder_path.parent / '.ingest_cache' / folder_path.name
+
+
+def _ingest_file_cached(file_path: Path,
+                        name: str,
+                        cache_dir: Path,
+                        min_ts: Optional[datetime] = None,
+                        max_ts: Optional[datetime] = None,
+                        lazy: bool = False,
+                        rebuild_cache: bool = False) -> pl.DataFrame | pl.LazyFrame:
+    """ Ingest a single csv through the IPC cache: on a hit the cached (typed, filtered, sorted) table
+        is memory-mapped instead of re-parsing the csv, on a miss it is ingested and written to the cache.
+
+    Args:
+        file_path (Path): 
+        name (str): source name (e.g. 'app_usage')
+        cache_dir (Path): 
+        min_ts (Optional[datetime], optional): part of the cache key. Defaults to None.
+        max_ts (Optional[datetime], optional): part of the cache key. Defaults to None.
+        lazy (bool, optional): return a pl.LazyFrame scanning the cache file. Defaults to False.
+        rebuild_cache (bool, optional): ignore an existing cache entry and re-ingest. Defaults to False.
+
+    Returns:
+        pl.DataFrame | pl.LazyFrame: 
+    """
+    key = hash_key({'version': _CACHE_VERSION,
+                    'name': name,
+                    'source': file_fingerprint(file_path, memo_dir=cache_dir),
+                    'min_ts': min_ts,
+                    'max_ts': max_ts})
+    cache_path = cache_dir / f"{name}-{key}.arrow"
+
+    if cache_path.exists() and not rebuild_cache:
+        logger.info(f"Loading {name} dataframe from cache {cache_path}")
+    else:
+        df = _ingest_file(file_path, name, min_ts, max_ts, lazy)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.tmp')
+        if isinstance(df, pl.LazyFrame):
+            df.sink_ipc(tmp_path)
+        else:
+            df.write_ipc(tmp_path)
+        os.replace(tmp_path, cache_path)
+        # remove stale entries of the same source
+        for stale_path in cache_dir.glob(f"{name}-*.arrow"):
+            if stale_path != cache_path:
+                stale_path.unlink()
+        logger.info(f"Cached {name} dataframe to {cache_path}")
+
+    # polars memory-maps (uncompressed) IPC files by default
+    if lazy:
+        return pl.scan_ipc(cache_path)
+    return pl.read_ipc(cache_path)
+
+
 def ingest_and_pre_process_data(folder_path: str | Path, 
                                 min_ts: Optional[datetime] = None,
-                                max_ts: Optional[datetime] = None) -> dict[str, pl.DataFrame]:
+                                max_ts: Optional[datetime] = None,
+                                lazy: bool = False,
+                                use_cache: bool = False,
+                                rebuild_cache: bool = False,
+                                cache_dir: Optional[str | Path] = None,
+                                n_workers: int = 1) -> dict[str, pl.DataFrame | pl.LazyFrame]:
     """ Pre-process each df with function based on the csv name.
         Turn str columns to datetime, drop nulls, sort by member_id and timestamp/diagnosis_date
         Select in date range
@@ -177,25 +310,53 @@ def ingest_and_pre_process_data(folder_path: str | Path,
         folder_path: path with all csv files
         min_ts (Optional[datetime], optional): minimum ts to filter on. Defaults to None.
         max_ts (Optional[datetime], optional): maximum ts to filter on. Defaults to None
+        lazy (bool, optional): return pl.LazyFrame-s built on pl.scan_csv, so the null drop, filters
+            and sort run as a single plan when collected (e.g. by featurize_data). Defaults to False.
+        use_cache (bool, optional): cache the pre-processed dataframes as Arrow IPC files, keyed by the
+            csv size, mtime and content hash and by min_ts/max_ts, and memory-map them on later runs. Defaults to False.
+        rebuild_cache (bool, optional): with use_cache, re-ingest and overwrite existing cache entries. Defaults to False.
+        cache_dir (Optional[str | Path], optional): with use_cache, folder of the cache. 
+            Defaults to None (see default_cache_dir).
+        n_workers (int, optional): number of csv files ingested concurrently (in threads, polars releases the GIL),
+            so small files don't wait behind large ones. Defaults to 1 (sequential).
 
     Returns:
-        dict[str, pl.DataFrame]: preprocessed dict of dataframes, keyed by csv name (e.g. 'app_usage')
+        dict[str, pl.DataFrame | pl.LazyFrame]: preprocessed dict of dataframes, keyed by csv name (e.g. 'app_usage')
     """
     
     folder_path = Path(folder_path)
-    dfs = dict()
+    if use_cache:
+        cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir(folder_path)
     
     logger.info(f"Ingesting and pre-processing dataframes from folder: {folder_path}")
     
-    for file_path in folder_path.glob('*.csv'):
-        file_stem = file_path.stem.replace('test_', '')  # remove 'test_' prefix to unify naming convention
-        name = file_stem  # use file_stem as the name key
-        
-        if name in ingest_functions:
-            logger.info(f"Ingesting and pre-processing {name} dataframe")
-            dfs[name] = ingest_functions[name](file_path, min_ts, max_ts)
-        else:
-            logger.warning(f"No ingest function defined for {name}, ingesting without processing")
-            dfs[name] = pl.read_csv(file_path)
+    def ingest(file_path: Path) -> tuple[pl.DataFrame | pl.LazyFrame, float]:
+        name = _source_name(file_path)
+        start = time.perf_counter()
+        with span(f'ingest.{name}', source=name, lazy=lazy, cached=use_cache) as ingest_span:
+            if use_cache:
+                df = _ingest_file_cached(file_path, name, cache_dir, min_ts, max_ts, lazy, rebuild_cache)
+            else:
+                df = _ingest_file(file_path, name, min_ts, max_ts, lazy)
+            if isinstance(df, pl.DataFrame):
+                # rows_in from the drop counts of the filters, without counting the rows read separately
+                record(rows_out=len(df), rows_in=len(df) + sum(ingest_span.drops.values()))
+        return df, time.perf_counter() - start
+    
+    # largest files first, so they start right away and the small ones fill in the other workers
+    file_paths = sorted(folder_path.glob('*.csv'), key=lambda p: p.stat().st_size, reverse=True)
+    start = time.perf_counter()
+    with span('ingest', folder=str(folder_path), n_workers=n_workers), \
+            ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        # each file in a copy of the current context, so its span is a child of the 'ingest' span
+        jobs = [executor.submit(contextvars.copy_context().run, ingest, file_path) for file_path in file_paths]
+        results = dict(zip(file_paths, [job.result() for job in jobs]))
+    
+    dfs = dict()
+    for file_path, (df, elapsed) in results.items():
+        name = _source_name(file_path)
+        dfs[name] = df
+        logger.info(f"Ingested {name} in {elapsed:.2f}s")
+    logger.info(f"Ingested {len(dfs)} dataframes in {time.perf_counter() - start:.2f}s with {n_workers} worker(s)")
                 
-    return dfs
\ No newline at end of file
+    return dfs
@@ -0,0 +1,175 @@
+from pathlib import Path
+from datetime import datetime
+from typing import Optional
+import json
+import os
+import polars as pl
+
+from caching import file_fingerprint, hash_key
+from data_ingestion import ingest_functions
+from featurization import (FEATURE_FAMILIES, FeatureFamily, extract_family_state, merge_family_states,
+                           family_features_from_state, join_family_features)
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Layout of a feature store folder:
+#   manifest.json                     keys of the event batches already applied, per source, and under '_bases'
+#                                     the current base file of each family with the batch keys merged into it
+#   <prefix>/base-<key>.parquet       merged per member state of the family (written by compact_feature_store)
+#   <prefix>/delta-<batch key>.parquet  per member state of a single event batch
+# A family's state is its current base plus the deltas of the manifest's batches not merged into it. Files are
+# written under a temporary name and moved into place before the manifest records them, and compaction switches
+# to a new base in the manifest, so a crash at any point leaves either the old or the new state, never both.
+_MANIFEST_NAME = 'manifest.json'
+_BASES_KEY = '_bases'
+
+
+def _read_manifest(store_dir: Path) -> dict:
+    manifest_path = store_dir / _MANIFEST_NAME
+    return json.loads(manifest_path.read_text()) if manifest_path.exists() else dict()
+
+
+def _write_manifest(store_dir: Path, manifest: dict):
+    manifest_path = store_dir / _MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, manifest_path)
+
+
+def _source_families(source: str) -> list[FeatureFamily]:
+    return [family for family in FEATURE_FAMILIES.values() if family.source == source]
+
+
+def update_feature_store(store_dir: str | Path,
+                         source: str,
+                         batch_path: str | Path,
+                         min_ts: Optional[datetime] = None,
+                         max_ts: Optional[datetime] = None) -> bool:
+    """ Add a batch of new events to the per member aggregate state of the source's feature families.
+        The batch is cleaned with the source's ingest function and aggregated on its own, so the update
+        costs time proportional to the batch size. A batch that was already applied is skipped.
+
+    Args:
+        store_dir (str | Path): feature store folder
+        source (str): source name (e.g. 'app_usage')
+        batch_path (str | Path): csv of new events, same format as the source csv
+        min_ts (Optional[datetime], optional): minimum ts to filter on. Defaults to None.
+        max_ts (Optional[datetime], optional): maximum ts to filter on. Defaults to None.
+
+    Returns:
+        bool: whether the batch was applied (False if it was applied before)
+    """
+    store_dir = Path(store_dir)
+    families = _source_families(source)
+    if not families:
+        raise ValueError(f"No feature families are defined for source {source}")
+
+    batch_key = hash_key({'content_hash': file_fingerprint(batch_path)['content_hash'],
+                          'min_ts': min_ts,
+                          'max_ts': max_ts})
+    manifest = _read_manifest(store_dir)
+    if batch_key in manifest.get(source, []):
+        logger.warning(f"Batch {batch_path} was already applied to the {source} feature store, skipping")
+        return False
+
+    events = ingest_functions[source](Path(batch_path), min_ts, max_ts)
+    logger.info(f"Updating {source} feature store with {len(events)} events from {batch_path}")
+    for family in families:
+        family_dir = store_dir / family.prefix
+        family_dir.mkdir(parents=True, exist_ok=True)
+        delta_path = family_dir / f"delta-{batch_key}.parquet"
+        tmp_path = delta_path.with_suffix('.tmp')
+        extract_family_state(events.lazy(), family).collect().write_parquet(tmp_path)
+        os.replace(tmp_path, delta_path)
+
+    manifest.setdefault(source, []).append(batch_key)
+    _write_manifest(store_dir, manifest)
+    return True
+
+
+def _delta_key(delta_path: Path) -> str:
+    return delta_path.stem.removeprefix('delta-')
+
+
+def _family_base(manifest: dict, family: FeatureFamily) -> dict:
+    """ the manifest entry of the family's base: its file (None before the first compaction) and merged batch keys """
+    return manifest.get(_BASES_KEY, dict()).get(family.prefix, {'file': None, 'deltas': []})
+
+
+def _family_state_files(store_dir: Path, family: FeatureFamily, manifest: dict) -> list[Path]:
+    """ the family's current base (if any) and the deltas of the manifest's batches that are not merged into it.
+        Deltas of batches the manifest doesn't record (an update that crashed before its manifest write) are 
+        ignored, the batch is applied again by the next update with it.
+    """
+    family_dir = store_dir / family.prefix
+    base = _family_base(manifest, family)
+    compacted = set(base['deltas'])
+    deltas = [family_dir / f'delta-{key}.parquet' for key in manifest.get(family.source, []) if key not in compacted]
+    # a family added after some of its source's batches were applied has no deltas of them
+    deltas = [path for path in deltas if path.exists()]
+    return ([family_dir / base['file']] if base['file'] is not None else []) + deltas
+
+
+def load_family_state(store_dir: str | Path, family: FeatureFamily) -> Optional[pl.LazyFrame]:
+    """ merged per member state of a family (base and its deltas), None if the store has no events for it """
+    state_files = _family_state_files(Path(store_dir), family, _read_manifest(Path(store_dir)))
+    if not state_files:
+        return None
+    return merge_family_states(pl.scan_parquet(state_files), family)
+
+
+def compact_feature_store(store_dir: str | Path):
+    """ Merge the deltas of every family into a new base state, so reads stay fast as batches accumulate.
+        The new base and the deltas merged into it are recorded in the manifest in one atomic write, before
+        the old files are removed, so a crash never counts a delta twice.
+    """
+    store_dir = Path(store_dir)
+    for family in FEATURE_FAMILIES.values():
+        manifest = _read_manifest(store_dir)
+        state_files = _family_state_files(store_dir, family, manifest)
+        if len(state_files) <= 1:
+            continue
+        family_dir = store_dir / family.prefix
+        compacted = _family_base(manifest, family)['deltas'] + [_delta_key(path) for path in state_files if path.name.startswith('delta-')]
+        base_path = family_dir / f"base-{hash_key({'deltas': compacted})}.parquet"
+        tmp_path = base_path.with_suffix('.tmp')
+        merge_family_states(pl.scan_parquet(state_files), family).sink_parquet(tmp_path)
+        os.replace(tmp_path, base_path)
+        manifest.setdefault(_BASES_KEY, dict())[family.prefix] = {'file': base_path.name, 'deltas': compacted}
+        _write_manifest(store_dir, manifest)
+
+        # the merged deltas and older bases (also those left by an interrupted compaction) are no longer read
+        compacted_keys = set(compacted)
+        for state_file in family_dir.glob('*.parquet'):
+            if ((state_file.name.startswith('base') and state_file != base_path)
+                    or (state_file.name.startswith('delta-') and _delta_key(state_file) in compacted_keys)):
+                state_file.unlink(missing_ok=True)
+        logger.info(f"Compacted {len(state_files)} state files of feature family {family.prefix}")
+
+
+def features_from_store(store_dir: str | Path,
+                        churn_labels: pl.DataFrame | pl.LazyFrame,
+                        obs_window_end: datetime = datetime(2025, 7, 16),
+                        fill_nulls: bool = True) -> pl.DataFrame:
+    """ Feature matrix from the stored per member state, same columns as featurization.featurize_data.
+        The *_dt features are derived from the state at read time, so any obs_window_end can be used.
+        Windowed features (featurize_data horizons/gap_stats) are not mergeable and are not stored.
+
+    Args:
+        store_dir (str | Path): feature store folder
+        churn_labels (pl.DataFrame | pl.LazyFrame): ingested churn_labels (members and signup dates)
+        obs_window_end (datetime, optional): start of day after end of observation window. Defaults to datetime(2025, 7, 16).
+        fill_nulls (bool, optional): whether to fill nulls in the final feature set. Defaults to True.
+
+    Returns:
+        pl.DataFrame:
+    """
+    family_features = []
+    for family in FEATURE_FAMILIES.values():
+        state = load_family_state(store_dir, family)
+        features = family_features_from_state(state, family, obs_window_end) if state is not None else None
+        family_features.append((family.columns(), features))
+
+    return join_family_features(churn_labels, family_features, obs_window_end, fill_nulls).collect()
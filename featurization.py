@@ -1,11 +1,18 @@
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Callable, Optional, Sequence
 import polars as pl
 import logging
+
+from instrumentation import span, record, tracer
+
 # obs_window_end = datetime(2025, 7, 16)  # start of day after end of observation window
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# dense per ICD code features (a column per code), not used. See sparse_features.py for per code (and per title)
+# features as a sparse matrix (--sparse-features)
 def _extract_claims_features(claims_df: pl.DataFrame, obs_window_end: datetime) -> pl.DataFrame:
     
     # group claims by member_id and icd_code to get first and last diagnosis dates and number of diagnoses
@@ -29,142 +36,272 @@ def _extract_claims_features(claims_df: pl.DataFrame, obs_window_end: datetime)
     return claims_per_id
 
 
-def _extract_claims_features_no_single(claims_df: pl.DataFrame, obs_window_end: datetime) -> pl.DataFrame:
-    
-    # group claims by member_id and icd_code to get first and last diagnosis dates and number of diagnoses
-    claims_per_id = claims_df.group_by(
-    ['member_id']).agg(
-        pl.min('diagnosis_date').alias('first_dx_date'),
-        pl.max('diagnosis_date').alias('last_dx_date'),
-        pl.count('diagnosis_date').alias('dx_count')
-    )
+#################################################################################################
+# Feature family registry
+#################################################################################################
 
-    # diff from obs_window_end, in days
-    claims_per_id = claims_per_id.with_columns(
-        (obs_window_end - pl.col("first_dx_date")).dt.total_days().alias("first_dx_dt"),
-        (obs_window_end - pl.col("last_dx_date")).dt.total_days().alias("last_dx_dt"),
-    )
 
-    claims_per_id = claims_per_id[['member_id', 'dx_count', 'first_dx_dt', 'last_dx_dt']]
-    
-    return claims_per_id
+@dataclass(frozen=True)
+class Aggregation:
+    """ A per-member aggregation of an event timestamp column.
+        It is split into a mergeable state (e.g. min timestamp) and a feature derived from the state
+        (e.g. days from obs_window_end), so states of event batches can be merged exactly (see feature_store).
 
+    Args:
+        column (str): feature column name, formatted with the family prefix (e.g. 'first_{prefix}_dt')
+        state (Callable[[str], pl.Expr]): ts_col -> per member state aggregation expression
+        merge (Callable[[str], pl.Expr]): state column -> aggregation expression merging states
+        feature (Callable[[pl.Expr, datetime], pl.Expr]): (state, obs_window_end) -> feature expression
+        fill_value (float): value for members without events in the source
+    """
+    column: str
+    state: Callable[[str], pl.Expr]
+    merge: Callable[[str], pl.Expr]
+    feature: Callable[[pl.Expr, datetime], pl.Expr]
+    fill_value: float
 
 
-def _extract_web_visits_features(app_usage_df: pl.DataFrame, obs_window_end: datetime) -> pl.DataFrame:
-    # group only by member id to get first and last web_visit dates and number of web_visits, this treats all website visits the same
-    
-    # TODO: move filtering by title column to here from ingestion?
-    web_visits_per_id = app_usage_df.group_by(
-        ['member_id']).agg(
-            pl.min('timestamp').alias('first_wv_date'),
-            pl.max('timestamp').alias('last_wv_date'),
-            pl.count('timestamp').alias('wv_count')
-    )
+# counts filled with 0, non-existant dates filled with large number (days from obs_window_end).
+# Features are narrowed to UInt32/Int32 (Float32 for gaps), fill values are ints so the fill keeps the dtype.
+AGGREGATIONS: dict[str, Aggregation] = {
+    'count': Aggregation('{prefix}_count',
+                         state=lambda ts_col: pl.col(ts_col).count(),
+                         merge=lambda state_col: pl.col(state_col).sum().cast(pl.UInt32),
+                         feature=lambda state, obs_window_end: state,
+                         fill_value=0),
+    'first': Aggregation('first_{prefix}_dt',
+                         state=lambda ts_col: pl.col(ts_col).min(),
+                         merge=lambda state_col: pl.col(state_col).min(),
+                         feature=lambda state, obs_window_end: (obs_window_end - state).dt.total_days().cast(pl.Int32),
+                         fill_value=100_000),
+    'last': Aggregation('last_{prefix}_dt',
+                        state=lambda ts_col: pl.col(ts_col).max(),
+                        merge=lambda state_col: pl.col(state_col).max(),
+                        feature=lambda state, obs_window_end: (obs_window_end - state).dt.total_days().cast(pl.Int32),
+                        fill_value=100_000),
+}
 
-    # diff from obs_window_end, in days
-    web_visits_per_id = web_visits_per_id.with_columns(
-        (obs_window_end - pl.col("first_wv_date")).dt.total_days().alias("first_wv_dt"),
-        (obs_window_end - pl.col("last_wv_date")).dt.total_days().alias("last_wv_dt"),
-    )
 
-    web_visits_per_id = web_visits_per_id[['member_id', 'wv_count', 'first_wv_dt', 'last_wv_dt']]
-    
-    return web_visits_per_id
+@dataclass(frozen=True)
+class FeatureFamily:
+    """ Declaration of a family of per-member features aggregated from one event source
 
+    Args:
+        source (str): name of the ingested dataframe (e.g. 'claims')
+        ts_col (str): timestamp column of the source
+        prefix (str): feature name prefix (e.g. 'dx' -> dx_count, first_dx_dt, last_dx_dt)
+        aggregations (tuple[str, ...]): keys of AGGREGATIONS. Defaults to first/last/count.
+        fill_values (dict[str, float]): per aggregation override of the fill value. Defaults to none.
+    """
+    source: str
+    ts_col: str
+    prefix: str
+    aggregations: tuple[str, ...] = ('count', 'first', 'last')
+    fill_values: dict[str, float] = field(default_factory=dict)
 
-def _extract_app_usage_features(app_usage_df: pl.DataFrame, obs_window_end: datetime) -> pl.DataFrame:
-    app_usage_per_id = app_usage_df.group_by(
-    ['member_id']).agg(
-        pl.min('timestamp').alias('first_au_date'),
-        pl.max('timestamp').alias('last_au_date'),
-        pl.count('timestamp').alias('au_count')
-    )
+    def columns(self) -> dict[str, float]:
+        """ feature column names of the family and their fill values """
+        return {AGGREGATIONS[agg].column.format(prefix=self.prefix): self.fill_values.get(agg, AGGREGATIONS[agg].fill_value)
+                for agg in self.aggregations}
+
+
+# registered feature families, keyed by prefix, in the order they are joined to the feature matrix
+FEATURE_FAMILIES: dict[str, FeatureFamily] = {}
+
+
+def register_feature_family(family: FeatureFamily) -> FeatureFamily:
+    """ Add a feature family to the registry, featurize_data then computes it in the same plan as all others """
+    if family.prefix in FEATURE_FAMILIES:
+        raise ValueError(f"Feature family with prefix '{family.prefix}' is already registered")
+    FEATURE_FAMILIES[family.prefix] = family
+    return family
+
+
+# Feature set 1: claims features, all claims codes aggregated together (see _extract_claims_features for per code)
+register_feature_family(FeatureFamily(source='claims', ts_col='diagnosis_date', prefix='dx'))
+# Feature set 2: web_visits features, treats all (relevant) website visits the same
+register_feature_family(FeatureFamily(source='web_visits', ts_col='timestamp', prefix='wv'))
+# Feature set 3: app_usage features
+register_feature_family(FeatureFamily(source='app_usage', ts_col='timestamp', prefix='au'))
+
+
+def _window_columns(family: FeatureFamily, horizons: Sequence[int] = (), gap_stats: bool = False) -> dict[str, float]:
+    """ names and fill values of the family's windowed features """
+    columns = dict()
+    for horizon in horizons:
+        columns[f'{family.prefix}_count_{horizon}d'] = 0
+        columns[f'{family.prefix}_active_days_{horizon}d'] = 0
+    if gap_stats:
+        columns[f'{family.prefix}_gap_mean_d'] = 1e5
+        columns[f'{family.prefix}_gap_max_d'] = 1e5
+    return columns
+
+
+def _window_exprs(family: FeatureFamily,
+                  obs_window_end: datetime,
+                  horizons: Sequence[int] = (),
+                  gap_stats: bool = False) -> list[pl.Expr]:
+    """ Aggregation expressions of the windowed features, evaluated in the same group_by as the lifetime features.
+        Each horizon is only a compare-and-sum over the per event days-before-obs_window_end, which (like the
+        per member unique days) polars computes once for all horizons, so more horizons add little cost.
+    """
+    days_before = (obs_window_end - pl.col(family.ts_col)).dt.total_days()
+    active_days = days_before.unique()
+    exprs = []
+    for horizon in horizons:
+        exprs.append(((days_before >= 0) & (days_before < horizon)).sum().alias(f'{family.prefix}_count_{horizon}d'))
+        exprs.append(((active_days >= 0) & (active_days < horizon)).sum().alias(f'{family.prefix}_active_days_{horizon}d'))
+    if gap_stats:
+        # events are sorted by member_id, ts at ingestion, so they are in time order within each group
+        gaps = pl.col(family.ts_col).diff().dt.total_seconds() / 86400
+        exprs.append(gaps.mean().cast(pl.Float32).alias(f'{family.prefix}_gap_mean_d'))
+        exprs.append(gaps.max().cast(pl.Float32).alias(f'{family.prefix}_gap_max_d'))
+    return exprs
+
+
+def _extract_family_features(events: pl.LazyFrame,
+                             family: FeatureFamily,
+                             obs_window_end: datetime,
+                             horizons: Sequence[int] = (),
+                             gap_stats: bool = False) -> pl.LazyFrame:
+    """ group events by member_id and aggregate them into the family's features, in one group_by """
+    return events.group_by('member_id').agg([
+        AGGREGATIONS[agg].feature(AGGREGATIONS[agg].state(family.ts_col), obs_window_end).alias(column)
+        for agg, column in zip(family.aggregations, family.columns())
+    ] + _window_exprs(family, obs_window_end, horizons, gap_stats))
+
+
+def extract_family_state(events: pl.LazyFrame, family: FeatureFamily) -> pl.LazyFrame:
+    """ per member mergeable state of the family's aggregations, one column per aggregation (e.g. 'first') """
+    return events.group_by('member_id').agg([
+        AGGREGATIONS[agg].state(family.ts_col).alias(agg) for agg in family.aggregations
+    ])
+
+
+def merge_family_states(states: pl.LazyFrame, family: FeatureFamily) -> pl.LazyFrame:
+    """ merge (concatenated) per member states, e.g. of several event batches, into one row per member """
+    return states.group_by('member_id').agg([
+        AGGREGATIONS[agg].merge(agg).alias(agg) for agg in family.aggregations
+    ])
+
+
+def family_features_from_state(state: pl.LazyFrame, family: FeatureFamily, obs_window_end: datetime) -> pl.LazyFrame:
+    """ derive the family's features (e.g. *_dt columns) from its merged per member state, for any obs_window_end """
+    return state.select(['member_id'] + [
+        AGGREGATIONS[agg].feature(pl.col(agg), obs_window_end).alias(column)
+        for agg, column in zip(family.aggregations, family.columns())
+    ])
 
-    # diff from obs_window_end, in days
-    app_usage_per_id = app_usage_per_id.with_columns(
-        (obs_window_end - pl.col("first_au_date")).dt.total_days().alias("first_au_dt"),
-        (obs_window_end - pl.col("last_au_date")).dt.total_days().alias("last_au_dt"),
-    )
 
-    app_usage_per_id = app_usage_per_id[['member_id', 'au_count', 'first_au_dt', 'last_au_dt']]
+def _churn_labels_plan(churn_labels: pl.DataFrame | pl.LazyFrame, obs_window_end: datetime) -> pl.LazyFrame:
+    return churn_labels.lazy().with_columns(
+        (obs_window_end - pl.col("signup_date")).dt.total_days().cast(pl.Int32).alias("signup_date_dt")
+    ).drop('signup_date')
+
+
+def join_family_features(churn_labels: pl.DataFrame | pl.LazyFrame,
+                         family_features: list[tuple[dict[str, float], Optional[pl.LazyFrame]]],
+                         obs_window_end: datetime,
+                         fill_nulls: bool = True) -> pl.LazyFrame:
+    """ Join per family feature frames onto churn_labels and fill nulls in a single pass
+
+    Args:
+        churn_labels (pl.DataFrame | pl.LazyFrame): 
+        family_features (list[tuple[dict[str, float], Optional[pl.LazyFrame]]]): feature columns of a family 
+            with their fill values, and its features, in join order. None for a family without any events.
+        obs_window_end (datetime): start of day after end of observation window
+        fill_nulls (bool, optional): fill features of members without events. Defaults to True.
+
+    Returns:
+        pl.LazyFrame: 
+    """
+    plan = _churn_labels_plan(churn_labels, obs_window_end)
     
-    return app_usage_per_id
+    fill_values = dict()
+    for columns, features in family_features:
+        if features is None:
+            plan = plan.with_columns([pl.lit(None).alias(column) for column in columns])
+        else:
+            plan = plan.join(features, on='member_id', how='left')
+        fill_values.update(columns)
+    
+    if fill_nulls:
+        plan = plan.with_columns([pl.col(column).fill_null(value) for column, value in fill_values.items()])
     
+    return plan
 
-def featurize_data(dfs: dict[str, pl.DataFrame], 
+
+def compile_feature_plan(dfs: dict[str, pl.DataFrame | pl.LazyFrame],
+                         obs_window_end: datetime,
+                         fill_nulls: bool = True,
+                         families: Optional[list[FeatureFamily]] = None,
+                         horizons: Sequence[int] = (),
+                         gap_stats: bool = False) -> pl.LazyFrame:
+    """ Compile the feature families into a single lazy plan: one group_by per source, joined onto
+        churn_labels and null-filled in a single pass, so polars can optimize and parallelize it as a whole.
+
+    Args:
+        dfs (dict[str, pl.DataFrame | pl.LazyFrame]): ingested dataframes
+        obs_window_end (datetime): start of day after end of observation window
+        fill_nulls (bool, optional): fill features of members without events. Defaults to True.
+        families (Optional[list[FeatureFamily]], optional): Defaults to None (all registered families).
+        horizons (Sequence[int], optional): days before obs_window_end for the windowed event count and 
+            active days features. Defaults to () (no windowed features).
+        gap_stats (bool, optional): add mean and max days between consecutive events. Defaults to False.
+
+    Returns:
+        pl.LazyFrame: 
+    """
+    if families is None:
+        families = list(FEATURE_FAMILIES.values())
+    
+    family_features = [({**family.columns(), **_window_columns(family, horizons, gap_stats)},
+                        _extract_family_features(dfs[family.source].lazy(), family, obs_window_end, horizons, gap_stats))
+                       for family in families]
+    return join_family_features(dfs['churn_labels'], family_features, obs_window_end, fill_nulls)
+
+
+def featurize_data(dfs: dict[str, pl.DataFrame | pl.LazyFrame], 
                    obs_window_end: datetime = datetime(2025, 7, 16), 
-                   fill_nulls: bool = True) -> pl.DataFrame:
+                   fill_nulls: bool = True,
+                   horizons: Sequence[int] = (),
+                   gap_stats: bool = False) -> pl.DataFrame:
     """ Takes all loaded df-s and outputs a single df with all engineered features. 
+        Features are declared in FEATURE_FAMILIES and computed as one fused plan (see compile_feature_plan).
 
     Args:
-        dfs (dict[str, pl.DataFrame]): _description_
+        dfs (dict[str, pl.DataFrame | pl.LazyFrame]): if any of the df-s is lazy, only the final
+            per-member feature table is collected, with the streaming engine.
         obs_window_end (datetime, optional): start of day after end of observation window. Defaults to datetime(2025, 7, 16).
         fill_nulls (bool, optional): whether to fill nulls in the final feature set. Defaults to True.
+        horizons (Sequence[int], optional): windowed features horizons in days, e.g. (7, 30, 90). Defaults to ().
+        gap_stats (bool, optional): add inter-event gap features. Defaults to False.
 
     Returns:
         pl.DataFrame: _description_
     """
     logger.info("Starting featurization...")   
-    features_w_labels = dfs['churn_labels'].clone()
+    lazy = any(isinstance(df, pl.LazyFrame) for df in dfs.values())
     
-
-    features_w_labels = features_w_labels.with_columns(
-        (obs_window_end - pl.col("signup_date")).dt.total_days().alias("signup_date_dt")
-    )
-    features_w_labels = features_w_labels.drop('signup_date')
-    
-    # Feature set 1: claims features 
-    # ------------------------------
-    # claims_per_id = _extract_claims_features(dfs['claims'],
-    #                                          obs_window_end)
-    logger.info("Extracting claims features...")
-    claims_per_id = _extract_claims_features_no_single(dfs['claims'],
-                                                       obs_window_end)
-    
-    # merge to features matrix
-    features_w_labels = features_w_labels.join(claims_per_id, on='member_id', how='left')
-    # fill nulls: counts filled with 0, non-existant dates filled with large number (days from obs_window_end)
-    # features_w_labels = features_w_labels.with_columns(
-    #     pl.col(r"^dx_count_.*$").fill_null(0),
-    #     pl.col(r"^first_dx_dt.*$").fill_null(1e5),
-    #     pl.col(r"^last_dx_dt.*$").fill_null(1e5),
-    # )
-    if fill_nulls:
-        features_w_labels = features_w_labels.with_columns(
-            pl.col("dx_count").fill_null(0),
-            pl.col("first_dx_dt").fill_null(1e5),
-            pl.col("last_dx_dt").fill_null(1e5),
-        )
-    
-    # Feature set 2: web_visits features
-    # ---------------------------------
-    logger.info("Extracting web_visits features...")
-    web_visits_per_id = _extract_web_visits_features(dfs['web_visits'],
-                                                     obs_window_end)
-    # merge to features matrix
-    features_w_labels = features_w_labels.join(web_visits_per_id, on='member_id', how='left')
-    # fill nulls: counts filled with 0, non-existant dates filled with large number (days from obs_window_end)
-    if fill_nulls:
-        features_w_labels = features_w_labels.with_columns(
-            pl.col("wv_count").fill_null(0),
-            pl.col("first_wv_dt").fill_null(1e5),
-            pl.col("last_wv_dt").fill_null(1e5),
-        )
-    
-    # Feature set 3: app_usage features
-    # ---------------------------------
-    logger.info("Extracting app_usage features...")
-    app_usage_per_id = _extract_app_usage_features(dfs['app_usage'],
-                                                   obs_window_end)
-    # merge to features matrix
-    features_w_labels = features_w_labels.join(app_usage_per_id, on='member_id', how='left')
-    # fill nulls: counts filled with 0, non-existant dates filled with large number (days from obs_window_end)
-    if fill_nulls:
-        features_w_labels = features_w_labels.with_columns(
-            pl.col("au_count").fill_null(0),
-            pl.col("first_au_dt").fill_null(1e5),
-            pl.col("last_au_dt").fill_null(1e5),
-        )
+    plan = compile_feature_plan(dfs, obs_window_end, fill_nulls, horizons=horizons, gap_stats=gap_stats)
     
-    return features_w_labels
\ No newline at end of file
+    # the families run as one fused plan, so they are traced as attributes of the featurize span (and,
+    # for in-memory inputs, as the timings of the plan's nodes) rather than as separately timed spans
+    families = {family.prefix: {'source': family.source,
+                                'rows_in': None if lazy else len(dfs[family.source]),
+                                'n_features': len(family.columns()) + len(_window_columns(family, horizons, gap_stats))}
+                for family in FEATURE_FAMILIES.values()}
+    with span('featurize', lazy=lazy, families=families):
+        logger.info(f"Extracting features {list(FEATURE_FAMILIES)}...")
+        if lazy:
+            logger.info("Collecting lazy feature plan with the streaming engine...")
+            features = plan.collect(engine='streaming')
+        elif tracer.enabled:
+            start_s = tracer.elapsed_s()
+            features, timings = plan.profile()
+            for node, start_us, end_us in timings.iter_rows():
+                tracer.add_span(f'featurize.{node}', start_s + start_us / 1e6, (end_us - start_us) / 1e6)
+        else:
+            features = plan.collect()
+        record(rows_out=len(features))
+    return features
@@ -0,0 +1,206 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+import contextvars
+import json
+import os
+import platform
+import resource
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Per-stage tracing of the pipeline. Code marks its stages with `with span('name', rows_in=...)` and adds
+# to the current span with record() / record_drops(). Spans are only kept while the tracer is enabled
+# (main.py --trace-file), and are exported as JSON or as a Chrome trace (chrome://tracing, Perfetto).
+
+
+def current_rss_bytes() -> int:
+    """ resident set size of this process, from /proc on linux, else the peak so far (getrusage) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+
+class PeakRSS:
+    """ context manager sampling the RSS in a background thread, for the peak memory of a block """
+    def __init__(self, interval_s: float = 0.01):
+        self.interval_s = interval_s
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval_s):
+            self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+
+    def __enter__(self):
+        self.start_bytes = self.peak_bytes = current_rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+
+
+@dataclass
+class Span:
+    name: str
+    start_s: float = 0.0
+    duration_s: float = 0.0
+    thread_id: int = 0
+    parent: Optional[str] = None
+    rss_start_bytes: int = 0
+    rss_peak_bytes: int = 0
+    attrs: dict = field(default_factory=dict)
+    drops: dict = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'parent': self.parent,
+            'start_s': self.start_s,
+            'duration_s': self.duration_s,
+            'thread_id': self.thread_id,
+            'peak_rss_mb': self.rss_peak_bytes / 2**20,
+            'peak_rss_delta_mb': (self.rss_peak_bytes - self.rss_start_bytes) / 2**20,
+            'drops': self.drops,
+            **self.attrs,
+        }
+
+
+class Tracer:
+    """ Collects spans from all threads. While spans are open, a background thread samples the RSS
+        and raises the peak of every open span.
+    """
+    def __init__(self, sample_interval_s: float = 0.01):
+        self.enabled = False
+        self.spans: list[Span] = []
+        self.sample_interval_s = sample_interval_s
+        self._open: dict[int, Span] = dict()
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self._current = contextvars.ContextVar('current_span', default=None)
+        self._origin_s = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self._origin_s = time.perf_counter()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.sample_interval_s)
+            rss = current_rss_bytes()
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                for open_span in self._open.values():
+                    open_span.rss_peak_bytes = max(open_span.rss_peak_bytes, rss)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            yield Span(name)
+            return
+        parent = self._current.get()
+        rss = current_rss_bytes()
+        new_span = Span(name,
+                        start_s=time.perf_counter() - self._origin_s,
+                        thread_id=threading.get_ident(),
+                        parent=parent.name if parent is not None else None,
+                        rss_start_bytes=rss,
+                        rss_peak_bytes=rss,
+                        attrs=dict(attrs))
+        token = self._current.set(new_span)
+        with self._lock:
+            self._open[id(new_span)] = new_span
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        try:
+            yield new_span
+        finally:
+            new_span.duration_s = time.perf_counter() - self._origin_s - new_span.start_s
+            new_span.rss_peak_bytes = max(new_span.rss_peak_bytes, current_rss_bytes())
+            self._current.reset(token)
+            with self._lock:
+                del self._open[id(new_span)]
+                self.spans.append(new_span)
+
+    def add_span(self, name: str, start_s: float, duration_s: float, **attrs):
+        """ record an already finished span (e.g. from the node timings of polars' LazyFrame.profile),
+            start_s relative to the tracer's start (see elapsed_s), as a child of the current span
+        """
+        if not self.enabled:
+            return
+        parent = self._current.get()
+        with self._lock:
+            self.spans.append(Span(name,
+                                   start_s=start_s,
+                                   duration_s=duration_s,
+                                   thread_id=threading.get_ident(),
+                                   parent=parent.name if parent is not None else None,
+                                   attrs=dict(attrs)))
+
+    def elapsed_s(self) -> float:
+        return time.perf_counter() - self._origin_s
+
+    def current_span(self) -> Optional[Span]:
+        return self._current.get()
+
+    def export_json(self, path: str | Path):
+        spans = sorted(self.spans, key=lambda s: s.start_s)
+        Path(path).write_text(json.dumps({'spans': [s.to_dict() for s in spans]}, indent=2, default=str))
+
+    def export_chrome_trace(self, path: str | Path):
+        """ Chrome trace event format, complete ('X') events in microseconds """
+        events = [{'name': s.name,
+                   'ph': 'X',
+                   'ts': s.start_s * 1e6,
+                   'dur': s.duration_s * 1e6,
+                   'pid': os.getpid(),
+                   'tid': s.thread_id,
+                   'args': {k: v for k, v in s.to_dict().items() if k not in ('name', 'start_s', 'duration_s', 'thread_id')}}
+                  for s in self.spans]
+        Path(path).write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str))
+
+    def export(self, path: str | Path, trace_format: str = 'chrome'):
+        if trace_format == 'chrome':
+            self.export_chrome_trace(path)
+        else:
+            self.export_json(path)
+        logger.info(f"Trace with {len(self.spans)} spans saved to {path}")
+
+
+tracer = Tracer()
+
+
+def span(name: str, **attrs):
+    """ context manager recording a span of the global tracer (no-op while it's disabled) """
+    return tracer.span(name, **attrs)
+
+
+def record(**attrs):
+    """ add attributes (e.g. rows_out) to the current span """
+    current = tracer.current_span()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+def record_drops(drops: dict[str, int]):
+    """ add dropped row counts, per reason, to the current span """
+    current = tracer.current_span()
+    if current is not None:
+        for reason, count in drops.items():
+            current.drops[reason] = current.drops.get(reason, 0) + count
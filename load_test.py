@@ -0,0 +1,143 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.request import Request, urlopen
+import json
+import random
+import threading
+import time
+
+import numpy as np
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Load test of a running scoring_server.py: concurrent clients send score requests (and optionally app_usage
+# events) for random members, and the throughput and latency percentiles are reported as JSON.
+
+
+def _post(url: str, body: dict, timeout_s: float) -> dict:
+    request = Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'}, method='POST')
+    with urlopen(request, timeout=timeout_s) as response:
+        return json.loads(response.read())
+
+
+def _get(url: str, timeout_s: float) -> dict:
+    with urlopen(url, timeout=timeout_s) as response:
+        return json.loads(response.read())
+
+
+def run_load_test(url: str,
+                  n_clients: int = 16,
+                  duration_s: float = 30,
+                  members_per_request: int = 1,
+                  event_fraction: float = 0.0,
+                  obs_window_end: datetime = datetime(2025, 7, 16),
+                  timeout_s: float = 10,
+                  seed: int = 0) -> dict:
+    """ Send requests from n_clients concurrent clients, each waiting for its response before the next request
+
+    Args:
+        url (str): e.g. http://127.0.0.1:8080
+        n_clients (int, optional): Defaults to 16.
+        duration_s (float, optional): Defaults to 30.
+        members_per_request (int, optional): member_ids of each score request. Defaults to 1.
+        event_fraction (float, optional): fraction of the requests that post an app_usage event of a random member
+            (on the last day of the observation window) instead of scoring. Defaults to 0.0.
+        obs_window_end (datetime, optional): of the server, for the event timestamps. Defaults to datetime(2025, 7, 16).
+        timeout_s (float, optional): per request. Defaults to 10.
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        dict: requests/s, members/s and latency percentiles (ms) of the score and event requests, and the errors
+    """
+    member_ids = _get(f'{url}/members?limit=100000', timeout_s)['member_ids']
+    health = _get(f'{url}/health', timeout_s)
+    logger.info(f"Load testing {url} (model version {health['model_version']}) with {n_clients} clients for {duration_s}s")
+
+    latencies = {'score': [], 'events': []}
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration_s
+
+    def client(i: int):
+        rng = random.Random(seed + i)
+        while time.perf_counter() < deadline:
+            kind = 'events' if rng.random() < event_fraction else 'score'
+            if kind == 'score':
+                path, body = '/score', {'member_ids': rng.sample(member_ids, members_per_request)}
+            else:
+                timestamp = obs_window_end - timedelta(seconds=rng.randrange(86400))
+                path, body = '/events', {'source': 'app_usage',
+                                         'events': [{'member_id': rng.choice(member_ids),
+                                                     'event_type': 'session',
+                                                     'timestamp': timestamp.isoformat()}]}
+            start = time.perf_counter()
+            try:
+                _post(url + path, body, timeout_s)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            latency_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies[kind].append(latency_ms)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as executor:
+        list(executor.map(client, range(n_clients)))
+    elapsed = time.perf_counter() - start
+
+    results = {'url': url, 'n_clients': n_clients, 'duration_s': elapsed, 'members_per_request': members_per_request,
+               'n_errors': len(errors), 'errors': sorted(set(errors))[:10]}
+    for kind, kind_latencies in latencies.items():
+        if not kind_latencies:
+            continue
+        p50, p95, p99 = np.percentile(kind_latencies, [50, 95, 99])
+        results[kind] = {
+            'requests': len(kind_latencies),
+            'requests_per_s': len(kind_latencies) / elapsed,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99,
+            'max_ms': max(kind_latencies),
+        }
+        if kind == 'score':
+            results[kind]['members_per_s'] = len(kind_latencies) * members_per_request / elapsed
+        logger.info(f"{kind}: {results[kind]['requests_per_s']:,.0f} requests/s, "
+                    f"latency p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms")
+    health = _get(f'{url}/health', timeout_s)
+    results['server'] = health
+    if health['n_batches']:
+        logger.info(f"Server scored {health['n_scored']} members in {health['n_batches']} micro-batches")
+    return results
+
+
+def parse_args():
+    parser = ArgumentParser(description="Load test a running scoring_server.py and report throughput and latency percentiles.")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    parser.add_argument("--clients", type=int, default=16, help="Number of concurrent clients.")
+    parser.add_argument("--duration", type=float, default=30, help="Duration of the test in seconds.")
+    parser.add_argument("--members-per-request", type=int, default=1)
+    parser.add_argument("--event-fraction", type=float, default=0.0,
+                        help="Fraction of the requests that post an app_usage event instead of scoring.")
+    parser.add_argument("--obs-window-end", type=datetime.fromisoformat, default=datetime(2025, 7, 16))
+    parser.add_argument("--output", type=str, default=None, help="JSON file to write the results to.")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_load_test(args.url, args.clients, args.duration, args.members_per_request, args.event_fraction,
+                            args.obs_window_end, seed=args.seed)
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        logger.info(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
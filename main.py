@@ -1,14 +1,16 @@
 from argparse import ArgumentParser
-from data_ingestion import ingest_and_pre_process_data
-from featurization import featurize_data
-from model import train_cate, evaluate_cate
+from functools import partial
 from pathlib import Path
+from typing import Optional
+import json
+import os
+import shutil
 import polars as pl
 
-from sklift.metrics import uplift_at_k, qini_auc_score
-from sklift.viz import plot_qini_curve
-
-import matplotlib.pyplot as plt
+from instrumentation import span, tracer
+from pipeline import DONE_MARKER, STAGE_KINDS, Pipeline, Stage
+from uplift_metrics import (qini_curve, perfect_qini_curve, qini_auc_score, uplift_auc_score, uplift_at_k,
+                            bootstrap_qini_auc, permutation_test_qini_auc, select_outreach_size, top_k_indices)
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +31,181 @@ def parse_args():
         default="output",
         help="Path to the folder to save outputs."
     )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="Scan the CSVs lazily and run ingestion and featurization as a single streaming plan (bounded memory)."
+    )
+    parser.add_argument(
+        "--cache-ingested",
+        action="store_true",
+        help="Cache the ingested dataframes as Arrow IPC files next to the data folder, and memory-map them on later runs."
+    )
+    parser.add_argument(
+        "--rebuild-cache",
+        action="store_true",
+        help="With --cache-ingested, re-ingest the CSVs and overwrite the cache."
+    )
+    parser.add_argument(
+        "--ingest-workers",
+        type=int,
+        default=4,
+        help="Number of CSV files ingested concurrently."
+    )
+    parser.add_argument(
+        "--horizons",
+        type=int,
+        nargs="*",
+        default=[],
+        help="Horizons in days before the end of the observation window for windowed event count and active days features, e.g. 7 30 90."
+    )
+    parser.add_argument(
+        "--gap-stats",
+        action="store_true",
+        help="Add mean and max days between consecutive events as features."
+    )
+    parser.add_argument(
+        "--sparse-features",
+        action="store_true",
+        help="Add event count and recency features per ICD code and per web page title, as a sparse matrix "
+             "(vocabularies of the train data). The model is then fitted on the sparse matrix."
+    )
+    parser.add_argument(
+        "--feature-shards",
+        type=int,
+        default=1,
+        help="Partition the ingested data by a hash of member_id into this many shards on disk and featurize them "
+             "in parallel processes, each with the memory of one shard. Defaults to 1 (no sharding)."
+    )
+    parser.add_argument(
+        "--featurize-workers",
+        type=int,
+        default=None,
+        help="With --feature-shards, number of worker processes. Defaults to the size of the polars thread pool."
+    )
+    parser.add_argument(
+        "--n-resamples",
+        type=int,
+        default=1000,
+        help="Number of bootstrap and permutation resamples for the confidence interval and p-value of the Qini AUC."
+    )
+    parser.add_argument(
+        "--cost-per-outreach",
+        type=float,
+        default=None,
+        help="With --value-per-retained, choose the outreach size with the highest net value instead of the Qini curve elbow."
+    )
+    parser.add_argument(
+        "--value-per-retained",
+        type=float,
+        default=None,
+        help="Value of a retained member, in the same unit as --cost-per-outreach."
+    )
+    parser.add_argument(
+        "--model-dir",
+        type=str,
+        default=None,
+        help="Folder to save the trained model artifact to (for score.py). Defaults to <output-folder>/model."
+    )
+    parser.add_argument(
+        "--lgbm-config",
+        type=str,
+        default=None,
+        help="JSON file with LightGBM settings of the CATE model, e.g. best_config.json written by tune.py."
+    )
+    parser.add_argument(
+        "--early-stopping-rounds",
+        type=int,
+        default=None,
+        help="Hold out a validation fold for each LightGBM model and stop boosting after this many rounds without improvement."
+    )
+    parser.add_argument(
+        "--train-threads",
+        type=int,
+        default=None,
+        help="Number of LightGBM threads used for training. Defaults to the threads of the budget (--threads) that are free when training starts."
+    )
+    parser.add_argument(
+        "--warm-start-from",
+        type=str,
+        default=None,
+        help="Model artifact folder of a previous run. Instead of training from scratch, each of its LightGBM models "
+             "continues boosting on the train data with --warm-start-trees new trees."
+    )
+    parser.add_argument(
+        "--warm-start-trees",
+        type=int,
+        default=100,
+        help="With --warm-start-from, number of trees added to each LightGBM model."
+    )
+    parser.add_argument(
+        "--compare-cold-retrain",
+        action="store_true",
+        help="With --warm-start-from, also retrain from scratch, and log the Qini AUC and fit time of both on a holdout "
+             "of the train data."
+    )
+    parser.add_argument(
+        "--distill",
+        action="store_true",
+        help="Fit a small LightGBM regressor to the trained model's treatment effects and use it as the scoring model "
+             "(evaluation and the saved model). Its rank correlation and Qini AUC loss against the full model are logged."
+    )
+    parser.add_argument(
+        "--inference-chunk-size",
+        type=int,
+        default=None,
+        help="Score members in chunks of this size (bounded memory). Defaults to all members at once."
+    )
+    parser.add_argument(
+        "--inference-workers",
+        type=int,
+        default=1,
+        help="With --inference-chunk-size, number of chunks scored concurrently."
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="Record a span (duration, peak memory, rows in/out, dropped rows) for each pipeline stage and save them to this file."
+    )
+    parser.add_argument(
+        "--trace-format",
+        choices=['chrome', 'json'],
+        default='chrome',
+        help="With --trace-file, Chrome trace format (chrome://tracing, Perfetto) or a plain JSON list of spans."
+    )
+    parser.add_argument(
+        "--until",
+        choices=STAGE_KINDS,
+        default=None,
+        help="Only run the pipeline up to (and including) the stages of this kind, e.g. featurize."
+    )
+    parser.add_argument(
+        "--from",
+        dest="from_kind",
+        choices=STAGE_KINDS,
+        default=None,
+        help="Re-run the stages of this kind and all later ones even if their cached outputs are up to date, e.g. report. "
+             "By default only stages whose inputs, settings or code changed are re-run."
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Thread budget shared by the stages running concurrently (e.g. test ingestion alongside model training). "
+             "Defaults to the number of cores."
+    )
+    parser.add_argument(
+        "--polars-threads",
+        type=int,
+        default=None,
+        help="Size of the polars thread pool, shared by the ingest and featurize stages. Defaults to half of --threads."
+    )
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="Run the stages one after the other, each with all the cores."
+    )
     
     return parser.parse_args()
 
@@ -38,48 +215,265 @@ def main():
     data_folder = Path(args.data_folder)
     output_folder = Path(args.output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
+    if args.trace_file is not None:
+        tracer.enable()
+    n_threads = None
+    if not args.sequential:
+        n_threads = args.threads or os.cpu_count() or 1
+        # polars creates its thread pool on first use, so its size can still be set here. Half of the budget,
+        # so the train features fit can run alongside the test ingestion and featurization
+        os.environ.setdefault('POLARS_MAX_THREADS', str(args.polars_threads or max(1, n_threads // 2)))
+    try:
+        pipeline = build_pipeline(args, data_folder, output_folder)
+        pipeline.run(until=args.until, from_kind=args.from_kind, n_threads=n_threads)
+        # publish the (new or cached) model artifact for score.py
+        if pipeline.is_cached('train'):
+            # cleared first, so no file of a previous artifact (e.g. the teacher of a distilled one) is left over
+            model_dir = _model_dir(args, output_folder)
+            shutil.rmtree(model_dir, ignore_errors=True)
+            shutil.copytree(pipeline.stage_dir('train'), model_dir, ignore=shutil.ignore_patterns(DONE_MARKER))
+    finally:
+        # also written when a stage fails, to see where it failed
+        if args.trace_file is not None:
+            tracer.export(args.trace_file, args.trace_format)
+
+
+#################################################################################################
+# Pipeline stages. Imports of the modules doing the work are inside the stage functions, so only
+# the stages that actually run import them (and e.g. a cached report run never imports lightgbm).
+#################################################################################################
+
+
+def _write_frames(dfs: dict[str, pl.DataFrame | pl.LazyFrame], out_dir: Path):
+    for name, df in dfs.items():
+        if isinstance(df, pl.LazyFrame):
+            df.sink_ipc(out_dir / f'{name}.arrow')
+        else:
+            df.write_ipc(out_dir / f'{name}.arrow')
+
+
+def _load_frames(out_dir: Path, lazy: bool = False) -> dict[str, pl.DataFrame | pl.LazyFrame]:
+    if lazy:
+        return {path.stem: pl.scan_ipc(path) for path in sorted(out_dir.glob('*.arrow'))}
+    return {path.stem: pl.read_ipc(path) for path in sorted(out_dir.glob('*.arrow'))}
+
+
+def _load_frame(out_dir: Path) -> pl.DataFrame:
+    return pl.read_ipc(next(out_dir.glob('*.arrow')))
+
+
+def _ingest_stage(args, folder: Path) -> Stage:
+    def run(out_dir: Path):
+        from data_ingestion import ingest_and_pre_process_data
+        logger.info(f"Processing {folder.name} data from {folder}")
+        dfs = ingest_and_pre_process_data(folder, 
+                                          lazy=args.lazy,
+                                          use_cache=args.cache_ingested,
+                                          rebuild_cache=args.rebuild_cache,
+                                          n_workers=args.ingest_workers)
+        _write_frames(dfs, out_dir)
+        return _load_frames(out_dir, args.lazy)
     
-    ######## Train ########
-    # Ingest and pre-process train data
-    print('should log now')
-    logger.info(f"Processing train data from {data_folder / 'train'}")
-    train_dfs = ingest_and_pre_process_data(data_folder / 'train')
-    # Featurize data
-    train_features_w_label = featurize_data(train_dfs)
-    # Train CATE model
-    cate_model = train_cate(train_features_w_label)
-
-    logger.info("Evaluating train data...")
-    train_eval_df = evaluate_cate(cate_model, train_features_w_label)
-    logger.info("Writing train report...")
-    write_report(str(output_folder / 'train'), train_eval_df)
-    
-    
-    ######## Test ########
-    # Ingest and pre-process test data
-    logger.info(f"Processing test data from {data_folder / 'test'}")
-    test_dfs = ingest_and_pre_process_data(data_folder / 'test')
-    # Featurize data
-    test_features_w_label = featurize_data(test_dfs)
-    logger.info("Evaluating test data...")
-    test_eval_df = evaluate_cate(cate_model, test_features_w_label)
-    logger.info("Writing test report...")
-    write_report(str(output_folder / 'test'), test_eval_df)
-
-def write_report(out_dir: str, eval_df: pl.DataFrame):
-    """ writes the csv, the confusion matrix png, and the text report with metrics to the out_dir
+    return Stage(name=f'ingest_{folder.name}',
+                 kind='ingest',
+                 run=run,
+                 load=partial(_load_frames, lazy=args.lazy),
+                 code=('data_ingestion', 'caching'),
+                 sources=tuple(sorted(folder.glob('*.csv'))),
+                 threads=pl.thread_pool_size(),
+                 pool='polars')
+
+
+def _load_features(out_dir: Path):
+    """ output of a featurize stage: the feature matrix with labels, and the sparse features (or None) """
+    from sparse_features import SparseFeatures
+    return pl.read_ipc(out_dir / 'features.arrow'), SparseFeatures.load(out_dir)
+
+
+def _featurize_stage(args, split: str) -> Stage:
+    # the other splits' sparse features use the train vocabularies, so they get the same columns
+    inputs = (f'ingest_{split}',) + (('featurize_train',) if args.sparse_features and split != 'train' else ())
+    # sharded featurization runs in worker processes, each with its own polars pool, which split the threads
+    # of the stage (the size of the polars pool, or more with more workers)
+    sharded = args.feature_shards > 1
+    n_workers = min(args.feature_shards, args.featurize_workers or pl.thread_pool_size())
+    shard_threads = max(n_workers, pl.thread_pool_size())
+    
+    def run(out_dir: Path, dfs: dict[str, pl.DataFrame | pl.LazyFrame], train_features=None):
+        if sharded:
+            from sharding import featurize_sharded
+            features_w_labels = featurize_sharded(dfs, args.feature_shards, n_workers=n_workers, n_threads=shard_threads,
+                                                  horizons=args.horizons, gap_stats=args.gap_stats)
+        else:
+            from featurization import featurize_data
+            features_w_labels = featurize_data(dfs, horizons=args.horizons, gap_stats=args.gap_stats)
+        features_w_labels.write_ipc(out_dir / 'features.arrow')
+        sparse = None
+        if args.sparse_features:
+            from sparse_features import sparse_category_features
+            vocabularies = train_features[1].vocabularies if train_features is not None else None
+            sparse = sparse_category_features(dfs, features_w_labels['member_id'], vocabularies=vocabularies)
+            sparse.save(out_dir)
+        return features_w_labels, sparse
+    
+    return Stage(name=f'featurize_{split}',
+                 kind='featurize',
+                 run=run,
+                 load=_load_features,
+                 inputs=inputs,
+                 params={'horizons': args.horizons, 'gap_stats': args.gap_stats, 'sparse_features': args.sparse_features},
+                 code=('featurization', 'sparse_features', 'sharding'),
+                 threads=shard_threads if sharded else pl.thread_pool_size(),
+                 pool=None if sharded else 'polars')
+
+
+def _model_dir(args, output_folder: Path) -> Path:
+    """ folder the model artifact is published to """
+    return Path(args.model_dir) if args.model_dir is not None else output_folder / 'model'
+
+
+def _train_stage(args, output_folder: Path) -> Stage:
+    lgbm_params = json.loads(Path(args.lgbm_config).read_text()) if args.lgbm_config is not None else None
+    previous_dir = previous_version = None
+    if args.warm_start_from is not None:
+        previous_dir = Path(args.warm_start_from)
+        # the run replaces the published model, so warm starting from it would add trees on top of this run's on the
+        # next run, and so on
+        if previous_dir.resolve() == _model_dir(args, output_folder).resolve():
+            raise ValueError(f"--warm-start-from {previous_dir} is the folder this run publishes its model to, "
+                             f"copy the previous model to a separate folder (or set --model-dir)")
+        previous_metadata = json.loads((previous_dir / 'metadata.json').read_text())
+        previous_version = previous_metadata['model_version']
+        # the full model of a distilled artifact is in its teacher folder
+        if 'distillation' in previous_metadata:
+            previous_dir = previous_dir / 'teacher'
+    
+    def run(out_dir: Path, features, n_threads: Optional[int] = None):
+        from model import train_cate, warm_start_cate, compare_warm_cold, distill_cate, model_features, trees_used
+        from artifacts import save_model_artifact, load_model_artifact, check_feature_schema
+        features_w_labels, sparse = features
+        n_jobs = args.train_threads or n_threads
+        featurization_params = {'horizons': args.horizons, 'gap_stats': args.gap_stats}
+        if sparse is not None:
+            featurization_params['sparse_vocabularies'] = sparse.vocabularies
+        extra_metadata = dict()
+        if previous_dir is None:
+            cate_model = train_cate(features_w_labels, 
+                                    lgbm_params=lgbm_params,
+                                    early_stopping_rounds=args.early_stopping_rounds,
+                                    n_jobs=n_jobs,
+                                    sparse_features=sparse)
+        else:
+            previous_model, previous_metadata = load_model_artifact(previous_dir)
+            check_feature_schema(previous_metadata, model_features(features_w_labels))
+            if previous_metadata.get('featurization', dict()).get('sparse_vocabularies') != featurization_params.get('sparse_vocabularies'):
+                raise ValueError(f"The sparse features of the train data don't match the ones of {previous_dir}")
+            cate_model = warm_start_cate(previous_model, features_w_labels, args.warm_start_trees, n_jobs, sparse)
+            extra_metadata['warm_start'] = {'previous_model_version': previous_metadata['model_version'],
+                                            'n_new_trees': args.warm_start_trees}
+            if args.compare_cold_retrain:
+                extra_metadata['warm_start'].update(compare_warm_cold(previous_model, features_w_labels, args.warm_start_trees,
+                                                                      lgbm_params=lgbm_params,
+                                                                      early_stopping_rounds=args.early_stopping_rounds,
+                                                                      n_jobs=n_jobs, 
+                                                                      sparse_features=sparse))
+        metadata = {'featurization': featurization_params, 'trees_used': trees_used(cate_model), **extra_metadata}
+        if not args.distill:
+            save_model_artifact(cate_model, model_features(features_w_labels), out_dir, extra_metadata=metadata)
+            return cate_model
+        
+        # the student is the scoring model, the full model is kept next to it
+        student, distillation_metrics = distill_cate(cate_model, features_w_labels, n_jobs=n_jobs, sparse_features=sparse)
+        save_model_artifact(cate_model, model_features(features_w_labels), out_dir / 'teacher', extra_metadata=metadata)
+        save_model_artifact(student, 
+                            model_features(features_w_labels), 
+                            out_dir,
+                            extra_metadata={'featurization': featurization_params, 'distillation': distillation_metrics,
+                                            **extra_metadata})
+        return student
+    
+    def load(out_dir: Path):
+        from artifacts import load_model_artifact
+        return load_model_artifact(out_dir)[0]
+    
+    return Stage(name='train',
+                 kind='train',
+                 run=run,
+                 load=load,
+                 inputs=('featurize_train',),
+                 params={'lgbm_params': lgbm_params, 'early_stopping_rounds': args.early_stopping_rounds, 
+                         'distill': args.distill, 'warm_start_trees': args.warm_start_trees if previous_dir else None,
+                         'compare_cold_retrain': args.compare_cold_retrain and previous_dir is not None,
+                         'warm_start_from_version': previous_version},
+                 code=('model', 'artifacts'),
+                 threads=None)
+
+
+def _evaluate_stage(args, split: str) -> Stage:
+    def run(out_dir: Path, cate_model, features, n_threads: Optional[int] = None) -> pl.DataFrame:
+        from model import evaluate_cate
+        logger.info(f"Evaluating {split} data...")
+        features_w_labels, sparse = features
+        # LightGBM's prediction threads within the stage's share of the thread budget, set on a copy of the models
+        # (see model.with_n_jobs), as the evaluate stages share the trained model and run concurrently
+        eval_df = evaluate_cate(cate_model, features_w_labels, args.inference_chunk_size, args.inference_workers,
+                                sparse_features=sparse, n_jobs=n_threads)
+        eval_df.write_ipc(out_dir / 'eval.arrow')
+        return eval_df
+    
+    return Stage(name=f'evaluate_{split}',
+                 kind='evaluate',
+                 run=run,
+                 load=_load_frame,
+                 inputs=('train', f'featurize_{split}'),
+                 code=('model',),
+                 threads=None)
+
+
+def _report_stage(args, split: str, output_folder: Path) -> Stage:
+    def run(out_dir: Path, eval_df: pl.DataFrame):
+        logger.info(f"Writing {split} report...")
+        write_report(str(output_folder / split), eval_df, 
+                     n_resamples=args.n_resamples,
+                     cost_per_outreach=args.cost_per_outreach,
+                     value_per_retained=args.value_per_retained)
+    
+    return Stage(name=f'report_{split}',
+                 kind='report',
+                 run=run,
+                 load=lambda out_dir: None,
+                 inputs=(f'evaluate_{split}',),
+                 params={'n_resamples': args.n_resamples,
+                         'cost_per_outreach': args.cost_per_outreach,
+                         'value_per_retained': args.value_per_retained,
+                         'output_folder': str(output_folder.resolve())},
+                 code=('main', 'uplift_metrics'))
+
+
+def build_pipeline(args, data_folder: Path, output_folder: Path) -> Pipeline:
+    """ train: ingest -> featurize -> train -> evaluate -> report, test: ingest -> featurize -> evaluate -> report,
+        with the stage outputs cached in <output_folder>/.stages
+    """
+    stages = []
+    for split in ['train', 'test']:
+        stages += [_ingest_stage(args, data_folder / split), _featurize_stage(args, split)]
+    stages.append(_train_stage(args, output_folder))
+    for split in ['train', 'test']:
+        stages += [_evaluate_stage(args, split), _report_stage(args, split, output_folder)]
+    return Pipeline(stages, output_folder / '.stages')
+
+
+def write_ranking(out_path: Path, eval_df: pl.DataFrame) -> Path:
+    """ writes top_n.csv, all members ranked by prioritization score (te)
 
     Args:
-        out_dir (str): 
-        results_df (pd.DataFrame): must contain columns true_class, pred_class
+        out_path (Path): 
+        eval_df (pl.DataFrame): must contain columns member_id, te
+
+    Returns:
+        Path: path of the csv
     """
-    out_path = Path(out_dir)
-    out_path.mkdir(parents=True, exist_ok=True)
-    
-    # results csv
-    # ----------------------------------
-    top_n_csv_path = out_path / '.csv'
-    logger.info(f"Results saved to {top_n_csv_path}")
+    top_n_csv_path = out_path / 'top_n.csv'
     
     results_top_n = eval_df.clone()
 
@@ -89,32 +483,108 @@ def write_report(out_dir: str, eval_df: pl.DataFrame):
 
     results_top_n = results_top_n[['member_id', 'prioritization_score', 'rank']]
     results_top_n.write_csv(top_n_csv_path)
+    logger.info(f"Results saved to {top_n_csv_path}")
+    return top_n_csv_path
+
+
+def write_shortlist(out_path: Path, eval_df: pl.DataFrame, outreach_size: int) -> Path:
+    """ writes shortlist.csv, the top outreach_size members by prioritization score (te),
+        selected without sorting the whole population
+
+    Args:
+        out_path (Path): 
+        eval_df (pl.DataFrame): must contain columns member_id, te
+        outreach_size (int): 
+
+    Returns:
+        Path: path of the csv
+    """
+    shortlist_csv_path = out_path / 'shortlist.csv'
     
-    # qini curve
-    # ----------------------------------
-    plt.figure()
-    plot_qini_curve(y_true=1-eval_df['churn'],
-                uplift=eval_df['te'],
-                treatment=eval_df['outreach'],
-                )
-    plt.legend(loc='upper right')
-    plt.savefig(out_path / 'qini_curve.png')
-    plt.close()
-    logger.info(f"Qini curve saved to {out_path / 'qini_curve.png'}")
-    
-    # metrics:
-    # ----------------------------------
-    auuc_score = qini_auc_score(y_true=1-eval_df['churn'], 
-                                uplift=eval_df['te'], 
-                                treatment=eval_df['outreach'])
-    logger.info(f"Train AUUC Score: {auuc_score}")
-
-
-    report_txt_path = out_path / 'report.txt'
-    with open(report_txt_path, 'w') as f:
-        f.write(f"AUUC Score: {auuc_score:.3f}\n")
+    top = top_k_indices(eval_df['te'].to_numpy(), outreach_size)
+    shortlist = pl.DataFrame({'member_id': eval_df['member_id'].to_numpy()[top],
+                              'prioritization_score': eval_df['te'].to_numpy()[top],
+                              'rank': pl.int_range(1, len(top) + 1, eager=True)})
+    shortlist.write_csv(shortlist_csv_path)
+    logger.info(f"Shortlist of {len(top)} members saved to {shortlist_csv_path}")
+    return shortlist_csv_path
+
+
+def write_report(out_dir: str, 
+                 eval_df: pl.DataFrame, 
+                 n_resamples: int = 1000,
+                 cost_per_outreach: Optional[float] = None,
+                 value_per_retained: Optional[float] = None):
+    """ writes the csv, the qini curve png, and the text report with metrics to the out_dir
+
+    Args:
+        out_dir (str): 
+        eval_df (pl.DataFrame): must contain columns member_id, te, outreach, churn
+        n_resamples (int, optional): bootstrap and permutation resamples of the Qini AUC. Defaults to 1000.
+        cost_per_outreach (Optional[float], optional): see uplift_metrics.select_outreach_size. Defaults to None.
+        value_per_retained (Optional[float], optional): see uplift_metrics.select_outreach_size. Defaults to None.
+    """
+    # only imported by the report stage. The object oriented Figure API, not pyplot's global state,
+    # so reports can be plotted in concurrent stages
+    from matplotlib.figure import Figure
+    
+    with span('write_report', rows_in=len(eval_df), n_resamples=n_resamples):
+        out_path = Path(out_dir)
+        out_path.mkdir(parents=True, exist_ok=True)
+    
+        y_true = 1 - eval_df['churn'].to_numpy()
+        uplift = eval_df['te'].to_numpy()
+        treatment = eval_df['outreach'].to_numpy()
+    
+        # results csv
+        # ----------------------------------
+        write_ranking(out_path, eval_df)
+    
+        # metrics:
+        # ----------------------------------
+        auuc_score = qini_auc_score(y_true, uplift, treatment)
+        uplift_auc = uplift_auc_score(y_true, uplift, treatment)
+        ci_low, ci_high, _ = bootstrap_qini_auc(y_true, uplift, treatment, n_resamples=n_resamples)
+        p_value, _ = permutation_test_qini_auc(y_true, uplift, treatment, n_resamples=n_resamples)
+        top_k_fractions = [0.05, 0.1, 0.2, 0.3, 0.5]
+        uplift_at_top_k = uplift_at_k(y_true, uplift, treatment, top_k_fractions)
+        logger.info(f"AUUC Score: {auuc_score:.3f} (95% CI [{ci_low:.3f}, {ci_high:.3f}], p-value {p_value:.3f})")
+    
+        # outreach shortlist
+        # ----------------------------------
+        outreach_size = select_outreach_size(y_true, uplift, treatment, cost_per_outreach, value_per_retained)
+        selection_method = 'max net value' if cost_per_outreach is not None else 'qini curve elbow'
+        logger.info(f"Selected outreach size {outreach_size} ({selection_method})")
+        write_shortlist(out_path, eval_df, outreach_size)
+    
+        # qini curve
+        # ----------------------------------
+        x, qini = qini_curve(y_true, uplift, treatment)
+        x_perfect, qini_perfect = perfect_qini_curve(y_true, treatment)
+        fig = Figure()
+        ax = fig.subplots()
+        ax.plot(x, qini, label=f'Model (qini_auc_score={auuc_score:.3f})')
+        ax.plot(x_perfect, qini_perfect, label='Perfect')
+        ax.plot([0, x[-1]], [0, qini[-1]], '--', label='Random')
+        ax.axvline(outreach_size, color='gray', linestyle=':', label=f'Outreach size ({outreach_size})')
+        ax.set_xlabel('Number targeted')
+        ax.set_ylabel('Number of incremental outcome')
+        ax.set_title('Qini curve')
+        ax.legend(loc='upper right')
+        fig.savefig(out_path / 'qini_curve.png')
+        logger.info(f"Qini curve saved to {out_path / 'qini_curve.png'}")
+
+        report_txt_path = out_path / 'report.txt'
+        with open(report_txt_path, 'w') as f:
+            f.write(f"AUUC Score: {auuc_score:.3f}\n")
+            f.write(f"AUUC Score 95% CI (bootstrap, {n_resamples} resamples): [{ci_low:.3f}, {ci_high:.3f}]\n")
+            f.write(f"AUUC Score p-value (permutation test vs random ranking): {p_value:.3f}\n")
+            f.write(f"Uplift curve AUC: {uplift_auc:.3f}\n")
+            f.write(f"Outreach size ({selection_method}): {outreach_size} of {len(eval_df)} members\n")
+            for k, uplift_k in zip(top_k_fractions, uplift_at_top_k):
+                f.write(f"Uplift at top {k:.0%}: {uplift_k:.4f}\n")
         
-    logger.info(f"Report saved to {report_txt_path}")
+        logger.info(f"Report saved to {report_txt_path}")
 
 if __name__ == "__main__":
     main()
@@ -1,64 +1,746 @@
 
 import polars as pl
-from sklift.metrics import uplift_at_k, qini_auc_score
 
 
-from econml.metalearners import XLearner
-from lightgbm import LGBMClassifier
+from lightgbm import Booster, LGBMClassifier, LGBMRegressor, early_stopping
+from sklearn.base import BaseEstimator, clone, is_classifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.utils.metaestimators import available_if
 
+import copy
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import numpy as np
+import scipy.sparse as sp
+from scipy.stats import spearmanr
+
+from instrumentation import span, record
+from uplift_metrics import qini_auc_score
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# id and label columns of the feature matrix, everything else is a model input
+LABEL_COLUMNS = ['member_id', 'churn', 'outreach']
+
+
+def model_features(features_w_labels: pl.DataFrame) -> pl.DataFrame:
+    """ drop the id and the labels (if present, e.g. scoring data has no labels) """
+    return features_w_labels.drop(LABEL_COLUMNS, strict=False)
+
+
+class EarlyStoppingLGBM(BaseEstimator):
+    """ LightGBM estimator that holds out a validation fold when fitted, and stops boosting when the 
+        validation loss stops improving. Used as the XLearner's models, which it fits without eval sets.
+
+    Args:
+        estimator: LightGBM estimator (LGBMClassifier or LGBMRegressor), n_estimators is the maximum number of trees
+        validation_fraction (float, optional): fraction of the fit data held out. Defaults to 0.2.
+        early_stopping_rounds (int, optional): Defaults to 50.
+        random_state (int, optional): seed of the validation split. Defaults to 0.
+    """
+    def __init__(self, estimator, validation_fraction: float = 0.2, early_stopping_rounds: int = 50, random_state: int = 0):
+        self.estimator = estimator
+        self.validation_fraction = validation_fraction
+        self.early_stopping_rounds = early_stopping_rounds
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        try:
+            # stratified for classifiers, so rare classes appear in both folds
+            X_train, X_val, y_train, y_val = train_test_split(X, y, 
+                                                              test_size=self.validation_fraction,
+                                                              stratify=y if is_classifier(self.estimator) else None,
+                                                              random_state=self.random_state)
+        except ValueError:
+            # a class with a single member can't be stratified
+            X_train, X_val, y_train, y_val = train_test_split(X, y, 
+                                                              test_size=self.validation_fraction,
+                                                              random_state=self.random_state)
+        self.estimator_ = clone(self.estimator)
+        self.estimator_.fit(X_train, y_train, 
+                            eval_set=[(X_val, y_val)],
+                            callbacks=[early_stopping(self.early_stopping_rounds, verbose=False)])
+        return self
+
+    @property
+    def classes_(self):
+        return self.estimator_.classes_
+
+    @property
+    def n_trees_(self) -> int:
+        """ number of boosting iterations used for prediction """
+        return self.estimator_.best_iteration_ or self.estimator_.booster_.current_iteration()
+
+    def predict(self, X):
+        # LightGBM predicts with the best iteration
+        return self.estimator_.predict(X)
+
+    @available_if(lambda self: hasattr(self.estimator, 'predict_proba'))
+    def predict_proba(self, X):
+        return self.estimator_.predict_proba(X)
+
+
+def trees_used(cate_model) -> dict[str, int]:
+    """ number of boosting iterations each fitted LightGBM model of an XLearner uses
+
+    Args:
+        cate_model: fitted XLearner
+
+    Returns:
+        dict[str, int]: keyed by model name, e.g. 'models_0', 'cate_treated_models_0'
+    """
+    n_trees = dict()
+    for attribute in ['models', 'cate_controls_models', 'cate_treated_models', 'propensity_models']:
+        for i, fitted_model in enumerate(getattr(cate_model, attribute, None) or []):
+            if isinstance(fitted_model, EarlyStoppingLGBM):
+                n_trees[f'{attribute}_{i}'] = fitted_model.n_trees_
+            elif hasattr(fitted_model, 'booster_'):
+                n_trees[f'{attribute}_{i}'] = fitted_model.booster_.current_iteration()
+    return n_trees
+
+
+def with_n_jobs(cate_model, n_jobs: int):
+    """ shallow copy of a fitted CATE model whose LightGBM models predict with n_jobs threads, sharing the fitted trees.
+        LightGBM's predict sets its OpenMP threads from the model's n_jobs on every call, so threadpoolctl limits 
+        don't apply to it, and the copy leaves the thread count of the original (e.g. used by another stage) as is.
+
+    Args:
+        cate_model: fitted XLearner (econml's or model.XLearner) or DistilledCATE
+        n_jobs (int):
+
+    Returns:
+        the copy
+    """
+    def copy_model(model):
+        if isinstance(model, EarlyStoppingLGBM):
+            model = copy.copy(model)
+            model.estimator_ = copy_model(model.estimator_)
+            return model
+        if hasattr(model, 'booster_'):
+            # the attribute, not set_params, which also updates a params dict shared with the original
+            model = copy.copy(model)
+            model.n_jobs = n_jobs
+        return model
+
+    cate_model = copy.copy(cate_model)
+    for attribute in ['models', 'cate_controls_models', 'cate_treated_models', 'propensity_models']:
+        if isinstance(getattr(cate_model, attribute, None), list):
+            setattr(cate_model, attribute, [copy_model(model) for model in getattr(cate_model, attribute)])
+    if hasattr(cate_model, 'regressor_'):
+        cate_model.regressor_ = copy_model(cate_model.regressor_)
+    return cate_model
+
+
+class XLearner:
+    """ econml's XLearner for a binary treatment, whose independent models are fitted concurrently: the treated
+        outcome model and the controls' effect model it imputes (models[1], cate_controls_models[0]) on one thread,
+        the control outcome model and the treated's effect model (models[0], cate_treated_models[0]) on another,
+        each with half of n_jobs LightGBM threads (LightGBM releases the GIL while it fits), then the propensity
+        model. LightGBM's threads scale sublinearly, so two half-width fits use the cores better than the same fits
+        one after the other at full width. With n_jobs < 2 the chains run one after the other.
+        Same algorithm and fitted attributes (models, cate_controls_models, cate_treated_models, propensity_models)
+        as econml.metalearners.XLearner (see check_econml_parity). X is dense or a scipy sparse matrix, which 
+        econml's input checks reject; rows are selected by treatment from the CSR matrix directly, so LightGBM gets
+        its native sparse input.
+
+    Args:
+        models: outcome model, cloned for control (models[0]) and treated (models[1])
+        cate_models (optional): model of the imputed effects. Defaults to None (same as models).
+        propensity_model (optional): Defaults to None (LogisticRegression, as econml).
+        n_jobs (Optional[int], optional): LightGBM threads of all the concurrent fits. Defaults to None (all cores).
+    """
+    def __init__(self, models, cate_models=None, propensity_model=None, n_jobs: Optional[int] = None):
+        self.models = models
+        self.cate_models = cate_models
+        self.propensity_model = propensity_model
+        self.n_jobs = n_jobs
+
+    @staticmethod
+    def _as_matrix(X):
+        if sp.issparse(X):
+            return sp.csr_matrix(X)
+        return X.to_numpy() if isinstance(X, pl.DataFrame) else np.asarray(X)
+
+    def fit(self, Y, T, *, X):
+        Y, T = np.ravel(np.asarray(Y)), np.ravel(np.asarray(T))
+        X = self._as_matrix(X)
+        control, treated = T == 0, T == 1
+        model = self.models
+        cate_model = self.cate_models if self.cate_models is not None else model
+        propensity_model = self.propensity_model if self.propensity_model is not None else LogisticRegression()
+        n_threads = self.n_jobs or os.cpu_count() or 1
+        n_chains = 2 if n_threads >= 2 else 1
+        threads_per_chain = n_threads // n_chains
+
+        def fit_clone(estimator, rows, y):
+            estimator = clone(estimator, safe=False)
+            if isinstance(estimator, EarlyStoppingLGBM):
+                estimator.set_params(estimator__n_jobs=threads_per_chain)
+            elif 'n_jobs' in estimator.get_params():
+                estimator.set_params(n_jobs=threads_per_chain)
+            return estimator.fit(X[rows], y)
+
+        def fit_chain(is_treated_chain: bool):
+            # outcome model on one arm, then the model of the effects it imputes on the other arm
+            outcome_rows, effect_rows = (treated, control) if is_treated_chain else (control, treated)
+            outcome_model = fit_clone(model, outcome_rows, Y[outcome_rows])
+            predicted = outcome_model.predict(X[effect_rows])
+            # effect = treated outcome - control outcome, with the observed outcome of the effect arm
+            imputed_effect = predicted - Y[effect_rows] if is_treated_chain else Y[effect_rows] - predicted
+            return outcome_model, fit_clone(cate_model, effect_rows, imputed_effect)
+
+        # the propensity model (single threaded) is queued behind the chains, so at most n_jobs threads run
+        with ThreadPoolExecutor(max_workers=n_chains, thread_name_prefix='xlearner-fit') as executor:
+            treated_chain = executor.submit(fit_chain, True)
+            control_chain = executor.submit(fit_chain, False)
+            propensity = executor.submit(fit_clone, propensity_model, slice(None), T)
+            treated_model, cate_controls_model = treated_chain.result()
+            control_model, cate_treated_model = control_chain.result()
+            self.propensity_models = [propensity.result()]
+        self.models = [control_model, treated_model]
+        self.cate_controls_models = [cate_controls_model]
+        self.cate_treated_models = [cate_treated_model]
+        return self
+
+    def effect(self, X) -> np.ndarray:
+        """ E[Y|T=1,X] - E[Y|T=0,X], the propensity weighted imputed effects """
+        X = self._as_matrix(X)
+        propensity = self.propensity_models[0].predict_proba(X)[:, 1]
+        return (propensity * self.cate_controls_models[0].predict(X) 
+                + (1 - propensity) * self.cate_treated_models[0].predict(X))
+
+
+def design_matrix(features: pl.DataFrame, sparse_features=None):
+    """ the model input: the dense features, or with sparse_features (sparse_features.SparseFeatures, rows aligned 
+        with features) a float32 CSR of the dense features followed by the sparse ones, without densifying them 
+    """
+    if sparse_features is None:
+        return features
+    return sp.hstack([sp.csr_matrix(features.to_numpy().astype(np.float32)), sparse_features.matrix], format='csr')
+
+
 ## CATE model training
 
-def train_cate(features_w_labels: pl.DataFrame):
+# LightGBM settings of the XLearner's models, overridden per key by train_cate's lgbm_params
+DEFAULT_LGBM_PARAMS = {
+    'max_depth': 5,
+    'n_estimators': 1000,
+    'reg_alpha': 0.1,
+    'reg_lambda': 0.1,
+}
+
+
+def train_cate(features_w_labels: pl.DataFrame,
+               lgbm_params: Optional[dict] = None,
+               early_stopping_rounds: Optional[int] = None,
+               validation_fraction: float = 0.2,
+               n_jobs: Optional[int] = None,
+               sparse_features=None):
+    """ Fit the XLearner CATE model, T = outreach, Y = 1-churn
+
+    Args:
+        features_w_labels (pl.DataFrame): 
+        lgbm_params (Optional[dict], optional): overrides of DEFAULT_LGBM_PARAMS (see tune.py). Defaults to None.
+        early_stopping_rounds (Optional[int], optional): if given, each LightGBM model holds out validation_fraction
+            of its fit data and stops after this many rounds without improvement. Defaults to None (all 1000 trees).
+        validation_fraction (float, optional): with early_stopping_rounds. Defaults to 0.2.
+        n_jobs (Optional[int], optional): LightGBM threads, the core budget of training, split between the 
+            XLearner's concurrent fits. Defaults to None (all cores).
+        sparse_features (Optional[SparseFeatures], optional): extra sparse features (see sparse_features.py), rows 
+            aligned with features_w_labels. The model is then fitted on a CSR matrix. Defaults to None.
+
+    Returns:
+        fitted XLearner
+    """
     logger.info("Training CATE model...")
+    start_time = time.perf_counter()
     # drop the labels
-    features = features_w_labels.drop(['member_id', 'churn', 'outreach'])
+    features = model_features(features_w_labels)
 
+    lgbm = LGBMClassifier(**{**DEFAULT_LGBM_PARAMS, **(lgbm_params or dict())},
+                          n_jobs=n_jobs,
+                          verbosity=-1)
+    if early_stopping_rounds is not None:
+        lgbm = EarlyStoppingLGBM(lgbm, 
+                                 validation_fraction=validation_fraction, 
+                                 early_stopping_rounds=early_stopping_rounds)
     # T = outreach, Y = churn
-    cate_model = XLearner(models=LGBMClassifier(max_depth=5, 
-                                            n_estimators=1000,
-                                            reg_alpha=0.1,
-                                            reg_lambda=0.1,
-                                            verbosity=-1))
-    # note that fitting is for 1-chrun, since we want to model P(no_churn)
-    # Treatment is outreach
-    cate_model.fit(Y=1-features_w_labels['churn'], 
-                   T=features_w_labels['outreach'], 
-                   X=features)
+    cate_model = XLearner(models=lgbm, n_jobs=n_jobs)
+    X = design_matrix(features, sparse_features)
+    with span('train_cate', rows_in=features.height, n_features=X.shape[1], n_jobs=n_jobs):
+        # note that fitting is for 1-chrun, since we want to model P(no_churn)
+        # Treatment is outreach
+        cate_model.fit(Y=1-features_w_labels['churn'], 
+                       T=features_w_labels['outreach'], 
+                       X=X)
+        record(trees_used=trees_used(cate_model))
 
+    logger.info(f"Trained CATE model in {time.perf_counter() - start_time:.2f}s, trees used: {trees_used(cate_model)}")
     return cate_model
 
 
-def cate_inference(cate_model, features_w_labels: pl.DataFrame) -> np.ndarray:
+def _continue_boosting(fitted_model, X, y, n_new_trees: int, n_jobs: Optional[int] = None):
+    """ a LightGBM model fitted on (X, y) starting from the trees of fitted_model (LightGBM or EarlyStoppingLGBM, 
+        whose trees after the best iteration are dropped), with at most n_new_trees more trees. Other models 
+        (e.g. a LogisticRegression propensity model) are refitted, and so are classifiers whose classes differ
+        from those of y (e.g. the XLearner's effect models, whose imputed effects take values in {-1, 0, 1} 
+        depending on the outcome models' predictions), since their trees have one output per class.
+    """
+    estimator = fitted_model.estimator_ if isinstance(fitted_model, EarlyStoppingLGBM) else fitted_model
+    if not hasattr(estimator, 'booster_'):
+        return clone(estimator).fit(X, y)
+    if is_classifier(estimator) and not np.array_equal(np.unique(y), estimator.classes_):
+        logger.warning(f"Classes {np.unique(y).tolist()} of the new data differ from the previous model's "
+                       f"{estimator.classes_.tolist()}, refitting it from scratch")
+        cold_model = clone(fitted_model)
+        if isinstance(cold_model, EarlyStoppingLGBM):
+            return cold_model.set_params(estimator__n_jobs=n_jobs).fit(X, y)
+        return cold_model.set_params(n_jobs=n_jobs).fit(X, y)
+    n_trees = fitted_model.n_trees_ if isinstance(fitted_model, EarlyStoppingLGBM) else estimator.booster_.current_iteration()
+    init_model = Booster(model_str=estimator.booster_.model_to_string(num_iteration=n_trees))
+    warm_model = clone(estimator).set_params(n_estimators=n_new_trees, n_jobs=n_jobs)
+    warm_model.fit(X, y, init_model=init_model)
+    return warm_model
+
+
+def warm_start_cate(previous_model,
+                    features_w_labels: pl.DataFrame,
+                    n_new_trees: int = 100,
+                    n_jobs: Optional[int] = None,
+                    sparse_features=None):
+    """ Refresh a fitted XLearner (econml's or model.XLearner) with new data: the XLearner's steps are repeated on
+        the new data, with each LightGBM model continuing to boost from its previous trees (at most n_new_trees
+        more) instead of being fitted from scratch. The propensity model is refitted.
+
+    Args:
+        previous_model: fitted XLearner, e.g. loaded from the previous model artifact
+        features_w_labels (pl.DataFrame): new (e.g. recent) data, same feature columns as previous_model's
+        n_new_trees (int, optional): trees added to each LightGBM model. Defaults to 100.
+        n_jobs (Optional[int], optional): LightGBM threads. Defaults to None (LightGBM default, all cores).
+        sparse_features (Optional[SparseFeatures], optional): for a model fitted on sparse features, with the 
+            previous model's vocabularies (see train_cate). Defaults to None.
+
+    Returns:
+        fitted XLearner, a copy of previous_model with the refreshed models
+    """
+    logger.info(f"Warm starting CATE model with {n_new_trees} new trees per model...")
+    start_time = time.perf_counter()
+    X = design_matrix(model_features(features_w_labels), sparse_features)
+    X = X if sp.issparse(X) else X.to_numpy()
+    outcome_model = previous_model.models[0]
+    n_features = (outcome_model.estimator_ if isinstance(outcome_model, EarlyStoppingLGBM) else outcome_model).n_features_
+    if X.shape[1] != n_features:
+        raise ValueError(f"The previous model was fitted on {n_features} features, the new data has {X.shape[1]}")
+    Y = 1 - features_w_labels['churn'].to_numpy()
+    T = features_w_labels['outreach'].to_numpy()
+    control, treated = T == 0, T == 1
+
+    # same steps as the XLearner's fit (see XLearner.fit), on the fitted models of a copy
+    cate_model = copy.deepcopy(previous_model)
+    with span('warm_start_cate', rows_in=features_w_labels.height, n_new_trees=n_new_trees):
+        cate_model.models[1] = _continue_boosting(previous_model.models[1], X[treated], Y[treated], n_new_trees, n_jobs)
+        cate_model.models[0] = _continue_boosting(previous_model.models[0], X[control], Y[control], n_new_trees, n_jobs)
+
+        imputed_effect_on_controls = cate_model.models[1].predict(X[control]) - Y[control]
+        imputed_effect_on_treated = Y[treated] - cate_model.models[0].predict(X[treated])
+        cate_model.cate_controls_models[0] = _continue_boosting(previous_model.cate_controls_models[0], X[control], 
+                                                                imputed_effect_on_controls, n_new_trees, n_jobs)
+        cate_model.cate_treated_models[0] = _continue_boosting(previous_model.cate_treated_models[0], X[treated], 
+                                                               imputed_effect_on_treated, n_new_trees, n_jobs)
+        cate_model.propensity_models[0] = _continue_boosting(previous_model.propensity_models[0], X, T, n_new_trees, n_jobs)
+        record(trees_used=trees_used(cate_model))
+
+    logger.info(f"Warm started CATE model in {time.perf_counter() - start_time:.2f}s, trees used: {trees_used(cate_model)}")
+    return cate_model
+
+
+def compare_warm_cold(previous_model,
+                      features_w_labels: pl.DataFrame,
+                      n_new_trees: int = 100,
+                      holdout_fraction: float = 0.2,
+                      lgbm_params: Optional[dict] = None,
+                      early_stopping_rounds: Optional[int] = None,
+                      n_jobs: Optional[int] = None,
+                      sparse_features=None,
+                      random_state: int = 0) -> dict:
+    """ Qini AUC and fit time of warm_start_cate and of a cold train_cate, both fitted on the same part of the new 
+        data and evaluated on the rest (stratified on outreach x churn)
+
+    Args:
+        previous_model: fitted XLearner
+        features_w_labels (pl.DataFrame): new data
+        n_new_trees (int, optional): see warm_start_cate. Defaults to 100.
+        holdout_fraction (float, optional): Defaults to 0.2.
+        lgbm_params (Optional[dict], optional): of the cold model, see train_cate. Defaults to None.
+        early_stopping_rounds (Optional[int], optional): of the cold model, see train_cate. Defaults to None.
+        n_jobs (Optional[int], optional): LightGBM threads of both. Defaults to None.
+        sparse_features (Optional[SparseFeatures], optional): see warm_start_cate. Defaults to None.
+        random_state (int, optional): seed of the holdout split. Defaults to 0.
+
+    Returns:
+        dict: warm/cold qini_auc and fit_s, and qini_auc_diff (warm - cold)
+    """
+    strata = (2 * features_w_labels['outreach'] + features_w_labels['churn']).to_numpy()
+    fit_rows, holdout_rows = train_test_split(np.arange(features_w_labels.height), 
+                                              test_size=holdout_fraction,
+                                              stratify=strata,
+                                              random_state=random_state)
+    
+    def split(rows: np.ndarray):
+        return features_w_labels[rows], (None if sparse_features is None else 
+                                         type(sparse_features)(sparse_features.matrix[rows], 
+                                                               sparse_features.feature_names, 
+                                                               sparse_features.vocabularies))
+    fit_features, fit_sparse = split(fit_rows)
+    holdout_features, holdout_sparse = split(holdout_rows)
+    
+    metrics = dict()
+    for name, fit in [('warm', lambda: warm_start_cate(previous_model, fit_features, n_new_trees, n_jobs, fit_sparse)),
+                      ('cold', lambda: train_cate(fit_features, lgbm_params, early_stopping_rounds, 
+                                                  n_jobs=n_jobs, sparse_features=fit_sparse))]:
+        start_time = time.perf_counter()
+        cate_model = fit()
+        metrics[f'{name}_fit_s'] = time.perf_counter() - start_time
+        eval_df = evaluate_cate(cate_model, holdout_features, sparse_features=holdout_sparse)
+        metrics[f'{name}_qini_auc'] = float(qini_auc_score(y_true=1 - eval_df['churn'].to_numpy(),
+                                                           uplift=eval_df['te'].to_numpy(),
+                                                           treatment=eval_df['outreach'].to_numpy()))
+    metrics['qini_auc_diff'] = metrics['warm_qini_auc'] - metrics['cold_qini_auc']
+    logger.info(f"Holdout Qini AUC: warm start {metrics['warm_qini_auc']:.4f} in {metrics['warm_fit_s']:.1f}s, "
+                f"cold retrain {metrics['cold_qini_auc']:.4f} in {metrics['cold_fit_s']:.1f}s")
+    return metrics
+
+
+def _chunk_to_numpy(features: pl.DataFrame, start: int, length: int) -> np.ndarray:
+    """ rows [start, start+length) of the features as a C-contiguous float32 array, filled column by column
+        from (zero-copy where possible) column views, so the chunk is copied only once
+    """
+    chunk = features.slice(start, length)
+    X = np.empty((chunk.height, chunk.width), dtype=np.float32, order='C')
+    for j, column in enumerate(chunk.iter_columns()):
+        X[:, j] = column.to_numpy()
+    return X
+
+
+def cate_inference(cate_model, 
+                   features_w_labels: pl.DataFrame,
+                   chunk_size: Optional[int] = None,
+                   n_workers: int = 1,
+                   sparse_features=None,
+                   n_jobs: Optional[int] = None) -> np.ndarray:
+    """ Conditional treatment effect of each member
+
+    Args:
+        cate_model (_type_): fitted CATE model
+        features_w_labels (pl.DataFrame): 
+        chunk_size (Optional[int], optional): score members in chunks of this size, as float32 arrays, so the
+            intermediate arrays of the underlying models stay bounded. Defaults to None (all members at once).
+        n_workers (int, optional): with chunk_size, number of chunks scored concurrently. The threads are split
+            between the workers (each predicts with n_jobs / n_workers LightGBM threads). Defaults to 1.
+        sparse_features (Optional[SparseFeatures], optional): the sparse features the model was trained with,
+            chunks are then row slices of the CSR matrix. Defaults to None.
+        n_jobs (Optional[int], optional): LightGBM threads of the inference (see with_n_jobs). 
+            Defaults to None (the number of cores with chunk_size, otherwise the model's own n_jobs).
+
+    Returns:
+        np.ndarray: te, E[Y|T=1,X] - E[Y|T=0,X]
+    """
     logger.info("Inference with CATE model...")
-    features = features_w_labels.drop(['member_id', 'churn', 'outreach'])
-    # Get conditional treatment effect
-    te = cate_model.effect(features)   # E[Y|T=1,X] - E[Y|T=0,X]
+    features = model_features(features_w_labels)
+    start_time = time.perf_counter()
+    
+    with span('cate_inference', rows_in=features.height, chunk_size=chunk_size, n_workers=n_workers):
+        if chunk_size is None:
+            if n_jobs is not None:
+                cate_model = with_n_jobs(cate_model, n_jobs)
+            # Get conditional treatment effect
+            te = cate_model.effect(design_matrix(features, sparse_features))   # E[Y|T=1,X] - E[Y|T=0,X]
+        else:
+            te = np.empty(features.height, dtype=np.float64)
+            X_sparse = design_matrix(features, sparse_features) if sparse_features is not None else None
+            threads_per_worker = max(1, (n_jobs or os.cpu_count() or 1) // max(1, n_workers))
+            cate_model = with_n_jobs(cate_model, threads_per_worker)
+            
+            def infer_chunk(start: int):
+                if X_sparse is not None:
+                    X = X_sparse[start:start + chunk_size]
+                else:
+                    X = _chunk_to_numpy(features, start, chunk_size)
+                te[start:start + X.shape[0]] = np.ravel(cate_model.effect(X))
+            
+            with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+                list(executor.map(infer_chunk, range(0, features.height, chunk_size)))
+        record(rows_out=len(te))
+    
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Scored {features.height} members in {elapsed:.2f}s "
+                f"({features.height / max(elapsed, 1e-9):,.0f} members/s)")
     return te
 
 
-def evaluate_cate(cate_model, features_w_labels: pl.DataFrame) -> pl.DataFrame:
+def evaluate_cate(cate_model, 
+                  features_w_labels: pl.DataFrame,
+                  chunk_size: Optional[int] = None,
+                  n_workers: int = 1,
+                  sparse_features=None,
+                  n_jobs: Optional[int] = None) -> pl.DataFrame:
     """_summary_
 
     Args:
         cate_model (_type_): _description_
         features_w_labels (pl.DataFrame): _description_
+        chunk_size (Optional[int], optional): see cate_inference. Defaults to None.
+        n_workers (int, optional): see cate_inference. Defaults to 1.
+        sparse_features (Optional[SparseFeatures], optional): see cate_inference. Defaults to None.
+        n_jobs (Optional[int], optional): see cate_inference. Defaults to None.
 
     Returns:
         pl.DataFrame: eval dataframe with extra column: te (treatment effect) and labels outreach, churn
     """
     logger.info("Evaluating CATE model...")
     
-    te = cate_inference(cate_model, features_w_labels)
+    te = cate_inference(cate_model, features_w_labels, chunk_size, n_workers, sparse_features, n_jobs)
     
-    eval_df = pl.DataFrame({'te': te, 
-                        'member_id': features_w_labels['member_id'],
-                        'outreach': features_w_labels['outreach'],
-                        'churn': features_w_labels['churn'],})
+    # selecting existing columns doesn't copy them
+    eval_df = pl.DataFrame({'te': te}).hstack(features_w_labels.select(['member_id', 'outreach', 'churn']))
+
+    return eval_df
+
+
+## Distillation
+
+# LightGBM settings of the distilled scoring model, a small fraction of the XLearner's 4 x 1000 depth-5 trees
+DEFAULT_STUDENT_PARAMS = {
+    'max_depth': 4,
+    'num_leaves': 15,
+    'n_estimators': 200,
+    'learning_rate': 0.1,
+}
+
+
+class DistilledCATE:
+    """ A single regressor fitted to a CATE model's te, scored with the same effect(X) interface, so it can
+        replace the CATE model in cate_inference, evaluate_cate and the saved model artifact.
+
+    Args:
+        regressor: e.g. LGBMRegressor, cloned when fitted
+    """
+    def __init__(self, regressor):
+        self.regressor = regressor
+
+    def fit(self, X, te):
+        self.regressor_ = clone(self.regressor)
+        self.regressor_.fit(X.to_numpy() if isinstance(X, pl.DataFrame) else X, np.ravel(te))
+        return self
+
+    @property
+    def n_trees_(self) -> int:
+        return self.regressor_.booster_.current_iteration()
+
+    def effect(self, X) -> np.ndarray:
+        """ the teacher's E[Y|T=1,X] - E[Y|T=0,X], approximated """
+        return self.regressor_.predict(X.to_numpy() if isinstance(X, pl.DataFrame) else X)
+
+
+def distill_cate(cate_model,
+                 features_w_labels: pl.DataFrame,
+                 student_params: Optional[dict] = None,
+                 validation_fraction: float = 0.2,
+                 n_jobs: Optional[int] = None,
+                 sparse_features=None,
+                 random_state: int = 0) -> tuple[DistilledCATE, dict]:
+    """ Fit a small LightGBM regressor (the student) to the te of a fitted CATE model (the teacher), and measure 
+        how much of the teacher's ranking it keeps on held out members
+
+    Args:
+        cate_model: fitted CATE model, e.g. from train_cate
+        features_w_labels (pl.DataFrame): e.g. the train features the teacher was fitted on
+        student_params (Optional[dict], optional): overrides of DEFAULT_STUDENT_PARAMS. Defaults to None.
+        validation_fraction (float, optional): members held out of the student's fit, the fidelity metrics 
+            are computed on them. Defaults to 0.2.
+        n_jobs (Optional[int], optional): LightGBM threads. Defaults to None (LightGBM default, all cores).
+        sparse_features (Optional[SparseFeatures], optional): see train_cate. Defaults to None.
+        random_state (int, optional): seed of the held out split. Defaults to 0.
+
+    Returns:
+        tuple[DistilledCATE, dict]: fitted student and its metrics: spearman (rank correlation of the student's 
+            and teacher's te), teacher_qini_auc, student_qini_auc and qini_auc_loss (teacher - student), the 
+            number of trees of each, and the scoring throughput (members/s) of each, all on the held out members
+    """
+    logger.info("Distilling CATE model...")
+    start_time = time.perf_counter()
+    X = design_matrix(model_features(features_w_labels), sparse_features)
+    te = cate_inference(cate_model, features_w_labels, sparse_features=sparse_features)
+    fit_rows, val_rows = train_test_split(np.arange(features_w_labels.height), 
+                                          test_size=validation_fraction, 
+                                          random_state=random_state)
+
+    student = DistilledCATE(LGBMRegressor(**{**DEFAULT_STUDENT_PARAMS, **(student_params or dict())},
+                                          n_jobs=n_jobs,
+                                          verbosity=-1))
+    with span('distill_cate', rows_in=len(fit_rows), n_jobs=n_jobs):
+        student.fit(X[fit_rows], te[fit_rows])
+
+        X_val = X[val_rows]
+        throughput = dict()
+        for name, model in [('teacher', cate_model), ('student', student)]:
+            scoring_start = time.perf_counter()
+            te_val = np.ravel(model.effect(X_val))
+            throughput[name] = len(val_rows) / max(time.perf_counter() - scoring_start, 1e-9)
+        
+        y_true = 1 - features_w_labels['churn'].to_numpy()[val_rows]
+        treatment = features_w_labels['outreach'].to_numpy()[val_rows]
+        teacher_qini_auc = qini_auc_score(y_true, te[val_rows], treatment)
+        student_qini_auc = qini_auc_score(y_true, te_val, treatment)
+        metrics = {
+            'spearman': float(spearmanr(te[val_rows], te_val).statistic),
+            'teacher_qini_auc': float(teacher_qini_auc),
+            'student_qini_auc': float(student_qini_auc),
+            'qini_auc_loss': float(teacher_qini_auc - student_qini_auc),
+            'teacher_trees': sum(trees_used(cate_model).values()),
+            'student_trees': student.n_trees_,
+            'teacher_members_per_s': throughput['teacher'],
+            'student_members_per_s': throughput['student'],
+        }
+        record(**metrics)
+
+    logger.info(f"Distilled CATE model in {time.perf_counter() - start_time:.2f}s: "
+                f"spearman {metrics['spearman']:.3f}, Qini AUC {metrics['student_qini_auc']:.4f} "
+                f"(teacher {metrics['teacher_qini_auc']:.4f}), {metrics['student_trees']} trees "
+                f"(teacher {metrics['teacher_trees']}), "
+                f"{metrics['student_members_per_s'] / max(metrics['teacher_members_per_s'], 1e-9):.1f}x faster scoring")
+    return student, metrics
+
+
+## Consistency checks (python model.py)
+
+def _synthetic_features(n_members: int, n_features: int, seed: int = 0) -> pl.DataFrame:
+    """ random features with labels, the treatment lowering churn for members with a positive f1 """
+    rng = np.random.default_rng(seed)
+    features = pl.DataFrame({f'f{j}': rng.normal(size=n_members) for j in range(n_features)})
+    outreach = rng.integers(0, 2, n_members)
+    churn_probability = 0.3 + 0.1 * (features['f0'].to_numpy() > 0) - 0.15 * outreach * (features['f1'].to_numpy() > 0)
+    return features.with_columns(member_id=pl.Series(np.arange(n_members, dtype=np.uint32)),
+                                 churn=pl.Series((rng.random(n_members) < churn_probability).astype(np.int8)),
+                                 outreach=pl.Series(outreach.astype(np.int8)))
+
+
+def check_econml_parity(n_members: int = 5000,
+                        n_features: int = 10,
+                        n_estimators: int = 100,
+                        atol: float = 1e-3,
+                        seed: int = 0) -> float:
+    """ Compare the effects of XLearner with econml.metalearners.XLearner fitted on the same random data.
+        They differ only by LightGBM's floating point sums, whose order depends on its number of threads.
+
+    Args:
+        n_members (int, optional): Defaults to 5000.
+        n_features (int, optional): Defaults to 10.
+        n_estimators (int, optional): trees of each LightGBM model. Defaults to 100.
+        atol (float, optional): tolerated absolute difference of the effects. Defaults to 1e-3.
+        seed (int, optional): Defaults to 0.
+
+    Raises:
+        ValueError: if an effect differs from econml's by more than atol
+
+    Returns:
+        float: largest absolute difference of the effects
+    """
+    from econml.metalearners import XLearner as EconmlXLearner
+
+    features_w_labels = _synthetic_features(n_members, n_features, seed)
+    X = model_features(features_w_labels).to_numpy()
+    Y, T = 1 - features_w_labels['churn'].to_numpy(), features_w_labels['outreach'].to_numpy()
+    lgbm = LGBMClassifier(**{**DEFAULT_LGBM_PARAMS, 'n_estimators': n_estimators}, verbosity=-1)
+
+    econml_te = np.ravel(EconmlXLearner(models=lgbm).fit(Y, T, X=X).effect(X))
+    te = np.ravel(XLearner(models=lgbm, n_jobs=2).fit(Y, T, X=X).effect(X))
+    difference = float(np.max(np.abs(te - econml_te)))
+    if not difference <= atol:
+        raise ValueError(f"XLearner's effects differ from econml's by up to {difference}")
+    logger.info(f"XLearner matches econml's XLearner on {n_members} members, max effect difference {difference:.2e}")
+    return difference
+
+
+def check_chunked_inference(n_members: int = 3000,
+                            n_features: int = 5,
+                            n_sparse_features: int = 200,
+                            chunk_size: int = 700,
+                            n_workers: int = 2,
+                            seed: int = 0) -> float:
+    """ Compare chunked and unchunked cate_inference of a model trained on random dense and sparse features.
+        The chunks are row slices of the same CSR matrix, so the effects must be identical.
+
+    Args:
+        n_members (int, optional): Defaults to 3000.
+        n_features (int, optional): dense features. Defaults to 5.
+        n_sparse_features (int, optional): Defaults to 200.
+        chunk_size (int, optional): not a divisor of n_members, so the last chunk is shorter. Defaults to 700.
+        n_workers (int, optional): Defaults to 2.
+        seed (int, optional): Defaults to 0.
+
+    Raises:
+        ValueError: if the chunked effects differ
+
+    Returns:
+        float: largest absolute difference of the effects
+    """
+    from sparse_features import SparseFeatures
+
+    features_w_labels = _synthetic_features(n_members, n_features, seed)
+    matrix = sp.random(n_members, n_sparse_features, density=0.05, format='csr', dtype=np.float32, random_state=seed)
+    sparse = SparseFeatures(matrix, [f's{j}' for j in range(n_sparse_features)], dict())
+    cate_model = train_cate(features_w_labels, lgbm_params={'n_estimators': 50}, sparse_features=sparse)
+
+    te = cate_inference(cate_model, features_w_labels, sparse_features=sparse)
+    chunked_te = cate_inference(cate_model, features_w_labels, chunk_size=chunk_size, n_workers=n_workers, 
+                                sparse_features=sparse)
+    difference = float(np.max(np.abs(chunked_te - te)))
+    if difference != 0:
+        raise ValueError(f"Chunked sparse inference differs from unchunked by up to {difference}")
+    logger.info(f"Chunked sparse inference matches unchunked on {n_members} members in chunks of {chunk_size}")
+    return difference
+
+
+def check_warm_start_class_change(n_members: int = 2000, n_features: int = 5, seed: int = 0) -> list[list]:
+    """ Continue boosting LightGBM classifiers (plain and early stopping) on targets with more and with fewer
+        classes than they were fitted on, as the XLearner's effect models get when the outcome models change.
+
+    Args:
+        n_members (int, optional): Defaults to 2000.
+        n_features (int, optional): Defaults to 5.
+        seed (int, optional): Defaults to 0.
+
+    Raises:
+        ValueError: if a continued model doesn't have the classes of its new targets
+
+    Returns:
+        list[list]: classes of the continued models
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_members, n_features))
+    binary = (X[:, 0] > 0).astype(int)
+    ternary = binary - (X[:, 1] > 1).astype(int)
+    lgbm = LGBMClassifier(n_estimators=20, verbosity=-1)
+
+    classes = []
+    for model in [lgbm, EarlyStoppingLGBM(lgbm, early_stopping_rounds=5)]:
+        for y_previous, y_new in [(binary, ternary), (ternary, binary)]:
+            continued = _continue_boosting(clone(model).fit(X, y_previous), X, y_new, n_new_trees=10)
+            if not np.array_equal(continued.classes_, np.unique(y_new)):
+                raise ValueError(f"Continued model has classes {continued.classes_}, the new targets {np.unique(y_new)}")
+            classes.append(continued.classes_.tolist())
+    logger.info(f"Warm start refits classifiers whose classes changed: {classes}")
+    return classes
+
 
-    return eval_df
\ No newline at end of file
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    check_econml_parity()
+    check_chunked_inference()
+    check_warm_start_class_change()
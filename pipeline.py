@@ -0,0 +1,233 @@
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional
+import contextvars
+import hashlib
+import shutil
+
+from caching import file_fingerprint, hash_key
+from instrumentation import span
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# A pipeline of named stages with declared inputs, each stage's output cached on disk under a key that
+# hashes everything it depends on: its parameters, the source of its code, its input files and the keys of
+# its upstream stages. A stage re-runs only if one of them changed (or it's forced with from_kind).
+
+# stage kinds in pipeline order, for --until / --from
+STAGE_KINDS = ['ingest', 'featurize', 'train', 'evaluate', 'report']
+
+_MODULES_DIR = Path(__file__).resolve().parent
+# written into a stage's output folder when it completed, so a failed or interrupted stage is never a cache hit
+DONE_MARKER = '.done'
+
+
+@dataclass(frozen=True)
+class Stage:
+    """ A pipeline stage
+
+    Args:
+        name (str): unique name, e.g. 'featurize_train'
+        kind (str): one of STAGE_KINDS
+        run (Callable[..., Any]): (out_dir, *outputs of the inputs) -> output. Writes whatever is needed to
+            reload the output into out_dir. Heavy imports belong in the function, so they only happen
+            if the stage runs.
+        load (Callable[[Path], Any]): out_dir -> output, on a cache hit
+        inputs (tuple[str, ...]): names of the upstream stages, their outputs are passed to run in this order
+        params (dict): settings changing the output, part of the cache key
+        code (tuple[str, ...]): names of the modules whose source is part of the cache key
+        sources (tuple[Path, ...]): input files, their fingerprints are part of the cache key
+        threads (Optional[int]): threads the stage uses, for the thread budget of a concurrent run. None for an
+            elastic stage (e.g. a LightGBM fit), which is passed the threads it may use as run(..., n_threads=).
+            Defaults to 1.
+        pool (Optional[str]): name of a thread pool shared with other stages (e.g. 'polars'). Defaults to None.
+    """
+    name: str
+    kind: str
+    run: Callable[..., Any]
+    load: Callable[[Path], Any]
+    inputs: tuple[str, ...] = ()
+    params: dict = field(default_factory=dict)
+    code: tuple[str, ...] = ()
+    sources: tuple[Path, ...] = ()
+    threads: Optional[int] = 1
+    pool: Optional[str] = None
+
+
+def _code_hash(modules: tuple[str, ...]) -> str:
+    """ hash of the modules' source files, read from disk (without importing them) """
+    digest = hashlib.blake2b(digest_size=16)
+    for module in sorted(modules):
+        digest.update(module.encode())
+        digest.update((_MODULES_DIR / f'{module}.py').read_bytes())
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """ Runs stages in dependency order, loading the outputs of up to date stages from cache_dir
+        (<cache_dir>/<stage name>/<key>/) instead of re-running them. Only the latest key of each stage is kept.
+    """
+    def __init__(self, stages: list[Stage], cache_dir: str | Path):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = Path(cache_dir)
+        for stage in stages:
+            if stage.kind not in STAGE_KINDS:
+                raise ValueError(f"Stage {stage.name} has unknown kind {stage.kind}, expected one of {STAGE_KINDS}")
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {name}")
+        self._keys = dict()
+
+    def key(self, name: str) -> str:
+        """ cache key of a stage, computed from its declaration and the keys of its inputs (not their outputs) """
+        if name not in self._keys:
+            stage = self.stages[name]
+            self._keys[name] = hash_key({
+                'name': stage.name,
+                'params': stage.params,
+                'code': _code_hash(stage.code),
+                'sources': [file_fingerprint(path, memo_dir=self.cache_dir) for path in stage.sources],
+                'inputs': {input_name: self.key(input_name) for input_name in stage.inputs},
+            })
+        return self._keys[name]
+
+    def stage_dir(self, name: str) -> Path:
+        return self.cache_dir / name / self.key(name)
+
+    def is_cached(self, name: str) -> bool:
+        return (self.stage_dir(name) / DONE_MARKER).exists()
+
+    def _load(self, name: str) -> Any:
+        stage = self.stages[name]
+        out_dir = self.stage_dir(name)
+        logger.info(f"Stage {name} is up to date, loading its output from {out_dir}")
+        with span(f'stage.{name}', kind=stage.kind, cached=True):
+            return stage.load(out_dir)
+
+    def _execute(self, name: str, inputs: list[Any], n_threads: Optional[int] = None) -> Any:
+        stage = self.stages[name]
+        out_dir = self.stage_dir(name)
+        logger.info(f"Running stage {name}" + (f" with {n_threads} threads" if n_threads is not None else ""))
+        # outputs of previous keys of the stage (and of a failed run of this key) are removed first
+        if out_dir.parent.is_dir():
+            for stale_dir in out_dir.parent.iterdir():
+                shutil.rmtree(stale_dir)
+        out_dir.mkdir(parents=True)
+        with span(f'stage.{name}', kind=stage.kind, cached=False, n_threads=n_threads):
+            if stage.threads is None:
+                output = stage.run(out_dir, *inputs, n_threads=n_threads)
+            else:
+                output = stage.run(out_dir, *inputs)
+        (out_dir / DONE_MARKER).touch()
+        return output
+
+    def _plan(self, selected: list[str], force: set[str]) -> tuple[list[str], list[str]]:
+        """ stages to run, in dependency order, and the up to date stages whose output they need """
+        to_run, to_load = [], []
+
+        def visit(name: str, output_needed: bool):
+            if name in to_run or name in to_load:
+                return
+            if name in force or not self.is_cached(name):
+                for input_name in self.stages[name].inputs:
+                    visit(input_name, True)
+                to_run.append(name)
+            elif output_needed:
+                to_load.append(name)
+
+        for name in selected:
+            visit(name, False)
+        for name in selected:
+            if name not in to_run:
+                logger.info(f"Stage {name} is up to date")
+        return to_run, to_load
+
+    def _run_concurrent(self, to_run: list[str], outputs: dict[str, Any], n_threads: int):
+        """ Run each stage as soon as its inputs are ready and the thread budget allows it.
+            A stage with fixed threads waits for them to be free. Stages of the same pool share its threads
+            (e.g. all polars stages use polars' single thread pool), which the first running stage of the pool
+            takes and the last one gives back. Elastic stages (threads=None) are started last and get all the free
+            threads. Ready stages with a longer chain of stages after them (the critical path) go first.
+        """
+        depth = dict()
+        for name in reversed(to_run):
+            depth[name] = 1 + max((depth[other] for other in to_run if name in self.stages[other].inputs), default=0)
+
+        pending = list(to_run)
+        running = dict()
+        free = n_threads
+        pool_users, pool_threads = defaultdict(int), dict()
+        with ThreadPoolExecutor(max_workers=max(1, len(to_run))) as executor:
+            while pending or running:
+                ready = [name for name in pending if all(input_name in outputs for input_name in self.stages[name].inputs)]
+                for name in sorted(ready, key=lambda name: (self.stages[name].threads is None, -depth[name])):
+                    stage = self.stages[name]
+                    if stage.threads is None:
+                        threads = free
+                        if threads < 1:
+                            continue
+                    elif stage.pool is not None and pool_users[stage.pool] > 0:
+                        threads = 0
+                    else:
+                        threads = min(stage.threads, n_threads)
+                        if threads > free:
+                            continue
+                    free -= threads
+                    if stage.pool is not None:
+                        pool_threads.setdefault(stage.pool, threads)
+                        pool_users[stage.pool] += 1
+                    pending.remove(name)
+                    inputs = [outputs[input_name] for input_name in stage.inputs]
+                    # in a copy of the current context, so the stage's span has the current span as parent
+                    job = executor.submit(contextvars.copy_context().run, self._execute, name, inputs,
+                                          threads if stage.threads is None else None)
+                    running[job] = (name, threads)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    name, threads = running.pop(job)
+                    outputs[name] = job.result()
+                    stage = self.stages[name]
+                    if stage.pool is None:
+                        free += threads
+                    else:
+                        pool_users[stage.pool] -= 1
+                        if pool_users[stage.pool] == 0:
+                            free += pool_threads.pop(stage.pool)
+
+    def run(self, 
+            until: Optional[str] = None, 
+            from_kind: Optional[str] = None,
+            n_threads: Optional[int] = None) -> dict[str, Any]:
+        """ Bring the selected stages up to date
+
+        Args:
+            until (Optional[str], optional): only stages of this kind and earlier kinds (see STAGE_KINDS),
+                e.g. 'featurize'. Defaults to None (all stages).
+            from_kind (Optional[str], optional): re-run the stages of this kind and later kinds even if cached,
+                e.g. 'report'. Earlier stages are loaded from the cache if they are up to date. Defaults to None
+                (only stages that changed).
+            n_threads (Optional[int], optional): thread budget of concurrently running independent stages
+                (see _run_concurrent). Defaults to None (one stage after the other).
+
+        Returns:
+            dict[str, Any]: outputs of the stages that were run or loaded, by stage name. Up to date stages that
+                no selected stage needs are neither run nor loaded.
+        """
+        last = STAGE_KINDS.index(until) if until is not None else len(STAGE_KINDS) - 1
+        first_forced = STAGE_KINDS.index(from_kind) if from_kind is not None else len(STAGE_KINDS)
+        selected = [name for name, stage in self.stages.items() if STAGE_KINDS.index(stage.kind) <= last]
+        force = {name for name in selected if STAGE_KINDS.index(self.stages[name].kind) >= first_forced}
+
+        to_run, to_load = self._plan(selected, force)
+        outputs = {name: self._load(name) for name in to_load}
+        if n_threads is None:
+            for name in to_run:
+                outputs[name] = self._execute(name, [outputs[input_name] for input_name in self.stages[name].inputs])
+        else:
+            self._run_concurrent(to_run, outputs, max(1, n_threads))
+        return outputs
@@ -0,0 +1,144 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from data_ingestion import ingest_and_pre_process_data
+from featurization import featurize_data
+from sparse_features import sparse_category_features
+from model import cate_inference, model_features
+from artifacts import load_model_artifact, check_feature_schema
+from main import write_ranking, write_shortlist
+from pathlib import Path
+from typing import Optional
+import polars as pl
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def parse_args():
+    parser = ArgumentParser(description="Score a member population with a trained CATE model artifact.")
+    parser.add_argument(
+        "--data-folder",
+        type=str,
+        required=True,
+        help="Path to the folder with the CSV files of the members to score."
+    )
+    parser.add_argument(
+        "--model-dir",
+        type=str,
+        required=True,
+        help="Path to the model artifact folder saved by main.py."
+    )
+    parser.add_argument(
+        "--output-folder",
+        type=str,
+        default="output/score",
+        help="Path to the folder to save the ranked prioritization csv."
+    )
+    parser.add_argument(
+        "--obs-window-end",
+        type=datetime.fromisoformat,
+        default=datetime(2025, 7, 16),
+        help="Start of day after the end of the observation window, e.g. 2025-07-16."
+    )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="Scan the CSVs lazily and run ingestion and featurization as a single streaming plan (bounded memory)."
+    )
+    parser.add_argument(
+        "--ingest-workers",
+        type=int,
+        default=4,
+        help="Number of CSV files ingested concurrently."
+    )
+    parser.add_argument(
+        "--outreach-size",
+        type=int,
+        default=None,
+        help="Also write shortlist.csv with the top members to reach out to (e.g. the size selected in the train report)."
+    )
+    parser.add_argument(
+        "--inference-chunk-size",
+        type=int,
+        default=100_000,
+        help="Score members in chunks of this size (bounded memory)."
+    )
+    parser.add_argument(
+        "--inference-workers",
+        type=int,
+        default=4,
+        help="Number of chunks scored concurrently."
+    )
+
+    return parser.parse_args()
+
+
+def score(data_folder: str | Path,
+          model_dir: str | Path,
+          output_folder: str | Path,
+          obs_window_end: datetime = datetime(2025, 7, 16),
+          lazy: bool = False,
+          ingest_workers: int = 1,
+          inference_chunk_size: Optional[int] = None,
+          inference_workers: int = 1,
+          outreach_size: Optional[int] = None) -> pl.DataFrame:
+    """ Ingest and featurize the scoring data, check it against the model's feature schema and rank it
+
+    Args:
+        data_folder (str | Path): folder with the CSV files of the members to score (labels are not needed)
+        model_dir (str | Path): model artifact folder
+        output_folder (str | Path):
+        obs_window_end (datetime, optional): Defaults to datetime(2025, 7, 16).
+        lazy (bool, optional): Defaults to False.
+        ingest_workers (int, optional): Defaults to 1.
+        inference_chunk_size (Optional[int], optional): see model.cate_inference. Defaults to None.
+        inference_workers (int, optional): see model.cate_inference. Defaults to 1.
+        outreach_size (Optional[int], optional): if given, also write the shortlist of this size. Defaults to None.
+
+    Returns:
+        pl.DataFrame: member_id and te (prioritization score)
+    """
+    cate_model, metadata = load_model_artifact(model_dir)
+    featurization_params = metadata.get('featurization', dict())
+
+    dfs = ingest_and_pre_process_data(data_folder, lazy=lazy, n_workers=ingest_workers)
+    features_w_labels = featurize_data(dfs,
+                                       obs_window_end=obs_window_end,
+                                       horizons=featurization_params.get('horizons', ()),
+                                       gap_stats=featurization_params.get('gap_stats', False))
+    check_feature_schema(metadata, model_features(features_w_labels))
+    sparse = None
+    if 'sparse_vocabularies' in featurization_params:
+        # the same sparse columns as in training
+        sparse = sparse_category_features(dfs, features_w_labels['member_id'], 
+                                          obs_window_end=obs_window_end,
+                                          vocabularies=featurization_params['sparse_vocabularies'])
+
+    te = cate_inference(cate_model, features_w_labels, inference_chunk_size, inference_workers, sparse_features=sparse)
+    scores_df = features_w_labels.select('member_id').with_columns(pl.Series('te', te))
+
+    output_path = Path(output_folder)
+    output_path.mkdir(parents=True, exist_ok=True)
+    write_ranking(output_path, scores_df)
+    if outreach_size is not None:
+        write_shortlist(output_path, scores_df, outreach_size)
+    return scores_df
+
+
+def main():
+    args = parse_args()
+    score(args.data_folder,
+          args.model_dir,
+          args.output_folder,
+          obs_window_end=args.obs_window_end,
+          lazy=args.lazy,
+          ingest_workers=args.ingest_workers,
+          inference_chunk_size=args.inference_chunk_size,
+          inference_workers=args.inference_workers,
+          outreach_size=args.outreach_size)
+
+
+if __name__ == "__main__":
+    main()
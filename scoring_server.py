@@ -0,0 +1,386 @@
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable
+import json
+import queue
+import tempfile
+import threading
+import time
+
+import numpy as np
+import polars as pl
+
+from artifacts import load_model_artifact, check_feature_schema
+from data_ingestion import ingest_and_pre_process_data, ingest_functions
+from featurization import (FEATURE_FAMILIES, extract_family_state, merge_family_states,
+                           family_features_from_state, join_family_features)
+from model import design_matrix, model_features
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# A long running scoring service. The per member aggregate state of every feature family (the mergeable state
+# of featurization.AGGREGATIONS, as in feature_store.py) is kept in memory and updated from event deltas, and
+# the features of the members in a score request are derived from it with the same functions as featurize_data.
+# The state is indexed by member_id (see IndexedState), so featurizing a batch costs time proportional to the batch.
+# Concurrent requests are queued and handled by a single batcher thread in micro-batches, so a burst of requests
+# costs one polars plan and one cate_model.effect call instead of one per request.
+#
+#   POST /score   {"member_ids": [1, 2]}                                  -> {"scores": {"1": 0.01, "2": -0.003}, "unknown": []}
+#   POST /events  {"source": "app_usage", "events": [{"member_id": 1, "timestamp": "2025-07-15T08:00:00"}]}
+#                 (source 'churn_labels' adds members, with their signup_date)  -> {"applied": 1}
+#   GET  /members?limit=1000                                               -> {"member_ids": [...]}
+#   GET  /health                                                           -> {"status": "ok", ...}
+
+
+class IndexedState:
+    """ A per member table, indexed by member_id, so the rows of a batch of members are found in time proportional
+        to the batch (and the rows added recently), not to the population. It is made of:
+        - the base, sorted by member_id, where the requested members are found by binary search (np.searchsorted)
+        - the delta, the rows added since, merged among themselves as they are added
+        Once the delta has max_delta_rows rows it is folded into a new base in a background thread, while the
+        old base and the folding delta keep serving, and the new base is swapped in when it's ready.
+        Not thread safe, only the batcher thread uses it.
+
+    Args:
+        base (pl.DataFrame): initial rows, with a member_id column
+        merge (Callable[[pl.LazyFrame], pl.LazyFrame]): merges rows (in order: base, then newer) into one per member
+        fold_executor (ThreadPoolExecutor): runs the folds
+        max_delta_rows (int, optional): Defaults to 100_000.
+    """
+    def __init__(self,
+                 base: pl.DataFrame,
+                 merge: Callable[[pl.LazyFrame], pl.LazyFrame],
+                 fold_executor: ThreadPoolExecutor,
+                 max_delta_rows: int = 100_000):
+        self.merge = merge
+        self.fold_executor = fold_executor
+        self.max_delta_rows = max_delta_rows
+        self._set_base(base.sort('member_id'))
+        self.delta = base.clear()
+        # delta being folded into the base, and the fold's job
+        self.folding = None
+        self.fold_job = None
+
+    def _set_base(self, base: pl.DataFrame):
+        self.base = base
+        self.keys = base['member_id'].to_numpy()
+
+    def _merged(self, frames: list[pl.DataFrame]) -> pl.DataFrame:
+        return self.merge(pl.concat(frames, how='vertical_relaxed').lazy()).collect()
+
+    def _swap_folded(self):
+        if self.fold_job is None or not self.fold_job.done():
+            return
+        try:
+            self._set_base(self.fold_job.result())
+        except Exception:
+            # the rows stay in the delta, and are folded again with the next fold
+            logger.exception("Failed to fold the delta into the base state")
+            self.delta = self._merged([self.folding, self.delta])
+        self.folding = self.fold_job = None
+
+    def add(self, rows: pl.DataFrame):
+        self._swap_folded()
+        self.delta = self._merged([self.delta, rows])
+        if self.fold_job is None and self.delta.height >= self.max_delta_rows:
+            self.folding, self.delta = self.delta, self.delta.clear()
+            base, folding = self.base, self.folding
+            self.fold_job = self.fold_executor.submit(
+                lambda: self.merge(pl.concat([base, folding], how='vertical_relaxed').lazy()).sort('member_id').collect())
+
+    def rows(self, member_ids: np.ndarray) -> pl.DataFrame:
+        """ merged rows of the members among member_ids (unique, uint32) that have any """
+        self._swap_folded()
+        positions = np.searchsorted(self.keys, member_ids)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == member_ids[found]
+        in_request = pl.col('member_id').is_in(pl.Series('member_id', member_ids))
+        recent = [frame.filter(in_request) for frame in (self.folding, self.delta) if frame is not None]
+        return self._merged([self.base[positions[found]]] + recent)
+
+    @property
+    def height(self) -> int:
+        """ number of rows, members added since the last fold may be counted twice """
+        return self.base.height + self.delta.height + (self.folding.height if self.folding is not None else 0)
+
+
+class MemberState:
+    """ Per member aggregate state of every feature family, and the members (churn_labels) that can be scored,
+        each an IndexedState. Not thread safe, only the batcher thread uses it.
+
+    Args:
+        dfs (dict[str, pl.DataFrame]): ingested dataframes (see data_ingestion), the initial state
+        obs_window_end (datetime): start of day after end of observation window, of the *_dt features
+        max_delta_rows (int, optional): see IndexedState. Defaults to 100_000.
+    """
+    def __init__(self, dfs: dict[str, pl.DataFrame], obs_window_end: datetime, max_delta_rows: int = 100_000):
+        self.obs_window_end = obs_window_end
+        fold_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-fold')
+        # a member added again replaces the previous one
+        self.members = IndexedState(dfs['churn_labels'],
+                                    lambda rows: rows.unique('member_id', keep='last', maintain_order=True),
+                                    fold_executor, max_delta_rows)
+        self.states = {family.prefix: IndexedState(extract_family_state(dfs[family.source].lazy(), family).collect(),
+                                                   partial(merge_family_states, family=family),
+                                                   fold_executor, max_delta_rows)
+                       for family in FEATURE_FAMILIES.values()}
+
+    def apply_events(self, source: str, events: pl.DataFrame):
+        """ add ingested (cleaned) events of a source """
+        if source == 'churn_labels':
+            self.members.add(events)
+            return
+        for family in FEATURE_FAMILIES.values():
+            if family.source == source:
+                self.states[family.prefix].add(extract_family_state(events.lazy(), family).collect())
+
+    def features(self, member_ids: list[int]) -> pl.DataFrame:
+        """ feature matrix (same columns as featurize_data) of the known members among member_ids """
+        member_ids = np.unique(np.asarray(member_ids, dtype=np.uint32))
+        family_features = [(family.columns(),
+                            family_features_from_state(self.states[family.prefix].rows(member_ids).lazy(), family, 
+                                                       self.obs_window_end))
+                           for family in FEATURE_FAMILIES.values()]
+        return join_family_features(self.members.rows(member_ids), family_features, self.obs_window_end).collect()
+
+
+class MicroBatcher:
+    """ Queue of score and event requests, handled in order by a single thread. Each batch is the requests that
+        arrive until max_batch_size members are waiting or max_wait_ms passed since the first one. Its events
+        are applied first, then all its members are featurized and scored together.
+
+    Args:
+        cate_model: fitted CATE model (anything with effect(X), e.g. model.DistilledCATE)
+        state (MemberState):
+        max_batch_size (int, optional): Defaults to 256.
+        max_wait_ms (float, optional): Defaults to 2.
+    """
+    def __init__(self, cate_model, state: MemberState, max_batch_size: int = 256, max_wait_ms: float = 2):
+        self.cate_model = cate_model
+        self.state = state
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.n_batches = 0
+        self.n_scored = 0
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def score(self, member_ids: list[int]) -> Future:
+        """ Future of {member_id: te} of the known members """
+        return self._submit('score', member_ids)
+
+    def apply_events(self, source: str, events: pl.DataFrame) -> Future:
+        """ Future of the number of events applied """
+        return self._submit('events', (source, events))
+
+    def _submit(self, kind: str, payload: Any) -> Future:
+        future = Future()
+        self.requests.put((kind, payload, future))
+        return future
+
+    def _next_batch(self) -> list[tuple[str, Any, Future]]:
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait_s
+        n_members = len(batch[0][1]) if batch[0][0] == 'score' else 0
+        while n_members < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            batch.append(request)
+            if request[0] == 'score':
+                n_members += len(request[1])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            for _, (source, events), future in [request for request in batch if request[0] == 'events']:
+                try:
+                    self.state.apply_events(source, events)
+                    future.set_result(len(events))
+                except Exception as e:
+                    future.set_exception(e)
+
+            score_requests = [request for request in batch if request[0] == 'score']
+            if not score_requests:
+                continue
+            try:
+                scores = self._score([member_id for _, ids, _ in score_requests for member_id in ids])
+                for _, ids, future in score_requests:
+                    future.set_result({member_id: scores.get(member_id) for member_id in ids})
+            except Exception:
+                # score the requests one by one, so only the ones causing the error fail
+                for _, ids, future in score_requests:
+                    try:
+                        scores = self._score(ids)
+                        future.set_result({member_id: scores.get(member_id) for member_id in ids})
+                    except Exception as e:
+                        future.set_exception(e)
+
+    def _score(self, member_ids: list[int]) -> dict[int, float]:
+        """ te of the known members among member_ids """
+        features = self.state.features(member_ids)
+        te = np.ravel(self.cate_model.effect(design_matrix(model_features(features)))) if features.height else []
+        scores = dict(zip(features['member_id'].to_list(), map(float, te)))
+        self.n_batches += 1
+        self.n_scored += len(scores)
+        return scores
+
+
+def _ingest_events(source: str, events: list[dict]) -> pl.DataFrame:
+    """ clean events posted as json rows with the source's ingest function (typing, null and relevance filters) """
+    if source not in ingest_functions:
+        raise ValueError(f"Unknown source {source}, expected one of {list(ingest_functions)}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = Path(tmp_dir) / f'{source}.csv'
+        pl.DataFrame(events).write_csv(csv_path)
+        return ingest_functions[source](csv_path)
+
+
+def _parse_member_ids(member_ids: Any) -> list[int]:
+    """ member ids of a score request, raises ValueError unless they are a list of uint32 ints """
+    if not isinstance(member_ids, list):
+        raise ValueError("member_ids must be a list")
+    for member_id in member_ids:
+        # bool is an int subclass
+        if not isinstance(member_id, int) or isinstance(member_id, bool) or not 0 <= member_id < 2**32:
+            raise ValueError(f"Invalid member_id {member_id!r}, expected an integer in [0, 2^32)")
+    return member_ids
+
+
+def make_handler(batcher: MicroBatcher, model_version: str, request_timeout_s: float = 10):
+    """ request handler class of the scoring server """
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send_json(self, status: int, body: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _read_json(self) -> dict:
+            return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path == '/health':
+                self._send_json(200, {'status': 'ok',
+                                      'model_version': model_version,
+                                      'n_members': batcher.state.members.height,
+                                      'n_batches': batcher.n_batches,
+                                      'n_scored': batcher.n_scored})
+            elif path == '/members':
+                params = dict(param.split('=', 1) for param in query.split('&') if '=' in param)
+                member_ids = batcher.state.members.base['member_id'].head(int(params.get('limit', 1000))).to_list()
+                self._send_json(200, {'member_ids': member_ids})
+            else:
+                self._send_json(404, {'error': f'unknown path {path}'})
+
+        def do_POST(self):
+            try:
+                body = self._read_json()
+                if self.path == '/score':
+                    member_ids = _parse_member_ids(body['member_ids'])
+                    scores = batcher.score(member_ids).result(timeout=request_timeout_s)
+                    self._send_json(200, {'model_version': model_version,
+                                          'scores': {str(k): v for k, v in scores.items() if v is not None},
+                                          'unknown': [k for k, v in scores.items() if v is None]})
+                elif self.path == '/events':
+                    events = _ingest_events(body['source'], body['events'])
+                    applied = batcher.apply_events(body['source'], events).result(timeout=request_timeout_s)
+                    self._send_json(200, {'applied': applied})
+                else:
+                    self._send_json(404, {'error': f'unknown path {self.path}'})
+            except (KeyError, ValueError, pl.exceptions.PolarsError) as e:
+                self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                logger.exception(f"Failed to handle {self.path}")
+                self._send_json(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            # no log line per request
+            pass
+
+    return ScoringHandler
+
+
+def build_server(data_folder: str | Path,
+                 model_dir: str | Path,
+                 host: str = '127.0.0.1',
+                 port: int = 8080,
+                 obs_window_end: datetime = datetime(2025, 7, 16),
+                 max_batch_size: int = 256,
+                 max_wait_ms: float = 2) -> ThreadingHTTPServer:
+    """ Load the model and the initial member state, and bind the scoring server (see module comment)
+
+    Args:
+        data_folder (str | Path): folder with the CSVs of the members and their events so far
+        model_dir (str | Path): model artifact saved by main.py (preferably with --distill, for low latency)
+        host (str, optional): Defaults to '127.0.0.1'.
+        port (int, optional): Defaults to 8080.
+        obs_window_end (datetime, optional): see featurize_data. Defaults to datetime(2025, 7, 16).
+        max_batch_size (int, optional): see MicroBatcher. Defaults to 256.
+        max_wait_ms (float, optional): see MicroBatcher. Defaults to 2.
+
+    Returns:
+        ThreadingHTTPServer: call serve_forever() to start serving
+    """
+    cate_model, metadata = load_model_artifact(model_dir)
+    featurization_params = metadata.get('featurization', dict())
+    # windowed and per code features are not derived from the mergeable state
+    if featurization_params.get('horizons') or featurization_params.get('gap_stats') or 'sparse_vocabularies' in featurization_params:
+        raise ValueError("The scoring server only supports models trained without --horizons, --gap-stats and --sparse-features")
+
+    state = MemberState(ingest_and_pre_process_data(data_folder, n_workers=4), obs_window_end)
+    check_feature_schema(metadata, model_features(state.features(state.members.base['member_id'].head(1).to_list())))
+    batcher = MicroBatcher(cate_model, state, max_batch_size, max_wait_ms)
+
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, metadata['model_version']))
+    server.daemon_threads = True
+    logger.info(f"Scoring server for {state.members.height} members with model version {metadata['model_version']} "
+                f"listening on http://{host}:{port}")
+    return server
+
+
+def parse_args():
+    parser = ArgumentParser(description="Serve prioritization scores of members, updated with new events.")
+    parser.add_argument("--data-folder", type=str, required=True,
+                        help="Path to the folder with the CSV files of the members and their events so far.")
+    parser.add_argument("--model-dir", type=str, required=True, help="Path to the model artifact folder saved by main.py.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--obs-window-end", type=datetime.fromisoformat, default=datetime(2025, 7, 16),
+                        help="Start of day after the end of the observation window, e.g. 2025-07-16.")
+    parser.add_argument("--max-batch-size", type=int, default=256, help="Maximum members scored in one micro-batch.")
+    parser.add_argument("--max-wait-ms", type=float, default=2,
+                        help="Maximum time a request waits for other requests to join its micro-batch.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = build_server(args.data_folder, args.model_dir, args.host, args.port, args.obs_window_end,
+                          args.max_batch_size, args.max_wait_ms)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down scoring server")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Optional, Sequence
+import multiprocessing
+import os
+import tempfile
+import time
+
+import polars as pl
+
+from featurization import featurize_data
+from instrumentation import span, record
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Featurization of member-hash shards in parallel processes. Every source is partitioned on disk by a hash of
+# member_id, so all events of a member are in the same shard and each shard is featurized independently,
+# with the same plan (featurize_data) as the whole data, within the memory of one shard.
+
+# row of each member in churn_labels, to restore its order after featurizing the shards
+_ROW_COLUMN = '_row'
+
+
+def _shard_expr(n_shards: int) -> pl.Expr:
+    return pl.col('member_id').hash(seed=0) % n_shards
+
+
+def shard_sources(dfs: dict[str, pl.DataFrame | pl.LazyFrame], shard_dir: str | Path, n_shards: int) -> list[Path]:
+    """ Partition every source by a hash of member_id into <shard_dir>/shard-<i>/<source>.arrow
+
+    Args:
+        dfs (dict[str, pl.DataFrame | pl.LazyFrame]): ingested dataframes. Lazy ones are streamed to the shards
+            in one pass (a sink per shard, sharing the scan), so they are never collected in memory.
+        shard_dir (str | Path):
+        n_shards (int):
+
+    Returns:
+        list[Path]: shard folders, each with every source (possibly empty, with the same schema)
+    """
+    shard_paths = [Path(shard_dir) / f'shard-{i:04d}' for i in range(n_shards)]
+    for shard_path in shard_paths:
+        shard_path.mkdir(parents=True, exist_ok=True)
+
+    for name, df in dfs.items():
+        if name == 'churn_labels':
+            df = df.with_row_index(_ROW_COLUMN)
+        if isinstance(df, pl.LazyFrame):
+            # one sink per shard, executed together: the streaming engine shares the scan of the common plan
+            # between the sinks, so the source is read once (and in order, so events stay sorted)
+            sharded = df.with_columns(_shard_expr(n_shards).alias('_shard'))
+            sinks = [sharded.filter(pl.col('_shard') == i).drop('_shard').sink_ipc(shard_path / f'{name}.arrow', lazy=True)
+                     for i, shard_path in enumerate(shard_paths)]
+            pl.collect_all(sinks, engine='streaming')
+        else:
+            shards = df.with_columns(_shard_expr(n_shards).alias('_shard')).partition_by('_shard', as_dict=True, include_key=False)
+            for i, shard_path in enumerate(shard_paths):
+                shards.get((i,), df.clear()).write_ipc(shard_path / f'{name}.arrow')
+    return shard_paths
+
+
+def _init_worker(polars_threads: int):
+    # polars creates its thread pool on first use, so the workers' pools share the cores
+    os.environ['POLARS_MAX_THREADS'] = str(polars_threads)
+
+
+def _featurize_shard(shard_path: Path,
+                     obs_window_end: datetime,
+                     fill_nulls: bool,
+                     horizons: Sequence[int],
+                     gap_stats: bool) -> Path:
+    """ featurize one shard (runs in a worker process), the features are written next to its sources """
+    dfs = {path.stem: pl.read_ipc(path) for path in shard_path.glob('*.arrow') if path.stem != 'features'}
+    features = featurize_data(dfs, obs_window_end, fill_nulls, horizons=horizons, gap_stats=gap_stats)
+    features.write_ipc(shard_path / 'features.arrow')
+    return shard_path / 'features.arrow'
+
+
+def featurize_sharded(dfs: dict[str, pl.DataFrame | pl.LazyFrame],
+                      n_shards: int,
+                      n_workers: Optional[int] = None,
+                      n_threads: Optional[int] = None,
+                      shard_dir: Optional[str | Path] = None,
+                      obs_window_end: datetime = datetime(2025, 7, 16),
+                      fill_nulls: bool = True,
+                      horizons: Sequence[int] = (),
+                      gap_stats: bool = False) -> pl.DataFrame:
+    """ featurize_data on member-hash shards of the sources in parallel processes. The result is the same as
+        featurize_data(dfs, ...): the shards' features have an identical schema and are concatenated in churn_labels order.
+
+    Args:
+        dfs (dict[str, pl.DataFrame | pl.LazyFrame]): ingested dataframes
+        n_shards (int): more shards bound the memory of each worker to a smaller part of the event history
+        n_workers (Optional[int], optional): worker processes. Defaults to None (n_threads, at most n_shards).
+        n_threads (Optional[int], optional): threads of all the workers, split between their polars pools, e.g.
+            the stage's share of a thread budget. Defaults to None (number of cores).
+        shard_dir (Optional[str | Path], optional): folder of the shards, kept after featurization.
+            Defaults to None (temporary folder, removed when done).
+        obs_window_end (datetime, optional): see featurize_data. Defaults to datetime(2025, 7, 16).
+        fill_nulls (bool, optional): see featurize_data. Defaults to True.
+        horizons (Sequence[int], optional): see featurize_data. Defaults to ().
+        gap_stats (bool, optional): see featurize_data. Defaults to False.
+
+    Returns:
+        pl.DataFrame:
+    """
+    n_threads = n_threads or os.cpu_count() or 1
+    n_workers = min(n_shards, n_workers or n_threads)
+    with tempfile.TemporaryDirectory() as tmp_dir, span('featurize_sharded', n_shards=n_shards, n_workers=n_workers):
+        start = time.perf_counter()
+        shard_paths = shard_sources(dfs, shard_dir if shard_dir is not None else tmp_dir, n_shards)
+        logger.info(f"Partitioned sources into {n_shards} shards in {time.perf_counter() - start:.2f}s")
+
+        # spawned, not forked: forking a process that already runs polars' thread pool can deadlock
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(max(1, n_threads // n_workers),)) as executor:
+            featurize_shard = partial(_featurize_shard, obs_window_end=obs_window_end, fill_nulls=fill_nulls,
+                                      horizons=tuple(horizons), gap_stats=gap_stats)
+            feature_paths = list(executor.map(featurize_shard, shard_paths))
+
+        # vertical concat checks that the shards' schemas are identical
+        features = (pl.concat([pl.read_ipc(path) for path in feature_paths], how='vertical')
+                    .sort(_ROW_COLUMN)
+                    .drop(_ROW_COLUMN))
+        record(rows_out=len(features))
+    logger.info(f"Featurized {n_shards} shards with {n_workers} workers in {time.perf_counter() - start:.2f}s")
+    return features
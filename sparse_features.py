@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+import json
+
+import numpy as np
+import polars as pl
+import scipy.sparse as sp
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Per member x category (ICD code, web page title) features, built directly as a sparse CSR matrix.
+# Unlike featurization._extract_claims_features (a dense pivot with a column per code, null-filled with 0),
+# memory grows with the number of (member, category) pairs that occur, not members x vocabulary size.
+
+
+@dataclass(frozen=True)
+class CategoryFamily:
+    """ Declaration of per category features of an event source
+
+    Args:
+        source (str): name of the ingested dataframe (e.g. 'claims')
+        category_col (str): column with the categories (e.g. 'icd_code')
+        ts_col (str): timestamp column of the source
+        prefix (str): feature name prefix, e.g. 'dx' -> dx_count[I10], dx_recency[I10]
+    """
+    source: str
+    category_col: str
+    ts_col: str
+    prefix: str
+
+
+CATEGORY_FAMILIES: list[CategoryFamily] = [
+    CategoryFamily(source='claims', category_col='icd_code', ts_col='diagnosis_date', prefix='dx'),
+    CategoryFamily(source='web_visits', category_col='title', ts_col='timestamp', prefix='wv'),
+]
+
+_MATRIX_FILE_NAME = 'sparse_features.npz'
+_METADATA_FILE_NAME = 'sparse_features.json'
+
+
+@dataclass
+class SparseFeatures:
+    """ sparse features, rows aligned with the members of the dense feature matrix
+
+    Args:
+        matrix (sp.csr_matrix): float32, members x features
+        feature_names (list[str]):
+        vocabularies (dict[str, list[str]]): categories of each family (by prefix), in column order.
+            Pass them to sparse_category_features to build the same columns for other data (e.g. test, scoring).
+    """
+    matrix: sp.csr_matrix
+    feature_names: list[str]
+    vocabularies: dict[str, list[str]]
+
+    def save(self, out_dir: str | Path):
+        out_dir = Path(out_dir)
+        sp.save_npz(out_dir / _MATRIX_FILE_NAME, self.matrix, compressed=False)
+        (out_dir / _METADATA_FILE_NAME).write_text(json.dumps({'feature_names': self.feature_names,
+                                                               'vocabularies': self.vocabularies}))
+
+    @classmethod
+    def load(cls, out_dir: str | Path) -> Optional['SparseFeatures']:
+        """ the sparse features saved in out_dir, None if there are none """
+        out_dir = Path(out_dir)
+        if not (out_dir / _MATRIX_FILE_NAME).exists():
+            return None
+        metadata = json.loads((out_dir / _METADATA_FILE_NAME).read_text())
+        return cls(sp.load_npz(out_dir / _MATRIX_FILE_NAME).tocsr(), metadata['feature_names'], metadata['vocabularies'])
+
+
+def build_vocabularies(dfs: dict[str, pl.DataFrame | pl.LazyFrame],
+                       families: list[CategoryFamily] = CATEGORY_FAMILIES,
+                       min_count: int = 1) -> dict[str, list[str]]:
+    """ sorted categories of each family with at least min_count events, by family prefix """
+    vocabularies = dict()
+    for family in families:
+        counts = (dfs[family.source].lazy()
+                  .group_by(pl.col(family.category_col).cast(pl.String))
+                  .agg(pl.len().alias('count'))
+                  .filter((pl.col('count') >= min_count) & pl.col(family.category_col).is_not_null())
+                  .collect())
+        vocabularies[family.prefix] = sorted(counts[family.category_col].to_list())
+    return vocabularies
+
+
+def _family_block(events: pl.LazyFrame,
+                  family: CategoryFamily,
+                  rows: pl.LazyFrame,
+                  vocabulary: list[str],
+                  obs_window_end: datetime) -> tuple[sp.csr_matrix, sp.csr_matrix]:
+    """ (count, recency) CSR blocks of a family, members x vocabulary """
+    columns = pl.DataFrame({family.category_col: vocabulary}, schema={family.category_col: pl.String}).with_row_index('col')
+    # one row per (member, category) that occurs, categories outside the vocabulary are dropped
+    pairs = (events
+             .group_by('member_id', pl.col(family.category_col).cast(pl.String))
+             .agg(pl.len().alias('count'), pl.col(family.ts_col).max().alias('last'))
+             .join(rows, on='member_id', how='inner')
+             .join(columns.lazy(), on=family.category_col, how='inner')
+             .select('row',
+                     'col',
+                     pl.col('count').cast(pl.Float32),
+                     # 1 for an event on the last day, decaying with the days since, 0 (not stored) if never
+                     (1 / (1 + (obs_window_end - pl.col('last')).dt.total_days().clip(lower_bound=0))).cast(pl.Float32).alias('recency'))
+             .collect())
+    shape = (rows.select(pl.len()).collect().item(), len(vocabulary))
+    index = (pairs['row'].to_numpy(), pairs['col'].to_numpy())
+    return (sp.csr_matrix((pairs['count'].to_numpy(), index), shape=shape),
+            sp.csr_matrix((pairs['recency'].to_numpy(), index), shape=shape))
+
+
+def sparse_category_features(dfs: dict[str, pl.DataFrame | pl.LazyFrame],
+                             member_ids: pl.Series,
+                             obs_window_end: datetime = datetime(2025, 7, 16),
+                             vocabularies: Optional[dict[str, list[str]]] = None,
+                             families: list[CategoryFamily] = CATEGORY_FAMILIES,
+                             min_count: int = 1) -> SparseFeatures:
+    """ Event count and recency per member and category (e.g. ICD code) of each family, as a CSR matrix,
+        never materialized densely.
+
+    Args:
+        dfs (dict[str, pl.DataFrame | pl.LazyFrame]): ingested dataframes
+        member_ids (pl.Series): member_id of each row, e.g. of the dense feature matrix
+        obs_window_end (datetime, optional): start of day after end of observation window. Defaults to datetime(2025, 7, 16).
+        vocabularies (Optional[dict[str, list[str]]], optional): categories of each family, e.g. of the train data,
+            so test and scoring data get the same columns. Defaults to None (built from dfs, see build_vocabularies).
+        families (list[CategoryFamily], optional): Defaults to CATEGORY_FAMILIES.
+        min_count (int, optional): with vocabularies=None, drop categories with fewer events. Defaults to 1.
+
+    Returns:
+        SparseFeatures:
+    """
+    if vocabularies is None:
+        vocabularies = build_vocabularies(dfs, families, min_count)
+    rows = pl.LazyFrame({'member_id': member_ids}).with_row_index('row')
+
+    blocks, feature_names = [], []
+    for family in families:
+        vocabulary = vocabularies[family.prefix]
+        counts, recency = _family_block(dfs[family.source].lazy(), family, rows, vocabulary, obs_window_end)
+        blocks += [counts, recency]
+        feature_names += [f'{family.prefix}_count[{category}]' for category in vocabulary]
+        feature_names += [f'{family.prefix}_recency[{category}]' for category in vocabulary]
+
+    matrix = sp.hstack(blocks, format='csr', dtype=np.float32)
+    logger.info(f"Built {matrix.shape[1]} sparse features for {matrix.shape[0]} members "
+                f"({matrix.nnz} non-zeros, density {matrix.nnz / max(1, matrix.shape[0] * matrix.shape[1]):.4f})")
+    return SparseFeatures(matrix, feature_names, vocabularies)
@@ -0,0 +1,199 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import polars as pl
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Synthetic member populations in the format of the exercise CSVs, with a planted heterogeneous
+# treatment effect of outreach on churn, for benchmarking the pipeline at any scale.
+
+RELEVANT_TITLES = ['Healthy eating guide', 'Mediterranean diet', 'Restorative sleep tips', 'Aerobic exercise',
+                   'Cardiometabolic health', 'Weight management', 'Stress reduction', 'Sleep hygiene',
+                   'HbA1c targets', 'Cardio workouts', 'High-fiber meals', 'Cholesterol friendly foods',
+                   'Hypertension basics', 'Meditation guide', 'Exercise routines', 'Diabetes management',
+                   'Lowering blood pressure', 'Strength training basics']
+IRRELEVANT_TITLES = ['Sports news', 'Celebrity gossip', 'Travel deals', 'Gaming reviews', 'Stock market today',
+                     'Car reviews', 'Movie trailers', 'Fashion trends']
+ICD_CODES = ['E11.9', 'I10', 'Z71.3', 'J06.9', 'M54.5', 'K21.9', 'F41.1', 'R51', 'E78.5', 'N39.0']
+# codes of the client brief, members with them respond to outreach the most
+CHRONIC_CODES = ['E11.9', 'I10', 'Z71.3']
+
+# mean number of events per member, per source
+DEFAULT_EVENTS_PER_MEMBER = {'app_usage': 30.0, 'web_visits': 10.0, 'claims': 2.0}
+
+_MEMBERS_PER_CHUNK = 500_000
+
+
+def _format_ts(ts_us: np.ndarray, fmt: str) -> pl.Series:
+    return pl.Series(ts_us, dtype=pl.Int64).cast(pl.Datetime('us')).dt.strftime(fmt)
+
+
+def _random_ts(rng: np.random.Generator, n: int, start: datetime, end: datetime) -> np.ndarray:
+    start_us, end_us = int(start.timestamp() * 1e6), int(end.timestamp() * 1e6)
+    return rng.integers(start_us, end_us, size=n)
+
+
+def _generate_chunk(rng: np.random.Generator,
+                    member_ids: np.ndarray,
+                    events_per_member: dict[str, float],
+                    start: datetime,
+                    end: datetime) -> tuple[dict[str, pl.DataFrame], np.ndarray]:
+    """ all sources of a chunk of members, and their true effect of outreach on P(churn) """
+    n = member_ids.size
+    # members differ in engagement, event counts are gamma-poisson (overdispersed)
+    engagement = rng.gamma(shape=2.0, scale=0.5, size=n)
+
+    # app usage
+    app_counts = rng.poisson(events_per_member['app_usage'] * engagement)
+    app_usage = pl.DataFrame({
+        'member_id': np.repeat(member_ids, app_counts),
+        'timestamp': _format_ts(_random_ts(rng, app_counts.sum(), start, end), '%Y-%m-%d %H:%M:%S'),
+    }).select('member_id', pl.lit('session').alias('event_type'), 'timestamp')
+
+    # web visits, including irrelevant titles
+    web_counts = rng.poisson(events_per_member['web_visits'] * engagement)
+    n_visits = web_counts.sum()
+    is_relevant = rng.random(n_visits) < 0.6
+    titles = np.where(is_relevant,
+                      np.array(RELEVANT_TITLES)[rng.integers(0, len(RELEVANT_TITLES), n_visits)],
+                      np.array(IRRELEVANT_TITLES)[rng.integers(0, len(IRRELEVANT_TITLES), n_visits)])
+    web_visits = pl.DataFrame({
+        'member_id': np.repeat(member_ids, web_counts),
+        'title': titles,
+        'timestamp': _format_ts(_random_ts(rng, n_visits, start, end), '%Y-%m-%d %H:%M:%S'),
+    }).select(
+        'member_id',
+        (pl.lit('https://example.com/') + pl.col('title').str.to_lowercase().str.replace_all(' ', '-')).alias('url'),
+        'title',
+        (pl.lit('Article about ') + pl.col('title')).alias('description'),
+        'timestamp',
+    )
+    relevant_visits = np.bincount(np.repeat(np.arange(n), web_counts)[is_relevant], minlength=n)
+
+    # claims
+    claim_counts = rng.poisson(events_per_member['claims'], size=n)
+    claim_members = np.repeat(np.arange(n), claim_counts)
+    codes = np.array(ICD_CODES)[rng.integers(0, len(ICD_CODES), claim_members.size)]
+    claims = pl.DataFrame({
+        'member_id': member_ids[claim_members],
+        'icd_code': codes,
+        'diagnosis_date': _format_ts(_random_ts(rng, claim_members.size, start, end), '%Y-%m-%d'),
+    })
+    has_chronic = np.bincount(claim_members[np.isin(codes, CHRONIC_CODES)], minlength=n) > 0
+
+    # churn labels with a planted heterogeneous treatment effect: outreach reduces churn most for
+    # members with chronic codes and low app engagement, and not at all for highly engaged members
+    signup_us = _random_ts(rng, n, datetime(2022, 1, 1), start)
+    outreach = (rng.random(n) < 0.3).astype(np.int64)
+    base_logit = 0.3 - 0.4 * np.log1p(app_counts) - 0.2 * np.log1p(relevant_visits) + 0.3 * has_chronic
+    effect_logit = -(0.3 + 1.2 * has_chronic) * (app_counts < np.median(app_counts))
+
+    def p_churn(treated: np.ndarray) -> np.ndarray:
+        return 1 / (1 + np.exp(-(base_logit + treated * effect_logit)))
+
+    churn = (rng.random(n) < p_churn(outreach)).astype(np.int64)
+    churn_labels = pl.DataFrame({
+        'member_id': member_ids,
+        'signup_date': _format_ts(signup_us, '%Y-%m-%d'),
+        'churn': churn,
+        'outreach': outreach,
+    })
+    # true effect of outreach on P(no churn), what the CATE model estimates
+    true_effect = p_churn(np.zeros(n)) - p_churn(np.ones(n))
+
+    return ({'app_usage': app_usage, 'web_visits': web_visits, 'claims': claims, 'churn_labels': churn_labels},
+            true_effect)
+
+
+def generate_dataset(out_dir: str | Path,
+                     n_members: int,
+                     events_per_member: dict[str, float] = DEFAULT_EVENTS_PER_MEMBER,
+                     file_prefix: str = '',
+                     seed: int = 0,
+                     start: datetime = datetime(2025, 1, 1),
+                     end: datetime = datetime(2025, 7, 16)) -> dict[str, int]:
+    """ Write app_usage, web_visits, claims and churn_labels CSVs of a synthetic population, in chunks of members
+        so any size fits in memory, and true_effect.parquet with each member's planted treatment effect.
+
+    Args:
+        out_dir (str | Path):
+        n_members (int):
+        events_per_member (dict[str, float], optional): mean events per member, per source. Defaults to DEFAULT_EVENTS_PER_MEMBER.
+        file_prefix (str, optional): e.g. 'test_' for a test set. Defaults to ''.
+        seed (int, optional): Defaults to 0.
+        start (datetime, optional): start of the observation window. Defaults to datetime(2025, 1, 1).
+        end (datetime, optional): end of the observation window. Defaults to datetime(2025, 7, 16).
+
+    Returns:
+        dict[str, int]: number of rows written per source
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    events_per_member = {**DEFAULT_EVENTS_PER_MEMBER, **events_per_member}
+    rng = np.random.default_rng(seed)
+
+    sources = ['app_usage', 'web_visits', 'claims', 'churn_labels']
+    files = {source: open(out_dir / f'{file_prefix}{source}.csv', 'wb') for source in sources}
+    n_rows = {source: 0 for source in sources}
+    true_effects = []
+    try:
+        for offset in range(0, n_members, _MEMBERS_PER_CHUNK):
+            member_ids = np.arange(offset, min(n_members, offset + _MEMBERS_PER_CHUNK), dtype=np.int64) + 1
+            chunk, true_effect = _generate_chunk(rng, member_ids, events_per_member, start, end)
+            for source, df in chunk.items():
+                df.write_csv(files[source], include_header=offset == 0)
+                n_rows[source] += len(df)
+            true_effects.append(pl.DataFrame({'member_id': member_ids, 'true_effect': true_effect}))
+    finally:
+        for f in files.values():
+            f.close()
+    pl.concat(true_effects).write_parquet(out_dir / 'true_effect.parquet')
+
+    logger.info(f"Wrote synthetic dataset of {n_members} members to {out_dir}: {n_rows}")
+    return n_rows
+
+
+def generate_train_test(data_folder: str | Path,
+                        n_members: int,
+                        n_test_members: int | None = None,
+                        events_per_member: dict[str, float] = DEFAULT_EVENTS_PER_MEMBER,
+                        seed: int = 0) -> dict[str, dict[str, int]]:
+    """ train and test folders in the layout main.py expects (test files with the 'test_' prefix) """
+    data_folder = Path(data_folder)
+    return {
+        'train': generate_dataset(data_folder / 'train', n_members, events_per_member, seed=seed),
+        'test': generate_dataset(data_folder / 'test', n_test_members or n_members, events_per_member,
+                                 file_prefix='test_', seed=seed + 1),
+    }
+
+
+def parse_args():
+    parser = ArgumentParser(description="Generate a synthetic train/test dataset in the exercise CSV format.")
+    parser.add_argument("--data-folder", type=str, required=True, help="Folder to write the train and test folders to.")
+    parser.add_argument("--n-members", type=int, default=10_000, help="Number of train members.")
+    parser.add_argument("--n-test-members", type=int, default=None, help="Number of test members. Defaults to --n-members.")
+    parser.add_argument("--app-usage-per-member", type=float, default=DEFAULT_EVENTS_PER_MEMBER['app_usage'])
+    parser.add_argument("--web-visits-per-member", type=float, default=DEFAULT_EVENTS_PER_MEMBER['web_visits'])
+    parser.add_argument("--claims-per-member", type=float, default=DEFAULT_EVENTS_PER_MEMBER['claims'])
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    generate_train_test(args.data_folder,
+                        args.n_members,
+                        args.n_test_members,
+                        events_per_member={'app_usage': args.app_usage_per_member,
+                                           'web_visits': args.web_visits_per_member,
+                                           'claims': args.claims_per_member},
+                        seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
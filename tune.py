@@ -0,0 +1,225 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+from typing import Optional
+import json
+import math
+import multiprocessing
+import os
+import random
+
+import numpy as np
+import polars as pl
+from sklearn.model_selection import StratifiedKFold
+
+from data_ingestion import ingest_and_pre_process_data
+from featurization import featurize_data
+from model import train_cate, evaluate_cate, DEFAULT_LGBM_PARAMS
+from uplift_metrics import qini_auc_score
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# search space of the XLearner's LightGBM settings
+PARAM_GRID = {
+    'max_depth': [3, 5, 7],
+    'n_estimators': [200, 500, 1000],
+    'learning_rate': [0.03, 0.1],
+    'reg_alpha': [0.1, 1.0, 10.0],
+    'reg_lambda': [0.1, 1.0, 10.0],
+    'min_child_samples': [20, 100],
+}
+
+
+def parse_args():
+    parser = ArgumentParser(description="Cross-validated hyperparameter search of the CATE model.")
+    parser.add_argument(
+        "--data-folder",
+        type=str,
+        required=True,
+        help="Path to the folder containing the train folder with all the CSV files."
+    )
+    parser.add_argument(
+        "--output-folder",
+        type=str,
+        default="output/tune",
+        help="Path to the folder to save the leaderboard and best config."
+    )
+    parser.add_argument(
+        "--search",
+        choices=['grid', 'random'],
+        default='random',
+        help="Evaluate the full PARAM_GRID or a random sample of it."
+    )
+    parser.add_argument(
+        "--n-candidates",
+        type=int,
+        default=27,
+        help="Number of candidates of a random search."
+    )
+    parser.add_argument(
+        "--n-folds",
+        type=int,
+        default=5,
+        help="Number of stratified (outreach x churn) folds."
+    )
+    parser.add_argument(
+        "--eta",
+        type=int,
+        default=3,
+        help="Successive halving: keep the best 1/eta candidates and give them eta times more folds at each rung."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of (candidate, fold) fits run in parallel processes."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--horizons",
+        type=int,
+        nargs="*",
+        default=[],
+        help="Windowed features horizons, as in main.py."
+    )
+    parser.add_argument(
+        "--gap-stats",
+        action="store_true",
+        help="Inter-event gap features, as in main.py."
+    )
+
+    return parser.parse_args()
+
+
+def _candidates(search: str, n_candidates: int, seed: int) -> list[dict]:
+    grid = [dict(zip(PARAM_GRID, values)) for values in product(*PARAM_GRID.values())]
+    if search == 'random' and n_candidates < len(grid):
+        grid = random.Random(seed).sample(grid, n_candidates)
+    return grid
+
+
+def _stratified_folds(features_w_labels: pl.DataFrame, n_folds: int, seed: int) -> list[tuple[np.ndarray, np.ndarray]]:
+    """ (train, validation) row indices, stratified on outreach x churn """
+    strata = (2 * features_w_labels['outreach'] + features_w_labels['churn']).to_numpy()
+    folds = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    return list(folds.split(np.zeros(len(strata)), strata))
+
+
+def _evaluate_fold(features_path: Path, params: dict, train_idx: np.ndarray, val_idx: np.ndarray, n_jobs: int) -> float:
+    """ out-of-fold Qini AUC of one candidate on one fold (runs in a worker process) """
+    features_w_labels = pl.read_ipc(features_path)
+    cate_model = train_cate(features_w_labels[train_idx], lgbm_params=params, n_jobs=n_jobs)
+    eval_df = evaluate_cate(cate_model, features_w_labels[val_idx])
+    return qini_auc_score(y_true=1 - eval_df['churn'].to_numpy(),
+                          uplift=eval_df['te'].to_numpy(),
+                          treatment=eval_df['outreach'].to_numpy())
+
+
+def successive_halving(features_path: Path,
+                       candidates: list[dict],
+                       folds: list[tuple[np.ndarray, np.ndarray]],
+                       eta: int = 3,
+                       n_workers: int = 1) -> pl.DataFrame:
+    """ Successive halving over the folds: every candidate is evaluated on the first fold(s), only the best 1/eta
+        are evaluated on eta times more folds, until the survivors are evaluated on all folds.
+
+    Args:
+        features_path (Path): Arrow IPC of the featurized data, memory-mapped by the workers
+        candidates (list[dict]): LightGBM settings
+        folds (list[tuple[np.ndarray, np.ndarray]]): (train, validation) row indices
+        eta (int, optional): Defaults to 3.
+        n_workers (int, optional): parallel processes. Defaults to 1.
+
+    Returns:
+        pl.DataFrame: leaderboard, one row per candidate with its mean and std Qini AUC over the evaluated folds
+    """
+    scores = {i: [] for i in range(len(candidates))}
+    alive = list(range(len(candidates)))
+    n_rung_folds = max(1, len(folds) // eta ** max(0, math.ceil(math.log(len(candidates), eta)) - 1))
+    n_jobs = max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+    # spawned, not forked: the parent already ran polars (ingestion, featurization), and forking a process that
+    # runs polars' thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=max(1, n_workers), mp_context=multiprocessing.get_context('spawn')) as executor:
+        while True:
+            jobs = {(i, fold): executor.submit(_evaluate_fold, features_path, candidates[i], *folds[fold], n_jobs)
+                    for i in alive for fold in range(len(scores[i]), n_rung_folds)}
+            for (i, fold), job in sorted(jobs.items()):
+                scores[i].append(job.result())
+            logger.info(f"Evaluated {len(alive)} candidates on {n_rung_folds} folds")
+
+            if n_rung_folds == len(folds) or len(alive) == 1:
+                break
+            alive = sorted(alive, key=lambda i: np.mean(scores[i]), reverse=True)[:max(1, len(alive) // eta)]
+            n_rung_folds = min(len(folds), n_rung_folds * eta)
+
+    leaderboard = pl.DataFrame([{**DEFAULT_LGBM_PARAMS, **candidates[i],
+                                 'qini_auc_mean': float(np.mean(fold_scores)),
+                                 'qini_auc_std': float(np.std(fold_scores)),
+                                 'n_folds': len(fold_scores)}
+                                for i, fold_scores in scores.items()])
+    # rank the candidates that made it to the last rung first
+    return leaderboard.sort(by=['n_folds', 'qini_auc_mean'], descending=True)
+
+
+def tune(data_folder: str | Path,
+         output_folder: str | Path,
+         search: str = 'random',
+         n_candidates: int = 27,
+         n_folds: int = 5,
+         eta: int = 3,
+         n_workers: int = 1,
+         seed: int = 0,
+         horizons: Optional[list[int]] = None,
+         gap_stats: bool = False) -> dict:
+    """ Featurize the train data once, then search the CATE model's LightGBM settings by out-of-fold Qini AUC
+
+    Returns:
+        dict: best LightGBM settings
+    """
+    output_path = Path(output_folder)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    train_dfs = ingest_and_pre_process_data(Path(data_folder) / 'train', n_workers=4)
+    features_w_labels = featurize_data(train_dfs, horizons=horizons or (), gap_stats=gap_stats)
+    # written once and memory-mapped by every worker, instead of pickled to each of them
+    features_path = output_path / 'features.arrow'
+    features_w_labels.write_ipc(features_path)
+
+    folds = _stratified_folds(features_w_labels, n_folds, seed)
+    candidates = _candidates(search, n_candidates, seed)
+    logger.info(f"Searching {len(candidates)} candidates on {n_folds} folds with {n_workers} workers")
+
+    leaderboard = successive_halving(features_path, candidates, folds, eta, n_workers)
+    leaderboard.write_csv(output_path / 'leaderboard.csv')
+
+    best_config = {name: leaderboard[name][0] for name in {**DEFAULT_LGBM_PARAMS, **PARAM_GRID}}
+    (output_path / 'best_config.json').write_text(json.dumps(best_config, indent=2))
+    logger.info(f"Best config (Qini AUC {leaderboard['qini_auc_mean'][0]:.3f}): {best_config}")
+    return best_config
+
+
+def main():
+    args = parse_args()
+    tune(args.data_folder,
+         args.output_folder,
+         search=args.search,
+         n_candidates=args.n_candidates,
+         n_folds=args.n_folds,
+         eta=args.eta,
+         n_workers=args.workers,
+         seed=args.seed,
+         horizons=args.horizons,
+         gap_stats=args.gap_stats)
+
+
+if __name__ == "__main__":
+    main()
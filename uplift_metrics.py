@@ -0,0 +1,346 @@
+import numpy as np
+from typing import Optional, Sequence
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Vectorized uplift metrics. Members are sorted once by score, and every curve point, every k of
+# uplift_at_k and every bootstrap / permutation resample is computed with cumulative sums over that order.
+# Curves and scores follow the definitions of sklift.metrics (qini_curve, uplift_curve, qini_auc_score,
+# uplift_auc_score, uplift_at_k with strategy='overall'), which check_sklift_parity verifies
+# (python uplift_metrics.py).
+
+# resamples are processed in blocks of (resamples x members) arrays of at most this many elements
+_MAX_BLOCK_ELEMENTS = 10_000_000
+
+
+def _as_arrays(y_true, uplift, treatment) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return (np.asarray(y_true, dtype=np.float64),
+            np.asarray(uplift, dtype=np.float64),
+            np.asarray(treatment, dtype=np.float64))
+
+
+def _sort_desc(score: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ order of the members by descending score, and the positions (in that order) of the last member
+        of each group of tied scores, where the curves are evaluated
+    """
+    order = np.argsort(score, kind='mergesort')[::-1]
+    sorted_score = score[order]
+    thresholds = np.r_[np.flatnonzero(np.diff(sorted_score)), sorted_score.size - 1]
+    return order, thresholds
+
+
+def _safe_divide(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a, b = np.broadcast_arrays(a, b)
+    return np.divide(a, b, out=np.zeros(a.shape), where=b != 0)
+
+
+def _cumulative_counts(y_sorted: np.ndarray,
+                       t_sorted: np.ndarray,
+                       thresholds: np.ndarray,
+                       weights: Optional[np.ndarray] = None) -> tuple[np.ndarray, ...]:
+    """ number of members, treated members, treated responders and control responders in the top of
+        the order, at each threshold. All inputs are in sorted order, with a leading resamples axis for
+        2d y/t (permutations) or weights (bootstrap).
+    """
+    if weights is None:
+        weights = np.ones_like(y_sorted)
+    weights = np.broadcast_to(weights, np.broadcast_shapes(weights.shape, y_sorted.shape))
+    n_all = np.cumsum(weights, axis=-1)[..., thresholds]
+    n_trmnt = np.cumsum(weights * t_sorted, axis=-1)[..., thresholds]
+    y_trmnt = np.cumsum(weights * y_sorted * t_sorted, axis=-1)[..., thresholds]
+    y_ctrl = np.cumsum(weights * y_sorted * (1 - t_sorted), axis=-1)[..., thresholds]
+    return n_all, n_trmnt, n_all - n_trmnt, y_trmnt, y_ctrl
+
+
+def _prepend_origin(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    pad = [(0, 0)] * (x.ndim - 1) + [(1, 0)]
+    return np.pad(x, pad), np.pad(y, pad)
+
+
+def _qini_from_counts(n_all, n_trmnt, n_ctrl, y_trmnt, y_ctrl) -> tuple[np.ndarray, np.ndarray]:
+    return _prepend_origin(n_all, y_trmnt - y_ctrl * _safe_divide(n_trmnt, n_ctrl))
+
+
+def _uplift_from_counts(n_all, n_trmnt, n_ctrl, y_trmnt, y_ctrl) -> tuple[np.ndarray, np.ndarray]:
+    return _prepend_origin(n_all, (_safe_divide(y_trmnt, n_trmnt) - _safe_divide(y_ctrl, n_ctrl)) * n_all)
+
+
+def _auc(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ trapezoidal area under the curve(s), along the last axis """
+    return ((x[..., 1:] - x[..., :-1]) * (y[..., 1:] + y[..., :-1]) / 2).sum(axis=-1)
+
+
+def _normalized_auc(x, y, x_perfect, y_perfect) -> np.ndarray:
+    """ area between the curve and the random baseline, relative to the area of the perfect curve """
+    baseline = x_perfect[..., -1] * y_perfect[..., -1] / 2
+    return (_auc(x, y) - baseline) / (_auc(x_perfect, y_perfect) - baseline)
+
+
+def _perfect_qini_score(y_true: np.ndarray, treatment: np.ndarray) -> np.ndarray:
+    # treated responders first, control responders last (negative effect allowed)
+    return y_true * treatment - y_true * (1 - treatment)
+
+
+def _perfect_uplift_score(y_true: np.ndarray, treatment: np.ndarray) -> np.ndarray:
+    control_responders = np.sum((y_true == 1) & (treatment == 0))
+    treated_non_responders = np.sum((y_true == 0) & (treatment == 1))
+    summand = y_true if control_responders > treated_non_responders else treatment
+    return 2 * (y_true == treatment) + summand
+
+
+def qini_curve(y_true, uplift, treatment) -> tuple[np.ndarray, np.ndarray]:
+    """ Qini curve: incremental number of responders in the top members, per number of top members
+
+    Args:
+        y_true: binary outcome (1 = response, e.g. no churn)
+        uplift: predicted uplift score
+        treatment: binary treatment flag
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: number of members, Qini curve value
+    """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    order, thresholds = _sort_desc(uplift)
+    return _qini_from_counts(*_cumulative_counts(y_true[order], treatment[order], thresholds))
+
+
+def uplift_curve(y_true, uplift, treatment) -> tuple[np.ndarray, np.ndarray]:
+    """ Uplift curve: difference of treated and control response rates in the top members, times their number
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: number of members, uplift curve value
+    """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    order, thresholds = _sort_desc(uplift)
+    return _uplift_from_counts(*_cumulative_counts(y_true[order], treatment[order], thresholds))
+
+
+def perfect_qini_curve(y_true, treatment) -> tuple[np.ndarray, np.ndarray]:
+    """ Qini curve of the perfect ranking (treated responders first, control responders last) """
+    y_true, _, treatment = _as_arrays(y_true, y_true, treatment)
+    return qini_curve(y_true, _perfect_qini_score(y_true, treatment), treatment)
+
+
+def qini_auc_score(y_true, uplift, treatment) -> float:
+    """ Normalized area under the Qini curve (1 = perfect ranking, 0 = random) """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    x, y = qini_curve(y_true, uplift, treatment)
+    x_perfect, y_perfect = perfect_qini_curve(y_true, treatment)
+    return float(_normalized_auc(x, y, x_perfect, y_perfect))
+
+
+def uplift_auc_score(y_true, uplift, treatment) -> float:
+    """ Normalized area under the uplift curve, AUUC (1 = perfect ranking, 0 = random) """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    x, y = uplift_curve(y_true, uplift, treatment)
+    x_perfect, y_perfect = uplift_curve(y_true, _perfect_uplift_score(y_true, treatment), treatment)
+    return float(_normalized_auc(x, y, x_perfect, y_perfect))
+
+
+def uplift_at_k(y_true, uplift, treatment, k: float | Sequence[float]) -> np.ndarray:
+    """ Difference of treated and control response rates in the top k fraction of members, for many k at once.
+        Same as sklift.metrics.uplift_at_k(strategy='overall') for k in (0, 1), except that a top of less than
+        one member (int(k * members) == 0) is evaluated at the first member, while sklift's is empty.
+
+    Args:
+        y_true: binary outcome
+        uplift: predicted uplift score
+        treatment: binary treatment flag
+        k (float | Sequence[float]): fraction(s) of members, in (0, 1] (sklift rejects k = 1.0)
+
+    Returns:
+        np.ndarray: uplift at each k (nan where the top has no treated or no control members)
+    """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    order = np.argsort(uplift, kind='mergesort')[::-1]
+    top_sizes = (np.atleast_1d(np.asarray(k, dtype=np.float64)) * y_true.size).astype(int)
+    positions = np.clip(top_sizes, 1, y_true.size) - 1
+    _, n_trmnt, n_ctrl, y_trmnt, y_ctrl = _cumulative_counts(y_true[order], treatment[order], positions)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return y_trmnt / n_trmnt - y_ctrl / n_ctrl
+
+
+def _blocks(n_resamples: int, n_members: int) -> list[int]:
+    block_size = max(1, _MAX_BLOCK_ELEMENTS // max(1, n_members))
+    return [min(block_size, n_resamples - start) for start in range(0, n_resamples, block_size)]
+
+
+def bootstrap_qini_auc(y_true, uplift, treatment,
+                       n_resamples: int = 1000,
+                       confidence: float = 0.95,
+                       seed: int = 0) -> tuple[float, float, np.ndarray]:
+    """ Bootstrap confidence interval of qini_auc_score.
+        A resample is a vector of multinomial member counts, so the members are sorted only once (by score, and
+        by perfect score) and a block of resamples is a batch of weighted cumulative sums over that order.
+
+    Args:
+        y_true: binary outcome
+        uplift: predicted uplift score
+        treatment: binary treatment flag
+        n_resamples (int, optional): Defaults to 1000.
+        confidence (float, optional): Defaults to 0.95.
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        tuple[float, float, np.ndarray]: lower and upper bound of the interval, and the resampled scores
+    """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    n = y_true.size
+    rng = np.random.default_rng(seed)
+    order, thresholds = _sort_desc(uplift)
+    perfect_order, perfect_thresholds = _sort_desc(_perfect_qini_score(y_true, treatment))
+
+    samples = []
+    for block_size in _blocks(n_resamples, n):
+        weights = rng.multinomial(n, np.full(n, 1 / n), size=block_size).astype(np.float64)
+        x, y = _qini_from_counts(*_cumulative_counts(y_true[order], treatment[order], thresholds,
+                                                     weights[:, order]))
+        x_perfect, y_perfect = _qini_from_counts(*_cumulative_counts(y_true[perfect_order], treatment[perfect_order],
+                                                                     perfect_thresholds, weights[:, perfect_order]))
+        samples.append(_normalized_auc(x, y, x_perfect, y_perfect))
+    samples = np.concatenate(samples)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.nanquantile(samples, [alpha, 1 - alpha])
+    return float(low), float(high), samples
+
+
+def permutation_test_qini_auc(y_true, uplift, treatment,
+                              n_resamples: int = 1000,
+                              seed: int = 0) -> tuple[float, np.ndarray]:
+    """ One-sided permutation test of qini_auc_score against a random ranking.
+        Permuting the scores between members keeps the sorted scores (and their ties), so each permutation
+        is only a reordering of the outcomes and treatments along the already computed thresholds.
+
+    Returns:
+        tuple[float, np.ndarray]: p-value, and the scores under the null
+    """
+    y_true, uplift, treatment = _as_arrays(y_true, uplift, treatment)
+    n = y_true.size
+    rng = np.random.default_rng(seed)
+    observed = qini_auc_score(y_true, uplift, treatment)
+    _, thresholds = _sort_desc(uplift)
+    # the perfect curve doesn't depend on the scores, so it's the same for all permutations
+    x_perfect, y_perfect = perfect_qini_curve(y_true, treatment)
+
+    null_scores = []
+    for block_size in _blocks(n_resamples, n):
+        permutations = rng.permuted(np.broadcast_to(np.arange(n), (block_size, n)), axis=1)
+        x, y = _qini_from_counts(*_cumulative_counts(y_true[permutations], treatment[permutations], thresholds))
+        null_scores.append(_normalized_auc(x, y, x_perfect, y_perfect))
+    null_scores = np.concatenate(null_scores)
+
+    p_value = (1 + np.sum(null_scores >= observed)) / (1 + null_scores.size)
+    return float(p_value), null_scores
+
+
+def select_outreach_size(y_true, uplift, treatment,
+                         cost_per_outreach: Optional[float] = None,
+                         value_per_retained: Optional[float] = None) -> int:
+    """ Number of top members to reach out to.
+        With a cost per outreach and a value per retained member it's the size with the highest net value
+        (value * incremental responders - cost * outreaches), the incremental responders of reaching all the top
+        members being the uplift curve ((treated rate - control rate) * members). Otherwise it's the first elbow 
+        of the Qini (cumulative incremental gain) curve: the point furthest above the chord from the origin to 
+        the curve's maximum (Kneedle).
+
+    Args:
+        y_true: binary outcome (1 = retained)
+        uplift: predicted uplift score
+        treatment: binary treatment flag
+        cost_per_outreach (Optional[float], optional): Defaults to None.
+        value_per_retained (Optional[float], optional): Defaults to None.
+
+    Returns:
+        int: outreach size
+    """
+    if (cost_per_outreach is None) != (value_per_retained is None):
+        raise ValueError("cost_per_outreach and value_per_retained must be given together")
+    if cost_per_outreach is not None:
+        # the uplift curve, not the Qini curve: the Qini value only counts the incremental responders among the
+        # treated members of the top, while all the members of the top are reached (and cost)
+        x, incremental_responders = uplift_curve(y_true, uplift, treatment)
+        return int(x[np.argmax(value_per_retained * incremental_responders - cost_per_outreach * x)])
+
+    x, qini = qini_curve(y_true, uplift, treatment)
+
+    peak = int(np.argmax(qini))
+    if peak == 0 or qini[peak] <= 0:
+        return 0
+    x_normalized = x[:peak + 1] / x[peak]
+    qini_normalized = qini[:peak + 1] / qini[peak]
+    return int(x[np.argmax(qini_normalized - x_normalized)])
+
+
+def top_k_indices(scores, k: int) -> np.ndarray:
+    """ indices of the k highest scores, in descending score order. Selects them with a partial sort 
+        (argpartition, linear in the number of members) and only sorts the k selected ones.
+    """
+    scores = np.asarray(scores)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.size:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(scores.size)
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def check_sklift_parity(n_members: int = 2000,
+                        n_trials: int = 20,
+                        k: Sequence[float] = (0.05, 0.1, 0.3, 0.5, 0.9),
+                        atol: float = 1e-9,
+                        seed: int = 0) -> dict[str, float]:
+    """ Compare qini_auc_score, uplift_auc_score and uplift_at_k with sklift.metrics on random data. Half of the
+        trials have continuous scores, the other half scores rounded to a few values, so many members are tied.
+
+    Args:
+        n_members (int, optional): Defaults to 2000.
+        n_trials (int, optional): Defaults to 20.
+        k (Sequence[float], optional): fractions of uplift_at_k, in (0, 1) as sklift requires, and with a top of
+            at least one member. Defaults to (0.05, 0.1, 0.3, 0.5, 0.9).
+        atol (float, optional): tolerated absolute difference. Defaults to 1e-9.
+        seed (int, optional): Defaults to 0.
+
+    Raises:
+        ValueError: if a metric differs from sklift's by more than atol
+
+    Returns:
+        dict[str, float]: largest absolute difference of each metric
+    """
+    from sklift import metrics as sklift_metrics
+
+    rng = np.random.default_rng(seed)
+    differences = {'qini_auc_score': 0.0, 'uplift_auc_score': 0.0, 'uplift_at_k': 0.0}
+    for trial in range(n_trials):
+        treatment = rng.integers(0, 2, n_members)
+        uplift = rng.normal(size=n_members)
+        if trial % 2:
+            uplift = np.round(uplift, 1)
+        # responses depend on the score for the treated, so the metrics are away from 0
+        y_true = (rng.random(n_members) < 0.3 + 0.1 * treatment * (uplift > 0)).astype(int)
+
+        for name, ours, theirs in [
+                ('qini_auc_score', qini_auc_score, sklift_metrics.qini_auc_score),
+                ('uplift_auc_score', uplift_auc_score, sklift_metrics.uplift_auc_score)]:
+            differences[name] = max(differences[name], abs(ours(y_true, uplift, treatment)
+                                                           - theirs(y_true, uplift, treatment)))
+        at_k = uplift_at_k(y_true, uplift, treatment, k)
+        sklift_at_k = np.array([sklift_metrics.uplift_at_k(y_true, uplift, treatment, strategy='overall', k=top)
+                                for top in k])
+        # nan (no treated or control members in the top) must match, and makes the difference nan otherwise
+        at_k_difference = np.where(np.isnan(at_k) & np.isnan(sklift_at_k), 0, np.abs(at_k - sklift_at_k))
+        differences['uplift_at_k'] = float(np.max(np.r_[differences['uplift_at_k'], at_k_difference]))
+
+    mismatches = {name: difference for name, difference in differences.items() if not difference <= atol}
+    if mismatches:
+        raise ValueError(f"uplift_metrics differs from sklift.metrics: {mismatches}")
+    logger.info(f"uplift_metrics matches sklift.metrics on {n_trials} trials of {n_members} members: {differences}")
+    return differences
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    check_sklift_parity()